@@ -1,100 +1,95 @@
 import os
+import re
+import json
+import time
+import asyncio
+import string
+import hashlib
+import tempfile
 import logging
-from google import genai
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import date
+from functools import lru_cache
 from google.genai import types
 from dotenv import load_dotenv
+import gemini_dispatcher
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-class AnalystAgent:
-    def __init__(self):
-        self.api_key = os.environ.get("GEMINI_API_KEY")
-        if not self.api_key:
-            logger.error("GEMINI_API_KEY not found for AnalystAgent")
-        else:
-            self.client = genai.Client(api_key=self.api_key)
+# Sub-agent findings are cached on disk so repeat runs skip the paid search call
+RESEARCH_CACHE_DIR = os.path.join(".cache", "research")
+RESEARCH_CACHE_TTL = int(os.environ.get("RESEARCH_CACHE_TTL", 6 * 3600))  # seconds
 
-    def _run_research_task(self, symbol: str, role: str, focus_area: str, model_name: str = "gemini-2.5-flash") -> str:
-        """
-        Executes a specific research sub-task using Google Search.
-        Using Flash model for speed and efficiency in information gathering.
-        """
-        prompt = f"""
-You are a professional {role} analyzing {symbol}.
-Your goal is to gather FACTUAL information from the internet regarding: {focus_area}.
+# Chief Editor reports are reused when a new prompt embeds close to a previous one
+SEMANTIC_CACHE_DIR = os.path.join(".cache", "semantic")
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_TTL = int(os.environ.get("SEMANTIC_CACHE_TTL", 24 * 3600))  # seconds
+EMBEDDING_MODEL = "text-embedding-004"
+# text-embedding-004 only reads ~2k tokens; embed a fixed-size prefix explicitly
+EMBEDDING_MAX_CHARS = 6000
 
-Please perform a Google Search and summarize your findings in concise bullet points.
-Include numbers, dates, and sources where possible. Do not write a full essay, just key facts.
-"""
-        # Configure Search Tool
-        grounding_tool = types.Tool(google_search=types.GoogleSearch())
-        config = types.GenerateContentConfig(tools=[grounding_tool])
+# Every generate_content call is bounded: HTTP timeout and output cap (retries live in gemini_dispatcher)
+RESEARCH_TIMEOUT_MS = 60_000
+EDITOR_TIMEOUT_MS = 300_000  # a 16k-token Pro synthesis legitimately takes minutes
+RESEARCH_MAX_OUTPUT_TOKENS = 4096
+COMBINED_RESEARCH_TIMEOUT_MS = 120_000  # one call covers several briefs' worth of searches
+EDITOR_MAX_OUTPUT_TOKENS = 16384
+GENERATION_TEMPERATURE = 0.3
 
-        try:
-            response = self.client.models.generate_content(
-                model=model_name,
-                contents=prompt,
-                config=config
-            )
-            return response.text if response.text else f"[No data found by {role}]"
-        except Exception as e:
-            logger.warning(f"{role} failed: {e}")
-            return f"[Search Error for {role}: {e}]"
+# Batch API job states after which a job will not produce (more) results
+BATCH_TERMINAL_STATES = ("JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED")
 
-    def generate_deep_research_report(self, symbol: str, context_text: str = "", model_name: str = "gemini-2.5-pro") -> str:
-        """
-        Multi-Agent Workflow:
-        1. 3 Sub-Agents gather info (Data, Industry, Corp).
-        2. Main Agent synthesizes everything into a report.
-        Returns: final_report_text
-        """
-        if not self.api_key:
-            return "Error: API Key missing."
+# Report date override, read once; otherwise the current local date at render time
+_CURRENT_DATE = os.environ.get("CURRENT_DATE")
 
-        logger.info(f"Starting Multi-Agent Research for {symbol}...")
 
-        # --- Phase 1: Distributed Research (Sub-Agents) ---
-        # 1. Data Analyst
-        data_research = self._run_research_task(
-            symbol, 
-            "Financial Data Analyst", 
-            "Latest financial reports (Revenue, Net Profit, Growth), PE/PB/PS ratios, Market Cap, Stock Price Performance (YTD/1Y), Dividend yield."
-        )
-        
-        # 2. Industry Analyst
-        industry_research = self._run_research_task(
-            symbol,
-            "Industry Researcher",
-            "Industry market size & CAGR, Supply chain position (Upstream/Downstream), Major Competitors & Market Share, Recent Industry Trends/Policies."
-        )
+def _report_date() -> str:
+    # Not frozen at import: a long-running worker must roll over at midnight
+    return _CURRENT_DATE or date.today().isoformat()
 
-        # 3. Corporate Analyst
-        corp_research = self._run_research_task(
-            symbol,
-            "Corporate Intelligence Specialist",
-            "Recent company news (last 6 months), Product launches, Management changes, Strategic partnerships, Legal disputes or Risks."
-        )
 
-        # Combine Raw Search Data
-        raw_search_content = f"""
-=== RESEARCH AGENT 1: FINANCIAL DATA ===
-{data_research}
+# Knowledge-base context handed to the Chief Editor is capped by estimated tokens, not characters
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 40_000))
+# Paragraphs shorter than this (headings, separators) may legitimately repeat and are never deduped
+CONTEXT_DEDUP_MIN_CHARS = 64
+_PARAGRAPH_SPLIT_RE = re.compile(r"\n\s*\n")
+_SECTION_MARKER_RE = re.compile(r"^\s*=== SECTION (\d+) ===\s*$", re.MULTILINE)
 
-=== RESEARCH AGENT 2: INDUSTRY ANALYSIS ===
-{industry_research}
+EDITOR_CONFIG = types.GenerateContentConfig(
+    temperature=GENERATION_TEMPERATURE,
+    max_output_tokens=EDITOR_MAX_OUTPUT_TOKENS,
+    http_options=types.HttpOptions(timeout=EDITOR_TIMEOUT_MS),
+)
 
-=== RESEARCH AGENT 3: CORPORATE INTELLIGENCE ===
-{corp_research}
-"""
+# Large knowledge-base contexts are uploaded once as Gemini explicit cached content
+# and reused across reports until they change; below the API minimum it is not worth it
+CONTEXT_CACHE_MIN_TOKENS = 4096
+CONTEXT_CACHE_TTL = 3600  # seconds
+KNOWLEDGE_CACHED_NOTE = "(See the Internal Knowledge Base documents provided at the start of this conversation.)"
 
-        # --- Phase 2: Synthesis (Chief Editor) ---
-        market_context = "China A-Share" if symbol.isdigit() else "US Stock"
-        
-        main_prompt = f"""
+
+def _editor_config(cached_content: str = None):
+    """EDITOR_CONFIG, optionally pointing at an explicit context cache."""
+    if not cached_content:
+        return EDITOR_CONFIG
+    return types.GenerateContentConfig(
+        temperature=GENERATION_TEMPERATURE,
+        max_output_tokens=EDITOR_MAX_OUTPUT_TOKENS,
+        http_options=types.HttpOptions(timeout=EDITOR_TIMEOUT_MS),
+        cached_content=cached_content,
+    )
+
+
+# Chief Editor prompt skeletons. Per-report constants are filled once per
+# (symbol/profile, model, date) and cached; only research + context vary per call.
+_STOCK_REPORT_TEMPLATE = string.Template("""
 You are a Top Wall Street Investment Analyst (Chief Editor).
-Your task is to write a comprehensive, professional investment research report for the {market_context} stock: {symbol}.
+Your task is to write a comprehensive, professional investment research report for the $market_context stock: $symbol.
 
 **IMPORTANT: The entire report content MUST be written in Simplified Chinese (简体中文).**
 
@@ -102,10 +97,10 @@ Your task is to write a comprehensive, professional investment research report f
 I have dispatched 3 field researchers to gather the latest data. You must synthesize their findings along with our internal knowledge base.
 
 #### 1. Fresh Field Research (Latest Internet Data):
-{raw_search_content}
+$raw_search_content
 
 #### 2. Internal Knowledge Base (User Uploads):
-{context_text[:150000]}
+$knowledge_context
 
 ### Task
 Write a cohesive, deep-dive report. Do not just copy-paste the research; analyze it. Connect the dots between financial data, industry trends, and internal docs.
@@ -113,9 +108,9 @@ Write a cohesive, deep-dive report. Do not just copy-paste the research; analyze
 ### Report Structure (Markdown)
 Please structure the report exactly as follows (Titles in Chinese):
 
-# {symbol} 深度投资价值分析报告
-**日期:** {os.environ.get('CURRENT_DATE', 'Today')}
-**分析师:** AI Advisor ({model_name})
+# $symbol 深度投资价值分析报告
+**日期:** $report_date
+**分析师:** AI Advisor ($model_name)
 
 ## 1. 核心观点 (Executive Summary)
 - 评级：(买入/持有/卖出)
@@ -127,7 +122,7 @@ Please structure the report exactly as follows (Titles in Chinese):
 
 ## 3. 行业与竞争格局 (Industry & Competitive Landscape)
 - 行业分析师的洞察
-- {symbol} 的市场地位
+- $symbol 的市场地位
 
 ## 4. 经营动态与风险 (Operational Updates & Risks)
 - 公司新闻与内部资料结合
@@ -135,101 +130,11 @@ Please structure the report exactly as follows (Titles in Chinese):
 
 ## 5. 结论 (Conclusion)
 - 最终结论与展望
-"""
-
-        # Main Agent Config (No search tool needed here, as we provided the search results in context)
-        # Using Pro model for reasoning
-        try:
-            logger.info(f"Chief Editor generating final report using {model_name}...")
-            response = self.client.models.generate_content(
-                model=model_name,
-                contents=main_prompt
-            )
-            final_report = response.text if response.text else "Error: Chief Editor produced no text."
-            
-            return final_report
-
-        except Exception as e:
-            logger.error(f"Chief Editor Failed: {e}")
-            return f"Agent Error: {str(e)}"
-
-    def generate_macro_strategy_report(self, category: str, context_text: str = "", model_name: str = "gemini-2.5-pro") -> str:
-        """
-        Generates a specialized report for Macro or Strategy analysis using a Multi-Agent Workflow.
-        Phase 1: 3 Sub-Agents gather fresh internet data.
-        Phase 2: Chief Editor synthesizes Search Data + Knowledge Base into a strategic report.
-        """
-        if not self.api_key:
-            return "Error: API Key missing."
-
-        current_date = os.environ.get('CURRENT_DATE', 'Today')
-        logger.info(f"Starting Multi-Agent Research for {category}...")
+""")
 
-        # --- Phase 1: Distributed Research (Sub-Agents) ---
-        if category == "MACRO":
-            # 1. Policy Agent
-            search_1 = self._run_research_task(
-                "Global & China Economy",
-                "Global Policy Researcher",
-                "Latest Federal Reserve interest rate decisions, ECB policy, China Politburo meeting notes, China Fiscal Stimulus updates, Monetary policy adjustments."
-            )
-            # 2. Economic Data Agent
-            search_2 = self._run_research_task(
-                "Global & China Economy",
-                "Economic Data Specialist",
-                "China GDP growth, CPI/PPI inflation data, Caixin PMI, US Non-farm payrolls, US CPI, 10-Year Treasury Yield trends."
-            )
-            # 3. Geopolitics Agent
-            search_3 = self._run_research_task(
-                "Global Markets",
-                "Geopolitical Risk Analyst",
-                "US-China trade relations, Regional conflicts (Middle East/Europe), Oil & Gold price trends due to geopolitics, Global supply chain disruptions."
-            )
-            
-            role_title = "首席宏观经济顾问 (Chief Macro Economist)"
-            report_title = "全球与中国宏观经济深度展望报告"
-            core_task = "Analyze the current global and Chinese macroeconomic environment, focusing on policy, interest rates, GDP, and geopolitical risks."
-
-        else: # STRATEGY
-            # 1. Sentiment Agent
-            search_1 = self._run_research_task(
-                "China A-Share & Global Markets",
-                "Market Sentiment Analyst",
-                "Market fear/greed index, VIX trend, Trading volume analysis, Northbound capital flows (Stock Connect), Institutional investor sentiment."
-            )
-            # 2. Sector Agent
-            search_2 = self._run_research_task(
-                "China A-Share Market",
-                "Sector Rotation Specialist",
-                "Top performing sectors this month, Sectors with institutional buying, rotation trends from Growth to Value (or vice versa), Theme concepts (e.g., AI, Low Altitude)."
-            )
-            # 3. Allocation Agent
-            search_3 = self._run_research_task(
-                "Global Assets",
-                "Asset Allocation Strategist",
-                "Equity Risk Premium (ERP), Bond Yield vs Dividend Yield comparison, Commodity trends, Currency (USD/CNY) impact on assets."
-            )
-
-            role_title = "首席投资策略顾问 (Chief Investment Strategist)"
-            report_title = "各大类资产配置与投资策略报告"
-            core_task = "Formulate investment strategies, asset allocation advice, and risk management rules based on the current market environment."
-
-        # Combine Raw Search Data
-        raw_search_content = f"""
-=== RESEARCH AGENT 1: POLICY / SENTIMENT ===
-{search_1}
-
-=== RESEARCH AGENT 2: DATA / SECTORS ===
-{search_2}
-
-=== RESEARCH AGENT 3: RISKS / ALLOCATION ===
-{search_3}
-"""
-
-        # --- Phase 2: Synthesis (Chief Editor) ---
-        prompt = f"""
-You are the {role_title}. 
-Your task is to write a high-level, forward-looking strategic report: "{report_title}".
+_MACRO_STRATEGY_TEMPLATE = string.Template("""
+You are the $role_title. 
+Your task is to write a high-level, forward-looking strategic report: "$report_title".
 
 **Constraint:** The report MUST be written in **Simplified Chinese (简体中文)**.
 
@@ -237,18 +142,18 @@ Your task is to write a high-level, forward-looking strategic report: "{report_t
 I have dispatched 3 field researchers to gather the latest data. You must synthesize their findings along with our internal knowledge base.
 
 #### 1. Fresh Field Research (Latest Internet Data):
-{raw_search_content}
+$raw_search_content
 
 #### 2. Internal Knowledge Base (User Uploads):
-{context_text[:150000]}
+$knowledge_context
 
-### {core_task}
+### $core_task
 
 ### Required Structure (Strictly Follow This)
 
-# {report_title}
-**日期:** {current_date}
-**顾问:** AI Advisor ({model_name})
+# $report_title
+**日期:** $report_date
+**顾问:** AI Advisor ($model_name)
 
 ## 1. 核心观点 (Executive Summary)
 - 当前市场定义的关键特征（牛/熊/震荡）。
@@ -279,16 +184,911 @@ For this section, you MUST provide distinct judgments for three time horizons:
 
 ---
 **Instruction:** Be professional, objective, and decisive. Use the provided Knowledge Base as the primary source of truth if available, but SUPPLEMENT it with the Fresh Field Research.
+""")
+
+
+@lru_cache(maxsize=512)
+def _stock_report_scaffold(symbol: str, model_name: str, report_date: str) -> string.Template:
+    market_context = "China A-Share" if symbol.isdigit() else "US Stock"
+    return string.Template(_STOCK_REPORT_TEMPLATE.safe_substitute(
+        symbol=symbol, market_context=market_context, model_name=model_name, report_date=report_date,
+    ))
+
+
+@lru_cache(maxsize=32)
+def _macro_strategy_scaffold(role_title: str, report_title: str, core_task: str,
+                             model_name: str, report_date: str) -> string.Template:
+    return string.Template(_MACRO_STRATEGY_TEMPLATE.safe_substitute(
+        role_title=role_title, report_title=report_title, core_task=core_task,
+        model_name=model_name, report_date=report_date,
+    ))
+
+
+def _trim_context(context_text: str, budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    Fit the knowledge-base context into `budget` estimated tokens.
+    Repeated paragraphs (the same file uploaded twice, boilerplate disclaimers) are dropped first,
+    then paragraphs are kept from the end, where the most recently added documents are.
+    """
+    if not context_text:
+        return ""
+
+    seen = set()
+    paragraphs = []
+    for para in _PARAGRAPH_SPLIT_RE.split(context_text):
+        if len(para) >= CONTEXT_DEDUP_MIN_CHARS:
+            # Whitespace-insensitive so re-extracted copies of the same page still match
+            digest = hashlib.blake2b(" ".join(para.split()).encode("utf-8"), digest_size=8).digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+        paragraphs.append(para)
+
+    kept, used = [], 0
+    for para in reversed(paragraphs):
+        cost = gemini_dispatcher.estimate_tokens(para)
+        if used + cost > budget:
+            # Keep the tail of the paragraph that crosses the budget
+            remaining = budget - used
+            if remaining > 0:
+                kept.append(para[-(len(para) * remaining // cost):])
+            break
+        kept.append(para)
+        used += cost
+
+    if len(kept) < len(paragraphs):
+        logger.info(f"Knowledge context trimmed: {len(paragraphs)} -> {len(kept)} paragraphs (~{budget} token budget)")
+    return "\n\n".join(reversed(kept))
+
+
+class SemanticReportCache:
+    """
+    Small nearest-neighbour cache of editor reports keyed by prompt embedding.
+    Vectors live in a numpy matrix (vectors.npy), report text and metadata in entries.json.
+    Lookups are scoped (symbol + model + report date + knowledge-base digest) so similar prompts
+    for different stocks, days or uploaded documents never collide.
+    """
+
+    def __init__(self, cache_dir: str = SEMANTIC_CACHE_DIR, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 ttl: int = SEMANTIC_CACHE_TTL):
+        self.vectors_path = os.path.join(cache_dir, "vectors.npy")
+        self.entries_path = os.path.join(cache_dir, "entries.json")
+        self.threshold = threshold
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._entries = []
+        self._load()
+
+    def _load(self):
+        try:
+            vectors = np.load(self.vectors_path)
+            with open(self.entries_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Semantic cache load failed: {e}")
+            return
+
+        if len(entries) == len(vectors):
+            self._vectors, self._entries = vectors, entries
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.vectors_path), exist_ok=True)
+            # Temp file + rename, so a crash mid-write never leaves a truncated cache behind
+            with open(f"{self.vectors_path}.tmp", 'wb') as f:
+                np.save(f, self._vectors)
+            with open(f"{self.entries_path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(f"{self.vectors_path}.tmp", self.vectors_path)
+            os.replace(f"{self.entries_path}.tmp", self.entries_path)
+        except Exception as e:
+            logger.warning(f"Semantic cache save failed: {e}")
+
+    def lookup(self, scope: str, vector: np.ndarray):
+        """Return the cached report most similar to `vector` within `scope`, or None."""
+        with self._lock:
+            if self._vectors is None or not len(self._entries):
+                return None
+
+            now = time.time()
+            scores = self._vectors @ vector
+            best, best_score = None, self.threshold
+            for i, entry in enumerate(self._entries):
+                if entry["scope"] == scope and now - entry["ts"] < self.ttl and scores[i] >= best_score:
+                    best, best_score = entry, scores[i]
+
+        if best is not None:
+            logger.info(f"Semantic cache hit for {scope} (similarity {best_score:.3f})")
+            return best["report"]
+        return None
+
+    def add(self, scope: str, vector: np.ndarray, report: str):
+        with self._lock:
+            # Drop expired entries while we are rewriting the files anyway
+            now = time.time()
+            keep = [i for i, e in enumerate(self._entries) if now - e["ts"] < self.ttl]
+            vectors = self._vectors[keep] if self._vectors is not None and keep else np.empty((0, len(vector)), dtype=np.float32)
+            self._entries = [self._entries[i] for i in keep]
+
+            self._vectors = np.vstack([vectors, vector[np.newaxis, :]])
+            self._entries.append({"scope": scope, "ts": now, "report": report})
+            self._save()
+
+    @staticmethod
+    def normalize(values) -> np.ndarray:
+        vector = np.asarray(values, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class AnalystAgent:
+    # Max sub-agents in flight at once for a single report
+    MAX_PARALLEL_RESEARCH = 3
+
+    # Max symbol-level workflows in flight for batch runs
+    MAX_PARALLEL_REPORTS = 8
+
+    # Ask one grounded call to cover all research briefs, falling back to one call per sub-agent
+    COMBINE_RESEARCH_CALLS = True
+
+    # (role, focus_area) for the three stock research sub-agents
+    STOCK_RESEARCH_TASKS = (
+        ("Financial Data Analyst",
+         "Latest financial reports (Revenue, Net Profit, Growth), PE/PB/PS ratios, Market Cap, Stock Price Performance (YTD/1Y), Dividend yield."),
+        ("Industry Researcher",
+         "Industry market size & CAGR, Supply chain position (Upstream/Downstream), Major Competitors & Market Share, Recent Industry Trends/Policies."),
+        ("Corporate Intelligence Specialist",
+         "Recent company news (last 6 months), Product launches, Management changes, Strategic partnerships, Legal disputes or Risks."),
+    )
+
+    # Sub-agents (subject, role, focus_area) and report framing per macro/strategy category
+    MACRO_STRATEGY_PROFILES = {
+        "MACRO": {
+            "tasks": (
+                # 1. Policy Agent
+                ("Global & China Economy", "Global Policy Researcher",
+                 "Latest Federal Reserve interest rate decisions, ECB policy, China Politburo meeting notes, China Fiscal Stimulus updates, Monetary policy adjustments."),
+                # 2. Economic Data Agent
+                ("Global & China Economy", "Economic Data Specialist",
+                 "China GDP growth, CPI/PPI inflation data, Caixin PMI, US Non-farm payrolls, US CPI, 10-Year Treasury Yield trends."),
+                # 3. Geopolitics Agent
+                ("Global Markets", "Geopolitical Risk Analyst",
+                 "US-China trade relations, Regional conflicts (Middle East/Europe), Oil & Gold price trends due to geopolitics, Global supply chain disruptions."),
+            ),
+            "role_title": "首席宏观经济顾问 (Chief Macro Economist)",
+            "report_title": "全球与中国宏观经济深度展望报告",
+            "core_task": "Analyze the current global and Chinese macroeconomic environment, focusing on policy, interest rates, GDP, and geopolitical risks.",
+        },
+        "STRATEGY": {
+            "tasks": (
+                # 1. Sentiment Agent
+                ("China A-Share & Global Markets", "Market Sentiment Analyst",
+                 "Market fear/greed index, VIX trend, Trading volume analysis, Northbound capital flows (Stock Connect), Institutional investor sentiment."),
+                # 2. Sector Agent
+                ("China A-Share Market", "Sector Rotation Specialist",
+                 "Top performing sectors this month, Sectors with institutional buying, rotation trends from Growth to Value (or vice versa), Theme concepts (e.g., AI, Low Altitude)."),
+                # 3. Allocation Agent
+                ("Global Assets", "Asset Allocation Strategist",
+                 "Equity Risk Premium (ERP), Bond Yield vs Dividend Yield comparison, Commodity trends, Currency (USD/CNY) impact on assets."),
+            ),
+            "role_title": "首席投资策略顾问 (Chief Investment Strategist)",
+            "report_title": "各大类资产配置与投资策略报告",
+            "core_task": "Formulate investment strategies, asset allocation advice, and risk management rules based on the current market environment.",
+        },
+    }
+
+    def __init__(self):
+        self.api_key = os.environ.get("GEMINI_API_KEY")
+        self._api_key_present = bool(self.api_key)
+        if not self._api_key_present:
+            logger.error("GEMINI_API_KEY not found for AnalystAgent")
+        else:
+            self.client = gemini_dispatcher.get_client(self.api_key)
+        self.semantic_cache = SemanticReportCache()
+        # (model, context digest) -> (cached content name, expiry timestamp)
+        self._context_caches = {}
+        self._context_caches_lock = threading.Lock()
+
+    @staticmethod
+    def _build_research_request(symbol: str, role: str, focus_area: str):
+        """Build the (prompt, config) pair shared by the sync and async sub-agent calls."""
+        prompt = f"""
+You are a professional {role} analyzing {symbol}.
+Your goal is to gather FACTUAL information from the internet regarding: {focus_area}.
+
+Please perform a Google Search and summarize your findings in concise bullet points.
+Include numbers, dates, and sources where possible. Do not write a full essay, just key facts.
+"""
+        # Configure Search Tool
+        grounding_tool = types.Tool(google_search=types.GoogleSearch())
+        config = types.GenerateContentConfig(
+            tools=[grounding_tool],
+            temperature=GENERATION_TEMPERATURE,
+            max_output_tokens=RESEARCH_MAX_OUTPUT_TOKENS,
+            http_options=types.HttpOptions(timeout=RESEARCH_TIMEOUT_MS),
+        )
+        return prompt, config
+
+    @staticmethod
+    def _build_combined_research_request(tasks):
+        """(prompt, config) for a single grounded call covering several (subject, role, focus_area) briefs."""
+        briefs = "\n".join(
+            f"Brief {i}: As a professional {role} analyzing {subject}, gather FACTUAL information regarding: {focus_area}"
+            for i, (subject, role, focus_area) in enumerate(tasks, 1)
+        )
+        markers = "\n".join(f"=== SECTION {i} ===\n<findings for brief {i}>" for i in range(1, len(tasks) + 1))
+        prompt = f"""
+You are a team of professional research analysts.
+Your goal is to gather FACTUAL information from the internet for each of the following briefs.
+
+{briefs}
+
+Please perform Google Searches for every brief and summarize the findings of each in concise bullet points.
+Include numbers, dates, and sources where possible. Do not write a full essay, just key facts.
+
+Format your answer EXACTLY as follows, one section per brief in the same order, with nothing before the first marker:
+{markers}
 """
+        # Structured JSON output can't be combined with the search tool on 2.5 models,
+        # so sections are delimited by plain-text markers instead
+        grounding_tool = types.Tool(google_search=types.GoogleSearch())
+        config = types.GenerateContentConfig(
+            tools=[grounding_tool],
+            temperature=GENERATION_TEMPERATURE,
+            max_output_tokens=RESEARCH_MAX_OUTPUT_TOKENS * len(tasks),
+            http_options=types.HttpOptions(timeout=COMBINED_RESEARCH_TIMEOUT_MS),
+        )
+        return prompt, config
+
+    @staticmethod
+    def _parse_combined_research(text: str, count: int):
+        """Split a combined research answer into `count` sections, or None if any section is missing."""
+        if not text:
+            return None
+        parts = _SECTION_MARKER_RE.split(text)
+        # parts = [preamble, "1", body1, "2", body2, ...]
+        sections = {}
+        for number, body in zip(parts[1::2], parts[2::2]):
+            # A repeated marker keeps the first non-empty body
+            if body.strip():
+                sections.setdefault(int(number), body.strip())
+        if not all(sections.get(i) for i in range(1, count + 1)):
+            return None
+        return [sections[i] for i in range(1, count + 1)]
 
+    def _combined_research_plan(self, tasks, model_name: str):
+        """
+        Return (results, missing) where results holds cached findings (None where missing),
+        or None when a combined call isn't worthwhile.
+        """
+        if not self.COMBINE_RESEARCH_CALLS or len(tasks) < 2:
+            return None
+        results = [self._read_research_cache(subject, role, focus_area, model_name) for subject, role, focus_area in tasks]
+        missing = [i for i, text in enumerate(results) if text is None]
+        # A lone missing brief gains nothing from combining; the per-task path handles it
+        if len(missing) == 1:
+            return None
+        return results, missing
+
+    def _apply_combined_research(self, tasks, model_name: str, results: list, missing: list, text: str):
+        sections = self._parse_combined_research(text, len(missing))
+        if sections is None:
+            logger.warning("Combined research answer was incomplete, falling back to separate sub-agents")
+            return None
+        for i, section in zip(missing, sections):
+            subject, role, focus_area = tasks[i]
+            self._write_research_cache(subject, role, focus_area, model_name, section)
+            results[i] = section
+        return results
+
+    def _run_combined_research(self, tasks, model_name: str = "gemini-2.5-flash"):
+        """All briefs answered by one grounded call (cache-aware); None means fall back to per-task calls."""
+        plan = self._combined_research_plan(tasks, model_name)
+        if plan is None:
+            return None
+        results, missing = plan
+        if not missing:
+            return results
+
+        prompt, config = self._build_combined_research_request([tasks[i] for i in missing])
         try:
-            logger.info(f"Generating {category} report using {model_name}...")
-            response = self.client.models.generate_content(
+            response = self._generate_content(model_name, prompt, config)
+        except Exception as e:
+            logger.warning(f"Combined research call failed, falling back to separate sub-agents: {e}")
+            return None
+        return self._apply_combined_research(tasks, model_name, results, missing, response.text)
+
+    async def _run_combined_research_async(self, tasks, model_name: str = "gemini-2.5-flash"):
+        """Async twin of _run_combined_research (research cache file I/O runs in a worker thread)."""
+        plan = await asyncio.to_thread(self._combined_research_plan, tasks, model_name)
+        if plan is None:
+            return None
+        results, missing = plan
+        if not missing:
+            return results
+
+        prompt, config = self._build_combined_research_request([tasks[i] for i in missing])
+        try:
+            response = await self._generate_content_async(model_name, prompt, config)
+        except Exception as e:
+            logger.warning(f"Combined research call failed, falling back to separate sub-agents: {e}")
+            return None
+        return await asyncio.to_thread(self._apply_combined_research, tasks, model_name, results, missing, response.text)
+
+    def _run_research_task(self, symbol: str, role: str, focus_area: str, model_name: str = "gemini-2.5-flash") -> str:
+        """
+        Executes a specific research sub-task using Google Search.
+        Using Flash model for speed and efficiency in information gathering.
+        """
+        cached = self._read_research_cache(symbol, role, focus_area, model_name)
+        if cached is not None:
+            return cached
+
+        prompt, config = self._build_research_request(symbol, role, focus_area)
+
+        try:
+            response = self._generate_content(model_name, prompt, config)
+            if not response.text:
+                return f"[No data found by {role}]"
+            self._write_research_cache(symbol, role, focus_area, model_name, response.text)
+            return response.text
+        except Exception as e:
+            logger.warning(f"{role} failed: {e}")
+            return f"[Search Error for {role}: {e}]"
+
+    async def _run_research_task_async(self, symbol: str, role: str, focus_area: str,
+                                       model_name: str = "gemini-2.5-flash", semaphore: asyncio.Semaphore = None) -> str:
+        """
+        Async twin of _run_research_task using the google-genai `.aio` client,
+        so several sub-agents can wait on the network at the same time.
+        Cache file reads/writes run in a worker thread, off the shared event loop.
+        """
+        cached = await asyncio.to_thread(self._read_research_cache, symbol, role, focus_area, model_name)
+        if cached is not None:
+            return cached
+
+        prompt, config = self._build_research_request(symbol, role, focus_area)
+
+        try:
+            async with semaphore or nullcontext():
+                response = await self._generate_content_async(model_name, prompt, config)
+            if not response.text:
+                return f"[No data found by {role}]"
+            await asyncio.to_thread(self._write_research_cache, symbol, role, focus_area, model_name, response.text)
+            return response.text
+        except Exception as e:
+            logger.warning(f"{role} failed: {e}")
+            return f"[Search Error for {role}: {e}]"
+
+    def _generate_content(self, model_name: str, contents, config):
+        return gemini_dispatcher.generate_content(self.client, model_name, contents, config)
+
+    async def _generate_content_async(self, model_name: str, contents, config):
+        return await gemini_dispatcher.generate_content_async(self.client, model_name, contents, config)
+
+    @staticmethod
+    def _semantic_cache_scope(symbol: str, model_name: str, knowledge_context: str) -> str:
+        """
+        Exact-match part of a semantic cache lookup. Only a prefix of the prompt is embedded,
+        and the knowledge context and date come after the research, so they are pinned here.
+        """
+        kb_digest = hashlib.blake2b(knowledge_context.encode("utf-8"), digest_size=16).hexdigest()
+        return f"{symbol}|{model_name}|{_report_date()}|{kb_digest}"
+
+    def _embed_prompt(self, prompt: str):
+        """Unit-length embedding of the prompt prefix, or None if embedding is unavailable."""
+        try:
+            response = self.client.models.embed_content(model=EMBEDDING_MODEL, contents=prompt[:EMBEDDING_MAX_CHARS])
+            return SemanticReportCache.normalize(response.embeddings[0].values)
+        except Exception as e:
+            logger.warning(f"Prompt embedding failed, skipping semantic cache: {e}")
+            return None
+
+    async def _embed_prompt_async(self, prompt: str):
+        try:
+            response = await self.client.aio.models.embed_content(model=EMBEDDING_MODEL, contents=prompt[:EMBEDDING_MAX_CHARS])
+            return SemanticReportCache.normalize(response.embeddings[0].values)
+        except Exception as e:
+            logger.warning(f"Prompt embedding failed, skipping semantic cache: {e}")
+            return None
+
+    def _context_cache_request(self, model_name: str, knowledge_context: str):
+        """
+        Return (key, cached_name, create_config) for an explicit context cache.
+        cached_name is set when a live cache already exists; create_config is set when one should be created.
+        """
+        if gemini_dispatcher.estimate_tokens(knowledge_context) < CONTEXT_CACHE_MIN_TOKENS:
+            return None, None, None
+
+        key = (model_name, hashlib.blake2b(knowledge_context.encode("utf-8"), digest_size=16).hexdigest())
+        with self._context_caches_lock:
+            entry = self._context_caches.get(key)
+        # Leave a margin so a cache doesn't expire in the middle of a long generation
+        if entry and entry[1] - time.time() > EDITOR_TIMEOUT_MS / 1000:
+            return key, entry[0], None
+
+        create_config = types.CreateCachedContentConfig(
+            display_name=f"knowledge-{key[1][:12]}",
+            contents=[types.Content(role="user", parts=[types.Part(
+                text=f"### Internal Knowledge Base (User Uploads)\n{knowledge_context}"
+            )])],
+            ttl=f"{CONTEXT_CACHE_TTL}s",
+        )
+        return key, None, create_config
+
+    def _remember_context_cache(self, key, name: str):
+        with self._context_caches_lock:
+            self._context_caches[key] = (name, time.time() + CONTEXT_CACHE_TTL)
+        logger.info(f"Created context cache {name} for {key[0]}")
+
+    def _get_context_cache(self, model_name: str, knowledge_context: str):
+        """Name of an explicit cache holding knowledge_context, or None to send it inline."""
+        key, name, create_config = self._context_cache_request(model_name, knowledge_context)
+        if create_config is None:
+            return name
+        try:
+            cache = self.client.caches.create(model=model_name, config=create_config)
+        except Exception as e:
+            logger.warning(f"Context cache creation failed, sending context inline: {e}")
+            return None
+        self._remember_context_cache(key, cache.name)
+        return cache.name
+
+    async def _get_context_cache_async(self, model_name: str, knowledge_context: str):
+        key, name, create_config = self._context_cache_request(model_name, knowledge_context)
+        if create_config is None:
+            return name
+        try:
+            cache = await self.client.aio.caches.create(model=model_name, config=create_config)
+        except Exception as e:
+            logger.warning(f"Context cache creation failed, sending context inline: {e}")
+            return None
+        self._remember_context_cache(key, cache.name)
+        return cache.name
+
+    @staticmethod
+    def _research_cache_path(symbol: str, role: str, focus_area: str, model_name: str) -> str:
+        key = hashlib.md5(f"{role}|{focus_area}|{model_name}".encode("utf-8")).hexdigest()
+        # Macro subjects like "Global & China Economy" are not filesystem-friendly
+        subject_dir = re.sub(r"[^\w.-]+", "_", symbol)
+        return os.path.join(RESEARCH_CACHE_DIR, subject_dir, f"{key}.json")
+
+    def _read_research_cache(self, symbol: str, role: str, focus_area: str, model_name: str):
+        """Return cached sub-agent findings younger than RESEARCH_CACHE_TTL, else None."""
+        path = self._research_cache_path(symbol, role, focus_area, model_name)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            logger.info(f"Research cache miss: {symbol} / {role}")
+            return None
+        except Exception as e:
+            logger.warning(f"Research cache read failed ({path}): {e}")
+            return None
+
+        if time.time() - entry.get("ts", 0) >= RESEARCH_CACHE_TTL:
+            logger.info(f"Research cache expired: {symbol} / {role}")
+            return None
+
+        logger.info(f"Research cache hit: {symbol} / {role}")
+        return entry.get("text")
+
+    def _write_research_cache(self, symbol: str, role: str, focus_area: str, model_name: str, text: str):
+        path = self._research_cache_path(symbol, role, focus_area, model_name)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"ts": time.time(), "text": text}, f, ensure_ascii=False)
+            os.replace(temp_path, path)
+        except Exception as e:
+            logger.warning(f"Research cache write failed ({path}): {e}")
+
+    async def _gather_research_async(self, tasks) -> list:
+        """Run (subject, role, focus_area) sub-agents concurrently, results in task order."""
+        combined = await self._run_combined_research_async(tasks)
+        if combined is not None:
+            return combined
+
+        # The sub-agents are independent, so dispatch them together and
+        # only wait as long as the slowest one.
+        semaphore = asyncio.Semaphore(self.MAX_PARALLEL_RESEARCH)
+        return await asyncio.gather(*(
+            self._run_research_task_async(subject, role, focus_area, semaphore=semaphore)
+            for subject, role, focus_area in tasks
+        ))
+
+    def _gather_research_threaded(self, tasks) -> list:
+        """
+        Fallback for SDKs without `.aio`: run the blocking sub-agent calls on a
+        thread pool (the HTTP wait releases the GIL) for the same overlap.
+        """
+        combined = self._run_combined_research(tasks)
+        if combined is not None:
+            return combined
+
+        with ThreadPoolExecutor(max_workers=self.MAX_PARALLEL_RESEARCH) as ex:
+            futures = {
+                ex.submit(self._run_research_task, subject, role, focus_area): i
+                for i, (subject, role, focus_area) in enumerate(tasks)
+            }
+            results = {futures[f]: f.result() for f in as_completed(futures)}
+        # Keep the report sections in their fixed order regardless of completion order
+        return [results[i] for i in range(len(tasks))]
+
+    def _has_async_client(self) -> bool:
+        # Older google-genai releases ship without the `.aio` client
+        return hasattr(self.client, "aio")
+
+    def _stock_research_tasks(self, symbol: str) -> list:
+        return [(symbol, role, focus_area) for role, focus_area in self.STOCK_RESEARCH_TASKS]
+
+    def generate_deep_research_report(self, symbol: str, context_text: str = "", model_name: str = "gemini-2.5-pro",
+                                      status_callback=None) -> str:
+        """
+        Multi-Agent Workflow:
+        1. 3 Sub-Agents gather info (Data, Industry, Corp) in parallel.
+        2. Main Agent synthesizes everything into a report.
+        status_callback: optional callable(text_delta), fed the report as it streams in.
+        Returns: final_report_text
+        """
+        if not self._api_key_present:
+            return "Error: API Key missing."
+
+        if not self._has_async_client():
+            return self._generate_deep_research_report_threaded(symbol, context_text, model_name, status_callback)
+
+        return gemini_dispatcher.run_sync(self.generate_deep_research_report_async(symbol, context_text, model_name, status_callback))
+
+    async def generate_deep_research_report_async(self, symbol: str, context_text: str = "", model_name: str = "gemini-2.5-pro",
+                                                  status_callback=None) -> str:
+        """Async implementation of generate_deep_research_report."""
+        if not self._api_key_present:
+            return "Error: API Key missing."
+
+        logger.info(f"Starting Multi-Agent Research for {symbol}...")
+
+        # --- Phase 1: Distributed Research (Sub-Agents) ---
+        research = await self._gather_research_async(self._stock_research_tasks(symbol))
+
+        # --- Phase 2: Synthesis (Chief Editor) ---
+        knowledge_context = _trim_context(context_text)
+        main_prompt = self._build_stock_report_prompt(symbol, research, knowledge_context, model_name)
+
+        cache_scope = self._semantic_cache_scope(symbol, model_name, knowledge_context)
+        vector = await self._embed_prompt_async(main_prompt)
+        if vector is not None:
+            cached = await asyncio.to_thread(self.semantic_cache.lookup, cache_scope, vector)
+            if cached:
+                return cached
+
+        # Main Agent Config (No search tool needed here, as we provided the search results in context)
+        # Using Pro model for reasoning
+        # Only upload the knowledge context cache once we know the editor call is needed
+        cache_name = await self._get_context_cache_async(model_name, knowledge_context)
+        if cache_name:
+            main_prompt = self._build_stock_report_prompt(symbol, research, KNOWLEDGE_CACHED_NOTE, model_name)
+
+        try:
+            logger.info(f"Chief Editor generating final report using {model_name}...")
+            report = await gemini_dispatcher.generate_content_stream_async(
+                self.client, model_name, main_prompt, _editor_config(cache_name), on_chunk=status_callback
+            )
+            if not report:
+                return "Error: Chief Editor produced no text."
+            if vector is not None:
+                # Rewrites vectors.npy/entries.json; keep it off the shared event loop
+                await asyncio.to_thread(self.semantic_cache.add, cache_scope, vector, report)
+            return report
+
+        except Exception as e:
+            logger.error(f"Chief Editor Failed: {e}")
+            return f"Agent Error: {str(e)}"
+
+    def _generate_deep_research_report_threaded(self, symbol: str, context_text: str, model_name: str,
+                                                status_callback=None) -> str:
+        """Thread-pool variant of generate_deep_research_report for SDKs without `.aio`."""
+        logger.info(f"Starting Multi-Agent Research for {symbol} (thread pool)...")
+
+        # --- Phase 1: Distributed Research (Sub-Agents) ---
+        research = self._gather_research_threaded(self._stock_research_tasks(symbol))
+
+        # --- Phase 2: Synthesis (Chief Editor) ---
+        knowledge_context = _trim_context(context_text)
+        main_prompt = self._build_stock_report_prompt(symbol, research, knowledge_context, model_name)
+
+        cache_scope = self._semantic_cache_scope(symbol, model_name, knowledge_context)
+        vector = self._embed_prompt(main_prompt)
+        if vector is not None:
+            cached = self.semantic_cache.lookup(cache_scope, vector)
+            if cached:
+                return cached
+
+        cache_name = self._get_context_cache(model_name, knowledge_context)
+        if cache_name:
+            main_prompt = self._build_stock_report_prompt(symbol, research, KNOWLEDGE_CACHED_NOTE, model_name)
+
+        try:
+            logger.info(f"Chief Editor generating final report using {model_name}...")
+            report = gemini_dispatcher.generate_content_stream(
+                self.client, model_name, main_prompt, _editor_config(cache_name), on_chunk=status_callback
+            )
+            if not report:
+                return "Error: Chief Editor produced no text."
+            if vector is not None:
+                self.semantic_cache.add(cache_scope, vector, report)
+            return report
+
+        except Exception as e:
+            logger.error(f"Chief Editor Failed: {e}")
+            return f"Agent Error: {str(e)}"
+
+    def generate_deep_research_reports_batch(self, symbols: list, context_text: str = "", model_name: str = "gemini-2.5-pro",
+                                             max_concurrency: int = MAX_PARALLEL_REPORTS) -> list:
+        """
+        Portfolio-wide variant of generate_deep_research_report.
+        Runs up to `max_concurrency` symbol workflows at once.
+        Returns: list of report texts, aligned with `symbols`.
+        """
+        if not self._api_key_present:
+            return ["Error: API Key missing."] * len(symbols)
+
+        if not self._has_async_client():
+            with ThreadPoolExecutor(max_workers=max_concurrency) as ex:
+                return list(ex.map(
+                    lambda s: self._generate_deep_research_report_threaded(s, context_text, model_name),
+                    symbols
+                ))
+
+        return gemini_dispatcher.run_sync(self.generate_deep_research_reports_batch_async(symbols, context_text, model_name, max_concurrency))
+
+    async def generate_deep_research_reports_batch_async(self, symbols: list, context_text: str = "", model_name: str = "gemini-2.5-pro",
+                                                         max_concurrency: int = MAX_PARALLEL_REPORTS) -> list:
+        """Async implementation of generate_deep_research_reports_batch."""
+        sem = asyncio.Semaphore(max_concurrency)
+
+        async def _bounded(sym):
+            async with sem:
+                return await self.generate_deep_research_report_async(sym, context_text, model_name)
+
+        return await asyncio.gather(*[_bounded(s) for s in symbols])
+
+    def submit_batch(self, requests: list, context_text: str = "", model_name: str = "gemini-2.5-pro") -> str:
+        """
+        Queue Chief Editor syntheses on the Gemini Batch API (~50% cheaper, results within 24h).
+        Use for nightly / end-of-day runs where latency doesn't matter.
+        requests: list of {"symbol": "AAPL"} or {"category": "MACRO" | "STRATEGY"} dicts.
+        Sub-agent research still runs live (it needs Google Search); only the editor calls are batched.
+        Returns: batch job name for poll_batch, or "" on failure.
+        """
+        if not self._api_key_present:
+            return ""
+
+        try:
+            prompts = gemini_dispatcher.run_sync(self._build_batch_prompts_async(requests, context_text, model_name))
+
+            # One JSONL line per editor call, keyed by symbol / category
+            with tempfile.NamedTemporaryFile('w', suffix=".jsonl", encoding='utf-8', delete=False) as f:
+                for key, prompt in prompts:
+                    f.write(json.dumps({
+                        "key": key,
+                        "request": {
+                            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                            "generation_config": {
+                                "temperature": GENERATION_TEMPERATURE,
+                                "max_output_tokens": EDITOR_MAX_OUTPUT_TOKENS,
+                            },
+                        },
+                    }, ensure_ascii=False) + "\n")
+                jsonl_path = f.name
+
+            try:
+                uploaded = self.client.files.upload(
+                    file=jsonl_path,
+                    config=types.UploadFileConfig(display_name="analyst-batch", mime_type="jsonl"),
+                )
+            finally:
+                os.remove(jsonl_path)
+
+            job = self.client.batches.create(
                 model=model_name,
-                contents=prompt
+                src=uploaded.name,
+                config={"display_name": f"analyst-batch-{int(time.time())}"},
+            )
+            logger.info(f"Submitted batch {job.name} with {len(prompts)} reports")
+            return job.name
+
+        except Exception as e:
+            logger.error(f"Batch submission failed: {e}")
+            return ""
+
+    async def _build_batch_prompts_async(self, requests: list, context_text: str, model_name: str) -> list:
+        """Run the live research phase for every request and return [(key, editor_prompt)]."""
+        knowledge_context = _trim_context(context_text)
+        sem = asyncio.Semaphore(self.MAX_PARALLEL_REPORTS)
+
+        async def _prompt_for(req):
+            async with sem:
+                if req.get("symbol"):
+                    symbol = req["symbol"]
+                    research = await self._gather_research_async(self._stock_research_tasks(symbol))
+                    return symbol, self._build_stock_report_prompt(symbol, research, knowledge_context, model_name)
+                profile = self._macro_strategy_profile(req.get("category"))
+                research = await self._gather_research_async(profile["tasks"])
+                return req.get("category"), self._build_macro_strategy_prompt(profile, research, knowledge_context, model_name)
+
+        return await asyncio.gather(*[_prompt_for(r) for r in requests])
+
+    def poll_batch(self, batch_name: str):
+        """
+        Check a job from submit_batch.
+        Returns: (state, reports) where reports maps symbol / category -> report text
+        (an "Agent Error: ..." string for failed entries). reports is empty until the job succeeds.
+        """
+        try:
+            job = self.client.batches.get(name=batch_name)
+        except Exception as e:
+            logger.error(f"Batch poll failed for {batch_name}: {e}")
+            return "UNKNOWN", {}
+
+        state = job.state.name if hasattr(job.state, "name") else str(job.state)
+        if state != "JOB_STATE_SUCCEEDED":
+            if state in BATCH_TERMINAL_STATES:
+                logger.error(f"Batch {batch_name} ended with {state}: {getattr(job, 'error', None)}")
+            return state, {}
+
+        reports = {}
+        try:
+            content = self.client.files.download(file=job.dest.file_name)
+            for line in content.decode('utf-8').splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                key = entry.get("key")
+                if "response" in entry:
+                    parts = entry["response"]["candidates"][0]["content"]["parts"]
+                    text = "".join(p.get("text", "") for p in parts)
+                    reports[key] = text if text else "Error: Chief Editor produced no text."
+                else:
+                    reports[key] = f"Agent Error: {entry.get('error')}"
+        except Exception as e:
+            logger.error(f"Batch result download failed for {batch_name}: {e}")
+            return state, reports
+
+        return state, reports
+
+    @staticmethod
+    def _build_stock_report_prompt(symbol: str, research: list, knowledge_context: str, model_name: str) -> str:
+        """Assemble the Chief Editor prompt from the three sub-agent findings."""
+        data_research, industry_research, corp_research = research
+
+        # Combine Raw Search Data
+        raw_search_content = f"""
+=== RESEARCH AGENT 1: FINANCIAL DATA ===
+{data_research}
+
+=== RESEARCH AGENT 2: INDUSTRY ANALYSIS ===
+{industry_research}
+
+=== RESEARCH AGENT 3: CORPORATE INTELLIGENCE ===
+{corp_research}
+"""
+
+        scaffold = _stock_report_scaffold(symbol, model_name, _report_date())
+        return scaffold.substitute(
+            raw_search_content=raw_search_content,
+            knowledge_context=knowledge_context,
+        )
+
+    def generate_macro_strategy_report(self, category: str, context_text: str = "", model_name: str = "gemini-2.5-pro",
+                                       status_callback=None) -> str:
+        """
+        Generates a specialized report for Macro or Strategy analysis using a Multi-Agent Workflow.
+        Phase 1: 3 Sub-Agents gather fresh internet data.
+        Phase 2: Chief Editor synthesizes Search Data + Knowledge Base into a strategic report.
+        status_callback: optional callable(text_delta), fed the report as it streams in.
+        """
+        if not self._api_key_present:
+            return "Error: API Key missing."
+
+        if not self._has_async_client():
+            return self._generate_macro_strategy_report_threaded(category, context_text, model_name, status_callback)
+
+        return gemini_dispatcher.run_sync(self.generate_macro_strategy_report_async(category, context_text, model_name, status_callback))
+
+    async def generate_macro_strategy_report_async(self, category: str, context_text: str = "", model_name: str = "gemini-2.5-pro",
+                                                   status_callback=None) -> str:
+        """Async implementation of generate_macro_strategy_report."""
+        if not self._api_key_present:
+            return "Error: API Key missing."
+
+        logger.info(f"Starting Multi-Agent Research for {category}...")
+        profile = self._macro_strategy_profile(category)
+
+        # --- Phase 1: Distributed Research (Sub-Agents) ---
+        research = await self._gather_research_async(profile["tasks"])
+
+        # --- Phase 2: Synthesis (Chief Editor) ---
+        knowledge_context = _trim_context(context_text)
+        cache_name = await self._get_context_cache_async(model_name, knowledge_context)
+        prompt = self._build_macro_strategy_prompt(
+            profile, research, KNOWLEDGE_CACHED_NOTE if cache_name else knowledge_context, model_name
+        )
+
+        try:
+            logger.info(f"Generating {category} report using {model_name}...")
+            report = await gemini_dispatcher.generate_content_stream_async(
+                self.client, model_name, prompt, _editor_config(cache_name), on_chunk=status_callback
+            )
+            return report if report else f"Error: {profile['role_title']} produced no text."
+
+        except Exception as e:
+            logger.error(f"{category} Report Failed: {e}")
+            return f"Agent Error: {str(e)}"
+
+    def _generate_macro_strategy_report_threaded(self, category: str, context_text: str, model_name: str,
+                                                 status_callback=None) -> str:
+        """Thread-pool variant of generate_macro_strategy_report for SDKs without `.aio`."""
+        logger.info(f"Starting Multi-Agent Research for {category} (thread pool)...")
+        profile = self._macro_strategy_profile(category)
+
+        # --- Phase 1: Distributed Research (Sub-Agents) ---
+        research = self._gather_research_threaded(profile["tasks"])
+
+        # --- Phase 2: Synthesis (Chief Editor) ---
+        knowledge_context = _trim_context(context_text)
+        cache_name = self._get_context_cache(model_name, knowledge_context)
+        prompt = self._build_macro_strategy_prompt(
+            profile, research, KNOWLEDGE_CACHED_NOTE if cache_name else knowledge_context, model_name
+        )
+
+        try:
+            logger.info(f"Generating {category} report using {model_name}...")
+            report = gemini_dispatcher.generate_content_stream(
+                self.client, model_name, prompt, _editor_config(cache_name), on_chunk=status_callback
             )
-            return response.text if response.text else f"Error: {role_title} produced no text."
+            return report if report else f"Error: {profile['role_title']} produced no text."
 
         except Exception as e:
             logger.error(f"{category} Report Failed: {e}")
             return f"Agent Error: {str(e)}"
+
+    @classmethod
+    def _macro_strategy_profile(cls, category: str) -> dict:
+        # Anything that is not MACRO is treated as STRATEGY
+        return cls.MACRO_STRATEGY_PROFILES["MACRO" if category == "MACRO" else "STRATEGY"]
+
+    @staticmethod
+    def _build_macro_strategy_prompt(profile: dict, research: list, knowledge_context: str, model_name: str) -> str:
+        """Assemble the Chief Editor prompt for a macro/strategy report."""
+        search_1, search_2, search_3 = research
+
+        # Combine Raw Search Data
+        raw_search_content = f"""
+=== RESEARCH AGENT 1: POLICY / SENTIMENT ===
+{search_1}
+
+=== RESEARCH AGENT 2: DATA / SECTORS ===
+{search_2}
+
+=== RESEARCH AGENT 3: RISKS / ALLOCATION ===
+{search_3}
+"""
+
+        scaffold = _macro_strategy_scaffold(
+            profile["role_title"], profile["report_title"], profile["core_task"],
+            model_name, _report_date()
+        )
+        return scaffold.substitute(
+            raw_search_content=raw_search_content,
+            knowledge_context=knowledge_context,
+        )
+
+
+@lru_cache(maxsize=1)
+def get_analyst_agent() -> AnalystAgent:
+    """Process-wide AnalystAgent: one client, research cache and semantic cache for every caller."""
+    return AnalystAgent()
@@ -0,0 +1,75 @@
+"""
+Report Cache Module
+Small key/value store for generated reports: Redis when REDIS_URL is set,
+otherwise gzip files under knowledge_base/.cache.
+"""
+
+import os
+import gzip
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join("knowledge_base", ".cache")
+REDIS_URL = os.environ.get("REDIS_URL")
+
+_redis = None
+if REDIS_URL:
+    try:
+        import redis
+        _redis = redis.Redis.from_url(REDIS_URL)
+        logger.info("Report cache: using Redis")
+    except Exception as e:
+        # redis-py is optional; fall back to local files
+        logger.warning(f"Report cache: Redis unavailable ({e}), using local files")
+        _redis = None
+
+
+def _file_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, f"{key}.md.gz")
+
+
+def get(key: str):
+    """Return the cached text for key, or None if missing or expired."""
+    if _redis is not None:
+        try:
+            data = _redis.get(key)
+            return gzip.decompress(data).decode('utf-8') if data else None
+        except Exception as e:
+            logger.warning(f"Report cache get failed: {e}")
+            return None
+
+    try:
+        with gzip.open(_file_path(key), 'rt', encoding='utf-8') as f:
+            # First line holds the expiry timestamp
+            expires_at = float(f.readline())
+            if expires_at < time.time():
+                return None
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Report cache read failed for {key}: {e}")
+        return None
+
+
+def set(key: str, value: str, ttl: int):
+    """Store value under key for ttl seconds."""
+    if _redis is not None:
+        try:
+            _redis.set(key, gzip.compress(value.encode('utf-8')), ex=ttl)
+        except Exception as e:
+            logger.warning(f"Report cache set failed: {e}")
+        return
+
+    path = _file_path(key)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+            f.write(f"{time.time() + ttl}\n")
+            f.write(value)
+        os.replace(temp_path, path)
+    except Exception as e:
+        logger.warning(f"Report cache write failed for {key}: {e}")
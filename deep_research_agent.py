@@ -3,55 +3,75 @@ Gemini Deep Research Agent Module
 使用 Google 官方 Deep Research API 生成超级深度报告
 """
 
+import re
+import hashlib
+import hmac
+import threading
 import time
+import random
 import os
+import asyncio
 import logging
+from datetime import datetime
 from typing import Dict, Optional, Tuple
-from google import genai
+import cache as report_cache
+from gemini_dispatcher import dispatcher, estimate_tokens, get_client, run_sync, submit
+from report_generator import create_markdown_pdf_async
+from task_manager import get_task_manager
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Opt-in completion webhooks: with both set, Google calls
+# {DEEP_RESEARCH_WEBHOOK_BASE}/api/agent/deep_research_webhook/<task_id>?token=... when a task finishes,
+# instead of the task being polled. The token is an HMAC of the task ID, so checking it needs no stored state.
+WEBHOOK_BASE_URL = os.environ.get("DEEP_RESEARCH_WEBHOOK_BASE")
+WEBHOOK_SECRET = os.environ.get("DEEP_RESEARCH_WEBHOOK_SECRET")
 
-class DeepResearchAgent:
-    """Official Google Deep Research API Integration"""
+# task_id -> what is needed to finish a task once its webhook arrives. The non-secret part is also
+# stored on the TaskManager task, so a callback after a restart can still be resolved (see _restore_webhook_task).
+_webhook_tasks = {}
+# Tasks whose interaction is being fetched right now, so overlapping callbacks don't finish a task twice
+_webhook_busy = set()
+_webhook_lock = threading.Lock()
+# Future of the safety-net sweep (DeepResearchAgent._awebhook_sweep_loop) on the shared event loop
+_webhook_sweeper = None
 
-    # Research mode constants
-    MODE_MACRO = "MACRO"
-    MODE_STRATEGY = "STRATEGY"
-    MODE_STOCK = "STOCK"
 
-    # Polling configuration
-    MAX_RETRIES = 120  # 20 minutes max (120 * 10 seconds)
-    SLEEP_INTERVAL = 10  # Poll every 10 seconds
+def _webhook_token(task_id: str) -> str:
+    return hmac.new(WEBHOOK_SECRET.encode('utf-8'), task_id.encode('utf-8'), hashlib.sha256).hexdigest()
 
-    def __init__(self, api_key: str):
-        """
-        Initialize Deep Research Agent with user-provided API key
 
-        Args:
-            api_key: User's Gemini API key
-        """
-        # Do not set os.environ["GOOGLE_API_KEY"] globally to avoid conflicts
-        # Initialize client directly with the key
-        self.api_key = api_key
-        self.client = genai.Client(api_key=api_key)
-        logger.info("Deep Research Agent initialized")
+def webhook_url_for(task_id: str) -> Optional[str]:
+    """Callback URL for a task, or None when webhooks aren't configured (tasks are polled)."""
+    if not (WEBHOOK_BASE_URL and WEBHOOK_SECRET):
+        return None
+    return f"{WEBHOOK_BASE_URL.rstrip('/')}/api/agent/deep_research_webhook/{task_id}?token={_webhook_token(task_id)}"
 
-    @staticmethod
-    def get_persona_prompt(mode: str, symbol: str = None) -> str:
-        """
-        Get ultra-detailed persona prompt for each research mode
 
-        Args:
-            mode: Research mode (MACRO/STRATEGY/STOCK)
-            symbol: Stock symbol (required for STOCK mode)
+def verify_webhook_token(task_id: str, token: str) -> bool:
+    return bool(WEBHOOK_SECRET and token) and hmac.compare_digest(token, _webhook_token(task_id))
 
-        Returns:
-            Formatted persona prompt
-        """
-        if mode == DeepResearchAgent.MODE_MACRO:
-            return """
+
+def ensure_webhook_sweeper():
+    """
+    Start the periodic sweep of webhook tasks (once per process), which finishes tasks whose callback
+    never arrived and fails those waiting too long. A no-op when webhooks aren't configured.
+    """
+    global _webhook_sweeper
+    if not (WEBHOOK_BASE_URL and WEBHOOK_SECRET):
+        return
+    with _webhook_lock:
+        if _webhook_sweeper is None or _webhook_sweeper.done():
+            _webhook_sweeper = submit(DeepResearchAgent._awebhook_sweep_loop())
+
+
+# Compiled once for _clean_markdown; reports can run to hundreds of KB
+_LINE_ENDING_RE = re.compile(r'\r\n?')
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+
+# Persona prompts per research mode, built once at import
+_MACRO_PROMPT = """
 你是一位顶级宏观经济分析师（Chief Macro Strategist），拥有20年全球宏观研究经验，曾在高盛、桥水基金担任首席宏观策略师。
 
 【你的专业领域】
@@ -66,8 +86,7 @@ class DeepResearchAgent:
 请确保你的分析具有前瞻性、数据驱动，并符合顶级投行研报的专业水准。
 """
 
-        elif mode == DeepResearchAgent.MODE_STRATEGY:
-            return """
+_STRATEGY_PROMPT = """
 你是一位量化投资策略专家（Quantitative Strategy Director），拥有MIT金融工程博士学位，曾在Two Sigma、DE Shaw担任多因子策略负责人。
 
 【你的专业领域】
@@ -82,11 +101,7 @@ class DeepResearchAgent:
 请确保你的分析逻辑严密、学术基础扎实，并尽可能提供可落地的实施细节。
 """
 
-        elif mode == DeepResearchAgent.MODE_STOCK:
-            if not symbol:
-                raise ValueError("Stock mode requires symbol parameter")
-
-            return f"""
+_STOCK_TEMPLATE = """
 你是一位顶级股票分析师（Senior Equity Analyst），拥有CFA、CPA双证，曾在摩根士丹利担任{symbol}所属行业的首席分析师，连续5年获得《机构投资者》最佳分析师称号。
 
 【你的专业领域】
@@ -100,8 +115,179 @@ class DeepResearchAgent:
 请根据用户的具体关注点进行针对性研究。如果用户没有具体指令，请进行标准的深度个股覆盖，包括但不限于：商业模式、行业竞争格局、财务健康度、增长驱动力、潜在风险及估值分析。
 请确保你的观点客观中立，所有论据都有详实的数据或事实支撑。
 """
-        else:
+
+class DeepResearchAgent:
+    """Official Google Deep Research API Integration"""
+
+    # Research mode constants
+    MODE_MACRO = "MACRO"
+    MODE_STRATEGY = "STRATEGY"
+    MODE_STOCK = "STOCK"
+
+    # Polling configuration
+    POLL_TIMEOUT = 20 * 60  # 20 minutes max
+    POLL_INITIAL_DELAY = 2.0  # First re-poll after 2 seconds
+    POLL_BACKOFF = 1.618  # Grow the delay between polls by the golden ratio (2s, 3s, 5s, 8s, 13s, ...)...
+    POLL_MAX_DELAY = 30.0  # ...up to 30 seconds
+    POLL_JITTER = 0.1  # Plus up to 10% random jitter, so tasks started together don't poll in lockstep
+
+    # Webhook tasks: re-fetched every WEBHOOK_SWEEP_INTERVAL seconds in case the callback was lost,
+    # and failed once they've waited WEBHOOK_MAX_AGE seconds
+    WEBHOOK_SWEEP_INTERVAL = 10 * 60
+    WEBHOOK_MAX_AGE = 3 * POLL_TIMEOUT
+
+    # Deep Research agent used for every interaction
+    AGENT_NAME = "deep-research-pro-preview-12-2025"
+
+    # Completed reports are reused for identical requests for 30 days
+    REPORT_CACHE_TTL = 30 * 86400
+
+    # Interaction fields worth logging at DEBUG level while a task runs
+    DEBUG_FIELDS = ("progress", "stage", "steps", "metadata")
+
+    def __init__(self, api_key: str):
+        """
+        Initialize Deep Research Agent with user-provided API key
+
+        Args:
+            api_key: User's Gemini API key
+        """
+        # Do not set os.environ["GOOGLE_API_KEY"] globally to avoid conflicts
+        # Reuse the process-wide client for this key (shared connection pool)
+        self.api_key = api_key
+        self.client = get_client(api_key)
+        logger.info("Deep Research Agent initialized")
+
+    @staticmethod
+    def get_persona_prompt(mode: str, symbol: str = None) -> str:
+        """
+        Get ultra-detailed persona prompt for each research mode
+
+        Args:
+            mode: Research mode (MACRO/STRATEGY/STOCK)
+            symbol: Stock symbol (required for STOCK mode)
+
+        Returns:
+            Formatted persona prompt
+        """
+        if mode == DeepResearchAgent.MODE_STOCK and not symbol:
+            raise ValueError("Stock mode requires symbol parameter")
+
+        try:
+            build = _PERSONA_PROMPTS[mode]
+        except KeyError:
             raise ValueError(f"Unknown mode: {mode}")
+        return build(symbol)
+
+    def _build_final_prompt(self, mode: str, custom_prompt: str, symbol: str = None) -> str:
+        """Combine the persona prompt with the user's custom research request."""
+        persona_prompt = self.get_persona_prompt(mode, symbol)
+
+        return f"""{persona_prompt}
+
+【用户研究需求】
+{custom_prompt}
+
+【通用输出要求】
+1. 请使用专业的Markdown格式进行排版，确保文档结构清晰、易读。
+2. 研究报告应内容详实、数据丰富，充分展现Deep Research的深度搜索与分析能力。
+3. 请引用可靠的信息来源，并在报告末尾附上参考文献。
+
+现在请开始深度研究并输出完整报告。
+"""
+
+    @staticmethod
+    def _create_kwargs(final_prompt: str, webhook_url: str = None) -> dict:
+        kwargs = {
+            "agent": DeepResearchAgent.AGENT_NAME,
+            "input": final_prompt,
+            "background": True
+        }
+        if webhook_url:
+            # Overrides any webhooks registered on the project for this one interaction
+            kwargs["webhook_config"] = {"uris": [webhook_url]}
+        return kwargs
+
+    @classmethod
+    def _report_cache_key(cls, mode: str, symbol: str, final_prompt: str) -> str:
+        # final_prompt already contains the persona and the user's request
+        return hashlib.sha256(f"{cls.AGENT_NAME}|{mode}|{symbol}|{final_prompt}".encode('utf-8')).hexdigest()
+
+    async def afetch_report(self, interaction_id: str):
+        """
+        Fetch an interaction once, after its completion webhook fired.
+
+        Returns:
+            Same tuple as agenerate_report, or None if it is still running
+        """
+        current_interaction = await self._interactions_get(interaction_id)
+        return self._handle_poll_result(current_interaction, 1, 0)
+
+    def _poll_wait(self, delay: float) -> float:
+        """Backoff delay plus jitter for the next poll."""
+        return delay + random.uniform(0, delay * self.POLL_JITTER)
+
+    def _handle_poll_result(self, current_interaction, attempt: int, elapsed_time: int, status_callback=None):
+        """
+        Report progress for one poll and interpret its status.
+        Shared by generate_report and agenerate_report.
+
+        Returns:
+            None while the task is still running, otherwise the final
+            (success, markdown_report, error_msg) tuple
+        """
+        status = current_interaction.status
+        elapsed_minutes = elapsed_time // 60
+
+        if status_callback:
+            status_callback(
+                f"研究进行中... ({elapsed_minutes}分{elapsed_time % 60}秒) - 状态: {status}"
+            )
+
+        # Only probe a few known progress fields, and only when DEBUG logging is on
+        debug_info = {}
+        if logger.isEnabledFor(logging.DEBUG):
+            for attr in self.DEBUG_FIELDS:
+                val = getattr(current_interaction, attr, None)
+                if val: debug_info[attr] = str(val)[:200] # Truncate long values
+
+        logger.info(
+            f"[poll {attempt}] "
+            f"Elapsed: {elapsed_time}s | Status: {status}"
+            + (f" | Debug: {debug_info}" if debug_info else "")
+        )
+
+        if status == "completed":
+            if current_interaction.outputs:
+                raw_report = current_interaction.outputs[-1].text
+
+                # Apply Markdown cleaning (same as report_generator.py logic)
+                cleaned_report = self._clean_markdown(raw_report)
+
+                logger.info(f"Research completed successfully. Report length: {len(cleaned_report)} chars")
+
+                if status_callback:
+                    status_callback("✓ 研究完成！正在处理报告...")
+
+                return True, cleaned_report, None
+            else:
+                error_msg = "任务完成但未返回输出内容"
+                logger.error(error_msg)
+                return False, "", error_msg
+
+        elif status == "failed":
+            error_msg = getattr(current_interaction, 'error', '未知错误')
+            # Try to get more error details
+            full_error_details = str(current_interaction)
+            logger.error(f"Research task failed: {error_msg} | Details: {full_error_details}")
+            return False, "", f"任务失败: {error_msg}"
+
+        elif status == "cancelled":
+            error_msg = "任务被取消"
+            logger.warning(error_msg)
+            return False, "", error_msg
+
+        return None
 
     def generate_report(
         self,
@@ -123,120 +309,149 @@ class DeepResearchAgent:
             Tuple of (success: bool, markdown_report: str, error_msg: Optional[str])
         """
         try:
-            # Get persona prompt
-            persona_prompt = self.get_persona_prompt(mode, symbol)
-
-            # Combine persona with user's custom prompt
-            final_prompt = f"""{persona_prompt}
-
-【用户研究需求】
-{custom_prompt}
-
-【通用输出要求】
-1. 请使用专业的Markdown格式进行排版，确保文档结构清晰、易读。
-2. 研究报告应内容详实、数据丰富，充分展现Deep Research的深度搜索与分析能力。
-3. 请引用可靠的信息来源，并在报告末尾附上参考文献。
+            final_prompt = self._build_final_prompt(mode, custom_prompt, symbol)
 
-现在请开始深度研究并输出完整报告。
-"""
+            # Identical requests are answered from the report cache without a new interaction
+            cache_key = self._report_cache_key(mode, symbol, final_prompt)
+            cached = report_cache.get(cache_key)
+            if cached:
+                logger.info(f"Deep Research cache hit ({cache_key[:12]})")
+                if status_callback:
+                    status_callback("✓ 命中缓存，直接返回已有报告")
+                return True, cached, None
 
             if status_callback:
-                status_callback(f"正在提交 Deep Research 任务到 Google...")
+                status_callback("正在提交 Deep Research 任务到 Google...")
 
-            # Create interaction using official API
-            interaction = self.client.interactions.create(
-                agent="deep-research-pro-preview-12-2025",
-                input=final_prompt,
-                background=True
-            )
+            # Create interaction using official API (counted against the shared Gemini quota)
+            dispatcher.acquire(estimate_tokens(final_prompt))
+            interaction = self.client.interactions.create(**self._create_kwargs(final_prompt))
 
             logger.info(f"Deep Research task submitted. Interaction ID: {interaction.id}")
 
             if status_callback:
                 status_callback(f"任务已提交 (ID: {interaction.id[:8]}...)，开始轮询...")
 
-            # Poll for completion
-            for attempt in range(1, self.MAX_RETRIES + 1):
+            # Poll for completion with exponential backoff: short jobs are picked up
+            # quickly, long jobs don't hammer the API every few seconds.
+            # The first get runs right after create (sleep is at the end of the loop),
+            # so a job that is already done returns without any wait
+            t0 = time.monotonic()
+            deadline = t0 + self.POLL_TIMEOUT
+            delay = self.POLL_INITIAL_DELAY
+            attempt = 0
+            while time.monotonic() < deadline:
+                attempt += 1
                 try:
                     current_interaction = self.client.interactions.get(interaction.id)
-                    status = current_interaction.status
+                    result = self._handle_poll_result(
+                        current_interaction, attempt, int(time.monotonic() - t0), status_callback
+                    )
+                    if result is not None:
+                        if result[0]:
+                            report_cache.set(cache_key, result[1], ttl=self.REPORT_CACHE_TTL)
+                        return result
 
-                    elapsed_time = attempt * self.SLEEP_INTERVAL
-                    elapsed_minutes = elapsed_time // 60
+                except Exception as poll_error:
+                    logger.error(f"Polling error at attempt {attempt}: {poll_error}", exc_info=True)
+                    if time.monotonic() + delay >= deadline:
+                        return False, "", f"轮询过程中发生错误: {str(poll_error)}"
 
-                    if status_callback:
-                        status_callback(
-                            f"研究进行中... ({elapsed_minutes}分{elapsed_time % 60}秒) - 状态: {status}"
-                        )
-
-                    # --- ENHANCED LOGGING START ---
-                    # Inspect internal attributes to see what the agent is doing
-                    debug_info = {}
-                    try:
-                        # Try to extract potential debug fields if they exist in the SDK response
-                        # Note: The actual field names depend on the specific API version/model structure
-                        # We log everything valid to find the clue.
-                        for attr in dir(current_interaction):
-                            if not attr.startswith('_') and not callable(getattr(current_interaction, attr)):
-                                val = getattr(current_interaction, attr)
-                                if val: debug_info[attr] = str(val)[:200] # Truncate long values
-                    except:
-                        pass
-                    
-                    logger.info(
-                        f"[{attempt}/{self.MAX_RETRIES}] "
-                        f"Elapsed: {elapsed_time}s | Status: {status} | Debug: {debug_info}"
-                    )
-                    # --- ENHANCED LOGGING END ---
+                # Wait before next poll, never sleeping past the deadline
+                time.sleep(max(0, min(self._poll_wait(delay), deadline - time.monotonic())))
+                delay = min(delay * self.POLL_BACKOFF, self.POLL_MAX_DELAY)
 
-                    if status == "completed":
-                        if current_interaction.outputs:
-                            raw_report = current_interaction.outputs[-1].text
+            # Timeout Handling - Enhanced
+            timeout_msg = f"任务超时（{self.POLL_TIMEOUT // 60}分钟）"
+            logger.error(timeout_msg)
+            
+            # Try to print the final state before giving up
+            try:
+                final_state = self.client.interactions.get(interaction.id)
+                logger.error(f"Final Interaction State on Timeout: {final_state}")
+            except:
+                logger.error("Could not fetch final state on timeout.")
 
-                            # Apply Markdown cleaning (same as report_generator.py logic)
-                            cleaned_report = self._clean_markdown(raw_report)
+            return False, "", timeout_msg
 
-                            logger.info(f"Research completed successfully. Report length: {len(cleaned_report)} chars")
+        except Exception as e:
+            error_msg = f"Deep Research 失败: {str(e)}"
+            logger.error(error_msg, exc_info=True)
+            return False, "", error_msg
+
+    async def agenerate_report(
+        self,
+        mode: str,
+        custom_prompt: str,
+        symbol: str = None,
+        status_callback=None,
+        webhook_url: str = None
+    ) -> Tuple[bool, str, Optional[str]]:
+        """
+        Async twin of generate_report using the `.aio` client.
+        Waiting between polls yields to the event loop, so many pending
+        interactions can share a single thread.
 
-                            if status_callback:
-                                status_callback("✓ 研究完成！正在处理报告...")
+        With webhook_url the interaction is submitted without polling and its ID is
+        returned in place of the report; arun_task then waits for the callback.
+        """
+        try:
+            final_prompt = self._build_final_prompt(mode, custom_prompt, symbol)
+
+            cache_key = self._report_cache_key(mode, symbol, final_prompt)
+            if not webhook_url:
+                # gzip file or Redis I/O; keep it off the shared event loop
+                cached = await asyncio.to_thread(report_cache.get, cache_key)
+                if cached:
+                    logger.info(f"Deep Research cache hit ({cache_key[:12]})")
+                    if status_callback:
+                        status_callback("✓ 命中缓存，直接返回已有报告")
+                    return True, cached, None
 
-                            return True, cleaned_report, None
-                        else:
-                            error_msg = "任务完成但未返回输出内容"
-                            logger.error(error_msg)
-                            return False, "", error_msg
+            if status_callback:
+                status_callback("正在提交 Deep Research 任务到 Google...")
 
-                    elif status == "failed":
-                        error_msg = getattr(current_interaction, 'error', '未知错误')
-                        # Try to get more error details
-                        full_error_details = str(current_interaction)
-                        logger.error(f"Research task failed: {error_msg} | Details: {full_error_details}")
-                        return False, "", f"任务失败: {error_msg}"
+            await dispatcher.acquire_async(estimate_tokens(final_prompt))
+            interaction = await self._interactions_create(**self._create_kwargs(final_prompt, webhook_url))
 
-                    elif status == "cancelled":
-                        error_msg = "任务被取消"
-                        logger.warning(error_msg)
-                        return False, "", error_msg
+            logger.info(f"Deep Research task submitted. Interaction ID: {interaction.id}")
 
-                    # Wait before next poll
-                    if attempt < self.MAX_RETRIES:
-                        time.sleep(self.SLEEP_INTERVAL)
+            if webhook_url:
+                return True, interaction.id, None
+
+            if status_callback:
+                status_callback(f"任务已提交 (ID: {interaction.id[:8]}...)，开始轮询...")
+
+            # Same backoff poll as generate_report; first get is immediate
+            t0 = time.monotonic()
+            deadline = t0 + self.POLL_TIMEOUT
+            delay = self.POLL_INITIAL_DELAY
+            attempt = 0
+            while time.monotonic() < deadline:
+                attempt += 1
+                try:
+                    current_interaction = await self._interactions_get(interaction.id)
+                    result = self._handle_poll_result(
+                        current_interaction, attempt, int(time.monotonic() - t0), status_callback
+                    )
+                    if result is not None:
+                        if result[0]:
+                            await asyncio.to_thread(report_cache.set, cache_key, result[1], ttl=self.REPORT_CACHE_TTL)
+                        return result
 
                 except Exception as poll_error:
                     logger.error(f"Polling error at attempt {attempt}: {poll_error}", exc_info=True)
-                    if attempt < self.MAX_RETRIES:
-                        time.sleep(self.SLEEP_INTERVAL)
-                    else:
+                    if time.monotonic() + delay >= deadline:
                         return False, "", f"轮询过程中发生错误: {str(poll_error)}"
 
-            # Timeout Handling - Enhanced
-            timeout_msg = f"任务超时（{self.MAX_RETRIES * self.SLEEP_INTERVAL // 60}分钟）"
+                await asyncio.sleep(max(0, min(self._poll_wait(delay), deadline - time.monotonic())))
+                delay = min(delay * self.POLL_BACKOFF, self.POLL_MAX_DELAY)
+
+            timeout_msg = f"任务超时（{self.POLL_TIMEOUT // 60}分钟）"
             logger.error(timeout_msg)
-            
-            # Try to print the final state before giving up
+
             try:
-                final_state = self.client.interactions.get(interaction.id)
+                final_state = await self._interactions_get(interaction.id)
                 logger.error(f"Final Interaction State on Timeout: {final_state}")
             except:
                 logger.error("Could not fetch final state on timeout.")
@@ -248,15 +463,41 @@ class DeepResearchAgent:
             logger.error(error_msg, exc_info=True)
             return False, "", error_msg
 
+    def _has_async_interactions(self) -> bool:
+        # The `.aio` interactions client only exists in recent google-genai releases
+        return hasattr(getattr(self.client, "aio", None), "interactions")
+
+    async def _interactions_create(self, **kwargs):
+        if self._has_async_interactions():
+            return await self.client.aio.interactions.create(**kwargs)
+        # Older SDKs only have the blocking client; keep it off the event loop
+        return await asyncio.to_thread(self.client.interactions.create, **kwargs)
+
+    async def _interactions_get(self, interaction_id: str):
+        if self._has_async_interactions():
+            return await self.client.aio.interactions.get(interaction_id)
+        return await asyncio.to_thread(self.client.interactions.get, interaction_id)
+
+    def submit_task(self, task_id, mode, custom_prompt, symbol, knowledge_service, user_id, webhook_url=None):
+        """
+        Queue a background research task on the shared Gemini event loop and return immediately.
+        Every in-flight task polls on that one loop thread instead of parking a thread of its own;
+        with webhook_url (see webhook_url_for) it isn't polled at all.
+        """
+        return submit(self.arun_task(task_id, mode, custom_prompt, symbol, knowledge_service, user_id, webhook_url))
+
     def run_async_task(self, task_id, mode, custom_prompt, symbol, knowledge_service, user_id):
         """
-        Background worker function for async execution
+        Background worker function for async execution (blocks until the task finishes)
         """
-        from task_manager import TaskManager
-        from report_generator import create_markdown_pdf
-        from datetime import datetime
-        
-        tm = TaskManager()
+        run_sync(self.arun_task(task_id, mode, custom_prompt, symbol, knowledge_service, user_id))
+
+    async def arun_task(self, task_id, mode, custom_prompt, symbol, knowledge_service, user_id, webhook_url=None):
+        """
+        Research, render and save one task, recording progress in the TaskManager.
+        With webhook_url the task is only submitted here; acomplete_webhook_task finishes it.
+        """
+        tm = get_task_manager()
         
         try:
             tm.update_task(task_id, status="processing", progress="正在初始化 Agent...")
@@ -264,46 +505,194 @@ class DeepResearchAgent:
             def progress_callback(msg):
                 tm.update_task(task_id, progress=msg)
                 
-            success, report_text, error = self.generate_report(
-                mode=mode, 
-                custom_prompt=custom_prompt, 
+            success, report_text, error = await self.agenerate_report(
+                mode=mode,
+                custom_prompt=custom_prompt,
                 symbol=symbol,
-                status_callback=progress_callback
+                status_callback=progress_callback,
+                webhook_url=webhook_url
             )
-            
-            if success:
-                tm.update_task(task_id, progress="研究完成，正在生成 PDF...")
-                
-                # Generate PDF
-                pdf_bytes = create_markdown_pdf(symbol, report_text)
-                filename = f"UltraDeepReport_{symbol}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-                
-                # Save using existing service (Saves to Disk + Supabase Metadata)
-                # Fix: If symbol is None (e.g. MACRO/STRATEGY mode), use mode as symbol
-                save_symbol = symbol if symbol else mode
-                
-                save_result = knowledge_service.save_document(
-                    save_symbol,
-                    pdf_bytes,
-                    filename,
-                    doc_type='ultra_deep_report',
-                    user_id=user_id
-                )
-                
-                result_data = {
-                    "report_text_preview": report_text[:500] + "...",
-                    "report_length": len(report_text),
-                    "file_record": save_result
+
+            if success and webhook_url:
+                # report_text is the interaction ID here
+                cache_key = self._report_cache_key(mode, symbol, self._build_final_prompt(mode, custom_prompt, symbol))
+                state = {
+                    "interaction_id": report_text,
+                    "cache_key": cache_key,
+                    "mode": mode,
+                    "symbol": symbol,
+                    "user_id": user_id,
+                    "submitted_at_ns": time.time_ns(),
                 }
-                
-                tm.update_task(task_id, status="completed", result=result_data, progress="已完成")
-            else:
-                tm.update_task(task_id, status="failed", error=error, progress="任务失败")
+                with _webhook_lock:
+                    _webhook_tasks[task_id] = dict(state, agent=self, knowledge_service=knowledge_service)
+                # The API key is never written to disk; a restored task uses the server's key
+                await asyncio.to_thread(tm.update_task, task_id, progress="任务已提交，等待完成通知...", webhook=state)
+                ensure_webhook_sweeper()
+                return
+
+            await self._afinish_task(task_id, mode, symbol, knowledge_service, user_id,
+                                     success, report_text, error, progress_callback)
                 
         except Exception as e:
             logger.error(f"Async task failed: {e}", exc_info=True)
             tm.update_task(task_id, status="failed", error=str(e), progress="发生系统错误")
 
+    async def _afinish_task(self, task_id, mode, symbol, knowledge_service, user_id,
+                            success, report_text, error, status_callback=None):
+        """Render and save a finished report, or record the failure, in the TaskManager."""
+        tm = get_task_manager()
+        if not success:
+            tm.update_task(task_id, status="failed", error=error, progress="任务失败")
+            return
+
+        if status_callback:
+            status_callback("研究完成，正在生成 PDF...")
+
+        # Rendered in report_generator's worker processes, off the event loop
+        pdf_bytes = await asyncio.wrap_future(create_markdown_pdf_async(symbol, report_text))
+
+        filename = f"UltraDeepReport_{symbol}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+        
+        # Save using existing service (Saves to Disk + Supabase Metadata)
+        # Fix: If symbol is None (e.g. MACRO/STRATEGY mode), use mode as symbol
+        save_symbol = symbol if symbol else mode
+        
+        save_result = await asyncio.to_thread(
+            knowledge_service.save_document,
+            save_symbol,
+            pdf_bytes,
+            filename,
+            doc_type='ultra_deep_report',
+            user_id=user_id,
+            source_text=report_text
+        )
+        
+        result_data = {
+            "report_text_preview": report_text[:500] + "...",
+            "report_length": len(report_text),
+            "file_record": save_result
+        }
+        
+        tm.update_task(task_id, status="completed", result=result_data, progress="已完成")
+
+    @staticmethod
+    async def acomplete_webhook_task(task_id: str) -> bool:
+        """
+        Handle a completion callback for task_id: fetch its interaction once and finish the task.
+        The callback body isn't trusted; the state always comes from the API.
+
+        Returns:
+            False if task_id isn't waiting on a webhook (unknown or already finished)
+        """
+        ensure_webhook_sweeper()
+        with _webhook_lock:
+            if task_id in _webhook_busy:
+                # Another callback is fetching this task; a lost result is picked up by the next sweep
+                return True
+            pending = _webhook_tasks.get(task_id)
+        if pending is None:
+            pending = await asyncio.to_thread(DeepResearchAgent._restore_webhook_task, task_id)
+            if pending is None:
+                return False
+        with _webhook_lock:
+            if task_id in _webhook_busy:
+                return True
+            pending = _webhook_tasks.setdefault(task_id, pending)
+            _webhook_busy.add(task_id)
+
+        try:
+            await DeepResearchAgent._afetch_webhook_task(task_id, pending)
+        finally:
+            with _webhook_lock:
+                _webhook_busy.discard(task_id)
+        return True
+
+    @staticmethod
+    async def _afetch_webhook_task(task_id: str, pending: dict):
+        agent = pending["agent"]
+        tm = get_task_manager()
+        if agent is None:
+            # Restored after a restart without a server-side API key: nothing can fetch the report
+            with _webhook_lock:
+                _webhook_tasks.pop(task_id, None)
+            tm.update_task(task_id, status="failed", error="服务重启后无法恢复该任务，请重新提交", progress="任务失败")
+            return
+
+        try:
+            result = await agent.afetch_report(pending["interaction_id"])
+        except Exception as e:
+            # Keep waiting; the next callback (or the sweep) fetches again
+            logger.error(f"Webhook fetch failed for task {task_id}: {e}", exc_info=True)
+            result = None
+        if result is None:
+            return
+
+        with _webhook_lock:
+            _webhook_tasks.pop(task_id, None)
+        try:
+            success, report_text, error = result
+            if success:
+                await asyncio.to_thread(report_cache.set, pending["cache_key"], report_text, ttl=agent.REPORT_CACHE_TTL)
+            await agent._afinish_task(
+                task_id, pending["mode"], pending["symbol"], pending["knowledge_service"], pending["user_id"],
+                success, report_text, error, lambda msg: tm.update_task(task_id, progress=msg)
+            )
+        except Exception as e:
+            logger.error(f"Async task failed: {e}", exc_info=True)
+            tm.update_task(task_id, status="failed", error=str(e), progress="发生系统错误")
+
+    @staticmethod
+    def _restore_webhook_task(task_id: str) -> Optional[dict]:
+        """
+        Rebuild a webhook task from the state stored on its TaskManager task (e.g. after a restart).
+        The submitting user's API key isn't stored, so the server's GEMINI_API_KEY is used; without
+        one, "agent" is None and the task is failed when it is next fetched.
+        """
+        state = get_task_manager().get_webhook(task_id)
+        if state is None:
+            return None
+        from knowledge_service import get_knowledge_service
+
+        api_key = os.environ.get("GEMINI_API_KEY")
+        return dict(
+            state,
+            agent=DeepResearchAgent(api_key) if api_key else None,
+            knowledge_service=get_knowledge_service(),
+        )
+
+    @classmethod
+    async def asweep_webhook_tasks(cls):
+        """
+        One pass over every task waiting on a webhook: fail those older than WEBHOOK_MAX_AGE and
+        fetch the rest, in case their callback was never delivered (or arrived before a restart).
+        """
+        tm = get_task_manager()
+        now = time.time_ns()
+        for task_id, state in tm.webhook_tasks():
+            if now - state.get("submitted_at_ns", 0) > cls.WEBHOOK_MAX_AGE * 1_000_000_000:
+                with _webhook_lock:
+                    if task_id in _webhook_busy:
+                        continue
+                    _webhook_tasks.pop(task_id, None)
+                logger.warning(f"Webhook task {task_id} timed out waiting for its completion callback")
+                tm.update_task(task_id, status="failed", progress="任务失败",
+                               error=f"任务超时（{cls.WEBHOOK_MAX_AGE // 60}分钟内未收到完成通知）")
+                continue
+            try:
+                await cls.acomplete_webhook_task(task_id)
+            except Exception as e:
+                logger.error(f"Webhook sweep failed for task {task_id}: {e}", exc_info=True)
+
+    @classmethod
+    async def _awebhook_sweep_loop(cls):
+        while True:
+            await asyncio.sleep(cls.WEBHOOK_SWEEP_INTERVAL)
+            try:
+                await cls.asweep_webhook_tasks()
+            except Exception as e:
+                logger.error(f"Webhook sweep failed: {e}", exc_info=True)
+
     @staticmethod
     def _clean_markdown(raw_markdown: str) -> str:
         """
@@ -327,11 +716,19 @@ class DeepResearchAgent:
         # The actual PDF generation will handle these
 
         # Remove potential problematic characters
-        cleaned = cleaned.replace('\r\n', '\n')  # Normalize line endings
-        cleaned = cleaned.replace('\r', '\n')
+        # Normalize \r\n and lone \r in one pass; most API output is already \n-only
+        if '\r' in cleaned:
+            cleaned = _LINE_ENDING_RE.sub('\n', cleaned)
 
         # Remove excessive blank lines (more than 2 consecutive)
-        import re
-        cleaned = re.sub(r'\n{3,}', '\n\n', cleaned)
+        cleaned = _BLANK_LINES_RE.sub('\n\n', cleaned)
 
         return cleaned.strip()
+
+
+# mode -> persona builder; MACRO/STRATEGY are fixed texts, STOCK fills in the symbol
+_PERSONA_PROMPTS = {
+    DeepResearchAgent.MODE_MACRO: lambda symbol: _MACRO_PROMPT,
+    DeepResearchAgent.MODE_STRATEGY: lambda symbol: _STRATEGY_PROMPT,
+    DeepResearchAgent.MODE_STOCK: lambda symbol: _STOCK_TEMPLATE.format(symbol=symbol),
+}
@@ -0,0 +1,228 @@
+"""
+Gemini Dispatcher Module
+Process-wide Gemini plumbing shared by every caller: one client per API key, one background
+event loop for `.aio` calls, an RPM/TPM limiter and retrying generate_content wrappers.
+"""
+
+import io
+import os
+import re
+import time
+import random
+import asyncio
+import logging
+import threading
+import httpx
+from functools import lru_cache
+from google import genai
+from google.genai import errors as genai_errors
+
+logger = logging.getLogger(__name__)
+
+# Per-minute quotas for the project key; override to match the account tier
+GEMINI_RPM = int(os.environ.get("GEMINI_RPM", 60))
+GEMINI_TPM = int(os.environ.get("GEMINI_TPM", 1_000_000))
+
+GENERATION_MAX_ATTEMPTS = 3
+GENERATION_BACKOFF_MIN = 2   # seconds
+GENERATION_BACKOFF_MAX = 20  # seconds
+
+# CJK ideographs, punctuation and full-width forms tokenize at roughly one token per character
+_CJK_RE = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+
+
+class GeminiDispatcher:
+    """
+    Token-bucket limiter for Gemini requests.
+    Two buckets refill continuously: one request per 60/rpm seconds and tpm/60 tokens per second.
+    Safe to share between threads and event loops (state is guarded by a threading.Lock,
+    never held across a sleep).
+    """
+
+    def __init__(self, rpm: int = GEMINI_RPM, tpm: int = GEMINI_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, est_tokens: int) -> float:
+        """Take one request + est_tokens if available and return 0, else return seconds to wait."""
+        # A single prompt larger than the whole bucket would otherwise wait forever
+        est_tokens = min(est_tokens, self.tpm)
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._last_refill
+            self._last_refill = now
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+            if self._requests >= 1 and self._tokens >= est_tokens:
+                self._requests -= 1
+                self._tokens -= est_tokens
+                return 0
+
+            request_wait = max(0, 1 - self._requests) * 60 / self.rpm
+            token_wait = max(0, est_tokens - self._tokens) * 60 / self.tpm
+            return max(request_wait, token_wait)
+
+    def acquire(self, est_tokens: int = 0):
+        """Block until the buckets allow one more request of ~est_tokens input tokens."""
+        while True:
+            wait = self._reserve(est_tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, est_tokens: int = 0):
+        """Async twin of acquire; yields to the event loop while throttled."""
+        while True:
+            wait = self._reserve(est_tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+# Single instance shared by AnalystAgent and DeepResearchAgent
+dispatcher = GeminiDispatcher()
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+@lru_cache(maxsize=16)
+def get_client(api_key: str) -> genai.Client:
+    """
+    One genai.Client per API key for the whole process, so every agent instance
+    reuses the same connection pools instead of opening fresh TLS sessions.
+    The key is passed explicitly; nothing here sets GOOGLE_API_KEY, so callers
+    must not rely on the environment to pick up a per-user key.
+    """
+    return genai.Client(api_key=api_key)
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            # Started lazily so each gunicorn worker gets its own loop after fork
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="gemini-aio-loop", daemon=True).start()
+        return _loop
+
+
+def run_sync(coro):
+    """
+    Run a coroutine on the shared background event loop and block until it finishes.
+    Used instead of asyncio.run: the shared client's `.aio` connections are bound to
+    the loop that opened them, so all async Gemini traffic must stay on one loop.
+    Must not be called from a coroutine already running on that loop.
+    """
+    return submit(coro).result()
+
+
+def submit(coro):
+    """Schedule a coroutine on the shared background event loop without waiting; returns a concurrent Future."""
+    return asyncio.run_coroutine_threadsafe(coro, _background_loop())
+
+
+def estimate_tokens(contents) -> int:
+    """
+    Rough token count without a tokenizer round-trip: ~1 token per CJK character,
+    ~4 characters per token for everything else. Good enough for quotas and prompt budgets.
+    """
+    text = str(contents)
+    non_cjk = len(_CJK_RE.sub("", text))
+    return (len(text) - non_cjk) + non_cjk // 4
+
+
+def is_retryable(exc: Exception) -> bool:
+    """Timeouts, rate limits (429) and server-side errors (5xx) are worth another attempt."""
+    if isinstance(exc, (TimeoutError, httpx.TimeoutException)):
+        return True
+    if isinstance(exc, genai_errors.APIError):
+        return exc.code == 429 or (exc.code or 0) >= 500
+    return False
+
+
+def backoff_delay(attempt: int) -> float:
+    # 2s, 4s, 8s ... capped, with a little jitter so parallel sub-agents don't retry in lockstep
+    delay = min(GENERATION_BACKOFF_MAX, GENERATION_BACKOFF_MIN * 2 ** attempt)
+    return delay + random.uniform(0, 1)
+
+
+def generate_content(client, model_name: str, contents, config=None):
+    """Rate-limited client.models.generate_content with retry + exponential backoff on transient errors."""
+    est_tokens = estimate_tokens(contents)
+    for attempt in range(GENERATION_MAX_ATTEMPTS):
+        dispatcher.acquire(est_tokens)
+        try:
+            return client.models.generate_content(model=model_name, contents=contents, config=config)
+        except Exception as e:
+            if attempt == GENERATION_MAX_ATTEMPTS - 1 or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"{model_name} call failed ({e}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+async def generate_content_async(client, model_name: str, contents, config=None):
+    """Async twin of generate_content using client.aio."""
+    est_tokens = estimate_tokens(contents)
+    for attempt in range(GENERATION_MAX_ATTEMPTS):
+        await dispatcher.acquire_async(est_tokens)
+        try:
+            return await client.aio.models.generate_content(model=model_name, contents=contents, config=config)
+        except Exception as e:
+            if attempt == GENERATION_MAX_ATTEMPTS - 1 or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"{model_name} call failed ({e}), retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+
+def generate_content_stream(client, model_name: str, contents, config=None, on_chunk=None) -> str:
+    """
+    Rate-limited client.models.generate_content_stream.
+    Each text delta is forwarded to on_chunk(delta) as it arrives; returns the full text.
+    Only retried if the failure happens before the first chunk, so callers never see duplicated output.
+    """
+    est_tokens = estimate_tokens(contents)
+    for attempt in range(GENERATION_MAX_ATTEMPTS):
+        dispatcher.acquire(est_tokens)
+        buffer = io.StringIO()
+        try:
+            for chunk in client.models.generate_content_stream(model=model_name, contents=contents, config=config):
+                if chunk.text:
+                    buffer.write(chunk.text)
+                    if on_chunk:
+                        on_chunk(chunk.text)
+            return buffer.getvalue()
+        except Exception as e:
+            if buffer.tell() or attempt == GENERATION_MAX_ATTEMPTS - 1 or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"{model_name} stream failed ({e}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+async def generate_content_stream_async(client, model_name: str, contents, config=None, on_chunk=None) -> str:
+    """Async twin of generate_content_stream using client.aio."""
+    est_tokens = estimate_tokens(contents)
+    for attempt in range(GENERATION_MAX_ATTEMPTS):
+        await dispatcher.acquire_async(est_tokens)
+        buffer = io.StringIO()
+        try:
+            async for chunk in await client.aio.models.generate_content_stream(model=model_name, contents=contents, config=config):
+                if chunk.text:
+                    buffer.write(chunk.text)
+                    if on_chunk:
+                        on_chunk(chunk.text)
+            return buffer.getvalue()
+        except Exception as e:
+            if buffer.tell() or attempt == GENERATION_MAX_ATTEMPTS - 1 or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"{model_name} stream failed ({e}), retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
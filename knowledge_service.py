@@ -2,27 +2,86 @@ import os
 import json
 import logging
 import uuid
+import gzip
+import hashlib
 import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from typing import TYPE_CHECKING
 from pypdf import PdfReader
-from supabase import create_client, Client
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    from supabase import Client
+
 load_dotenv()
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class _FilenameFilter(dict):
+    """
+    str.translate table for save_document's safe filenames: letters (any script, so
+    Chinese names survive), digits, space, '.', '_' and '-' are kept, everything else
+    is deleted. Each code point is classified once, on first sight, then looked up.
+    """
+
+    def __missing__(self, codepoint):
+        c = chr(codepoint)
+        self[codepoint] = keep = codepoint if (c.isalpha() or c.isdigit() or c in " ._-") else None
+        return keep
+
+
+_FILENAME_FILTER = _FilenameFilter()
+
+# Combined document context handed to the model: ~200k chars is ~50k tokens
+DOCUMENTS_MAX_CHARS = 200_000
+TRUNCATED_MARKER = "\n... [truncated]"
+
+# Seconds before a PostgREST / Storage request is abandoned
+SUPABASE_TIMEOUT = 30
+
+
+@lru_cache(maxsize=4)
+def get_supabase_client(url: str, key: str) -> "Client":
+    """
+    One Supabase client per project for the whole process, so services created per
+    request keep reusing the same HTTP connection pool instead of new TLS sessions.
+    The SDK is imported here, so local-storage setups never load it.
+    """
+    from supabase import create_client, ClientOptions
+    return create_client(url, key, options=ClientOptions(
+        postgrest_client_timeout=SUPABASE_TIMEOUT,
+        storage_client_timeout=SUPABASE_TIMEOUT,
+    ))
+
+
 class KnowledgeService:
+    # Documents read concurrently when building a combined context
+    MAX_PARALLEL_READS = 8
+    # Write buffer / copy chunk for saved files
+    WRITE_CHUNK_SIZE = 1 << 20
+    # Metadata lookups are reused for this long (seconds) / this many documents
+    METADATA_CACHE_TTL = 60
+    METADATA_CACHE_SIZE = 512
+
     def __init__(self):
         self.supabase_url = os.environ.get("SUPABASE_URL")
         self.supabase_key = os.environ.get("SUPABASE_KEY")
         self.use_supabase = bool(self.supabase_url and self.supabase_key)
         
         self.base_path = "knowledge_base"
-        self.local_meta_file = os.path.join(self.base_path, "documents.json")
+        self.local_meta_file = os.path.join(self.base_path, "documents.json")  # Legacy, migrated into local_db_file
+        self.local_db_file = os.path.join(self.base_path, "documents.db")
         self.table_name = "knowledge_documents"  # Correct table name
+        self.pdf_text_cache_dir = os.path.join(self.base_path, ".cache", "pdf_text")
+        self._meta_cache = {}  # doc_id -> (expires_at, record)
+        self._meta_cache_lock = threading.Lock()
         
         # Ensure directories
         os.makedirs(self.base_path, exist_ok=True)
@@ -31,7 +90,7 @@ class KnowledgeService:
 
         if self.use_supabase:
             try:
-                self.supabase: Client = create_client(self.supabase_url, self.supabase_key)
+                self.supabase: "Client" = get_supabase_client(self.supabase_url, self.supabase_key)
                 logger.info("KnowledgeService: Connected to Supabase")
             except Exception as e:
                 logger.error(f"KnowledgeService: Supabase init failed: {e}")
@@ -39,30 +98,120 @@ class KnowledgeService:
                 self._init_local_storage()
 
     def _init_local_storage(self):
-        """Initialize local metadata JSON."""
-        if not os.path.exists(self.local_meta_file):
-            with open(self.local_meta_file, 'w', encoding='utf-8') as f:
-                json.dump([], f)
+        """Initialize local metadata SQLite store (one shared connection, guarded by a lock)."""
+        self._db_lock = threading.Lock()
+        self.db = sqlite3.connect(self.local_db_file, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        # WAL: readers don't block the writer, and a crash mid-write can't corrupt the store
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS docs("
+                "id TEXT PRIMARY KEY, user_id TEXT, symbol TEXT, filename TEXT, file_path TEXT, "
+                "type TEXT, file_size INTEGER, created_at TEXT, is_pinned INTEGER NOT NULL DEFAULT 0)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_symbol ON docs(symbol, created_at)")
+        self._migrate_local_json()
 
-    def extract_text_from_pdf(self, file_path: str) -> str:
-        """Extract all text from a PDF file."""
+    def _migrate_local_json(self):
+        """One-off import of the old documents.json store; the file is renamed once imported."""
+        try:
+            with open(self.local_meta_file, 'r', encoding='utf-8') as f:
+                docs = json.load(f)
+            with self._db_lock, self.db:
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO docs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [self._local_row(d) for d in docs]
+                )
+            os.replace(self.local_meta_file, f"{self.local_meta_file}.migrated")
+            logger.info(f"KnowledgeService: Migrated {len(docs)} documents from {self.local_meta_file}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Local metadata migration failed: {e}")
+
+    @staticmethod
+    def _local_row(doc: dict) -> tuple:
+        return (
+            doc["id"], doc.get("user_id"), doc["symbol"], doc["filename"], doc.get("file_path"),
+            doc.get("type"), doc.get("file_size"), doc.get("created_at"), int(doc.get("is_pinned", False))
+        )
+
+    def _query_local(self, sql: str, params: tuple = ()) -> list:
+        with self._db_lock:
+            rows = self.db.execute(sql, params).fetchall()
+        docs = [dict(row) for row in rows]
+        for doc in docs:
+            doc["is_pinned"] = bool(doc["is_pinned"])
+        return docs
+
+    def extract_text_from_pdf(self, file_path: str, max_pages: int = None) -> str:
+        """
+        Extract all text from a PDF file (or its first max_pages pages).
+        Full extractions are cached by content hash, so a document referenced
+        again (next chat turn, next report) is not re-parsed.
+        Raises FileNotFoundError if file_path does not exist.
+        """
+        cache_path = None
+        if max_pages is None:
+            cache_path = os.path.join(self.pdf_text_cache_dir, f"{self._file_sha256(file_path)}.txt.gz")
+            try:
+                with gzip.open(cache_path, 'rt', encoding='utf-8') as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"PDF text cache read failed for {file_path}: {e}")
+
+        text = self._parse_pdf_text(file_path, max_pages)
+
+        if cache_path and text:
+            try:
+                os.makedirs(self.pdf_text_cache_dir, exist_ok=True)
+                temp_path = f"{cache_path}.tmp"
+                with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+                    f.write(text)
+                os.replace(temp_path, cache_path)
+            except Exception as e:
+                logger.warning(f"PDF text cache write failed for {file_path}: {e}")
+        return text
+
+    @staticmethod
+    def _file_sha256(file_path: str) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _parse_pdf_text(self, file_path: str, max_pages: int = None) -> str:
         try:
             reader = PdfReader(file_path)
-            text = ""
-            for page in reader.pages:
-                page_text = page.extract_text()
+            # Collect page texts and join once; += would copy the whole text per page
+            parts = []
+            for i, page in enumerate(reader.pages):
+                if max_pages is not None and i >= max_pages:
+                    break
+                # Pages without a content stream (blank/image-only) have no text to extract
+                if "/Contents" not in page:
+                    continue
+                # Plain mode skips pypdf's layout analysis, which dominates extraction time
+                page_text = page.extract_text(extraction_mode="plain")
                 if page_text:
-                    text += page_text + "\n"
-            return text
+                    parts.append(page_text)
+            return "\n".join(parts)
         except Exception as e:
             logger.error(f"PDF extraction failed for {file_path}: {e}")
             return ""
 
-    def save_document(self, symbol: str, file_obj, filename: str, doc_type: str = "user_upload", user_id: str = None) -> dict:
+    def save_document(self, symbol: str, file_obj, filename: str, doc_type: str = "user_upload", user_id: str = None, source_text: str = None) -> dict:
         """
         Save uploaded file or generated report.
         1. Save file to disk (local cache).
-        2. Save metadata to DB (Supabase) or local JSON.
+        2. Save metadata to DB (Supabase) or local SQLite.
+        source_text: markdown a generated PDF was rendered from; kept as a gzipped `<file>.md.gz` sidecar
+        so reading the document back never has to re-extract the PDF.
         """
         symbol = symbol.upper()
         doc_id = str(uuid.uuid4())
@@ -73,19 +222,15 @@ class KnowledgeService:
         
         # Determine paths
         # Use safe filename
-        safe_filename = "".join([c for c in filename if c.isalpha() or c.isdigit() or c in (' ', '.', '_', '-')]).strip()
+        safe_filename = filename.translate(_FILENAME_FILTER).strip()
         file_path = os.path.join(symbol_dir, f"{doc_id}_{safe_filename}")
         
         # Save file content locally (Supabase storage not configured in this version)
-        try:
-            file_obj.save(file_path)
-        except AttributeError:
-            # If file_obj is bytes or string (e.g. from report generator)
-            with open(file_path, 'wb') as f:
-                f.write(file_obj if isinstance(file_obj, bytes) else file_obj.encode('utf-8'))
-
-        # Get file size
-        file_size = os.path.getsize(file_path)
+        file_size = self._write_file(file_path, file_obj)
+        if source_text:
+            # Markdown compresses ~10x, a fraction of the PDF's size on disk
+            with gzip.open(self._markdown_sidecar(file_path), 'wt', encoding='utf-8') as f:
+                f.write(source_text)
 
         # Base record (Internal/Local representation)
         record = {
@@ -127,17 +272,34 @@ class KnowledgeService:
                 return {"error": str(e)}
         else:
             try:
-                with open(self.local_meta_file, 'r', encoding='utf-8') as f:
-                    docs = json.load(f)
-                docs.append(record)
-                with open(self.local_meta_file, 'w', encoding='utf-8') as f:
-                    json.dump(docs, f, indent=2)
+                with self._db_lock, self.db:
+                    self.db.execute("INSERT INTO docs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self._local_row(record))
             except Exception as e:
                 logger.error(f"Local document save failed: {e}")
                 return {"error": str(e)}
 
         return record
 
+    @staticmethod
+    def _markdown_sidecar(file_path: str) -> str:
+        return f"{file_path}.md.gz"
+
+    def _write_file(self, file_path: str, file_obj) -> int:
+        """Write an upload stream, bytes or str to file_path in 1 MB chunks; returns the bytes written."""
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        with os.fdopen(fd, 'wb', buffering=self.WRITE_CHUNK_SIZE) as out:
+            if hasattr(file_obj, 'read'):
+                # Uploaded file (werkzeug FileStorage) or any other stream: copy without buffering it whole
+                file_size = 0
+                for chunk in iter(lambda: file_obj.read(self.WRITE_CHUNK_SIZE), b""):
+                    out.write(chunk)
+                    file_size += len(chunk)
+                return file_size
+
+            # If file_obj is bytes or string (e.g. from report generator)
+            data = file_obj if isinstance(file_obj, (bytes, bytearray)) else file_obj.encode('utf-8')
+            return out.write(memoryview(data))
+
     def list_documents(self, symbol: str) -> list:
         """List documents for a specific symbol."""
         symbol = symbol.upper()
@@ -150,15 +312,17 @@ class KnowledgeService:
                 return []
         else:
             try:
-                with open(self.local_meta_file, 'r', encoding='utf-8') as f:
-                    docs = json.load(f)
-                return [d for d in docs if d["symbol"] == symbol]
+                return self._query_local("SELECT * FROM docs WHERE symbol = ? ORDER BY created_at DESC", (symbol,))
             except Exception as e:
+                logger.error(f"Local list failed: {e}")
                 return []
 
     def get_document_metadata(self, doc_id: str) -> dict:
-        """Retrieve document metadata by ID."""
-        doc = None
+        """Retrieve document metadata by ID (briefly cached, see METADATA_CACHE_TTL)."""
+        doc = self._cached_metadata(doc_id)
+        if doc:
+            return doc
+
         if self.use_supabase:
             try:
                 res = self.supabase.table(self.table_name).select("*").eq("id", doc_id).single().execute()
@@ -167,22 +331,69 @@ class KnowledgeService:
                 return None
         else:
             try:
-                with open(self.local_meta_file, 'r', encoding='utf-8') as f:
-                    docs = json.load(f)
-                doc = next((d for d in docs if d["id"] == doc_id), None)
+                docs = self._query_local("SELECT * FROM docs WHERE id = ?", (doc_id,))
+                doc = docs[0] if docs else None
             except Exception:
                 return None
         
         if doc:
-             # Reconstruct file_path if missing (DB doesn't store it)
-             if "file_path" not in doc:
-                 symbol_dir = os.path.join(self.base_path, doc["symbol"])
-                 # Note: In save_document we used f"{doc_id}_{safe_filename}"
-                 # DB stores safe_filename in "filename" column
-                 doc["file_path"] = os.path.join(symbol_dir, f"{doc['id']}_{doc['filename']}")
+            self._reconstruct_path(doc)
+            self._remember_metadata(doc)
         
         return doc
 
+    def get_documents_metadata(self, doc_ids: list) -> dict:
+        """Retrieve metadata for several documents in one lookup. Returns {id: record}."""
+        if not doc_ids:
+            return {}
+
+        if self.use_supabase:
+            try:
+                res = self.supabase.table(self.table_name).select("*").in_("id", doc_ids).execute()
+                docs = res.data or []
+            except Exception as e:
+                logger.error(f"Supabase batch metadata lookup failed: {e}")
+                return {}
+        else:
+            try:
+                placeholders = ",".join("?" * len(doc_ids))
+                docs = self._query_local(f"SELECT * FROM docs WHERE id IN ({placeholders})", tuple(doc_ids))
+            except Exception as e:
+                logger.error(f"Local batch metadata lookup failed: {e}")
+                return {}
+
+        for doc in docs:
+            self._reconstruct_path(doc)
+            self._remember_metadata(doc)
+        return {d["id"]: d for d in docs}
+
+    def _cached_metadata(self, doc_id: str):
+        with self._meta_cache_lock:
+            entry = self._meta_cache.get(doc_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def _remember_metadata(self, doc: dict):
+        with self._meta_cache_lock:
+            if len(self._meta_cache) >= self.METADATA_CACHE_SIZE:
+                # Oldest entry first (dicts keep insertion order)
+                self._meta_cache.pop(next(iter(self._meta_cache)))
+            self._meta_cache[doc["id"]] = (time.monotonic() + self.METADATA_CACHE_TTL, doc)
+
+    def _forget_metadata(self, doc_id: str):
+        with self._meta_cache_lock:
+            self._meta_cache.pop(doc_id, None)
+
+    def _reconstruct_path(self, doc: dict) -> dict:
+        # Reconstruct file_path if missing (DB doesn't store it)
+        if "file_path" not in doc:
+            symbol_dir = os.path.join(self.base_path, doc["symbol"])
+            # Note: In save_document we used f"{doc_id}_{safe_filename}"
+            # DB stores safe_filename in "filename" column
+            doc["file_path"] = os.path.join(symbol_dir, f"{doc['id']}_{doc['filename']}")
+        return doc
+
     def get_document_content(self, doc_id: str) -> str:
         """Retrieve full text content of a document by ID."""
         doc = self.get_document_metadata(doc_id)
@@ -190,23 +401,39 @@ class KnowledgeService:
         if not doc:
             return ""
 
+        return self._read_document_content(doc)
+
+    def _read_document_content(self, doc: dict) -> str:
+        """Text content of a document whose metadata is already loaded."""
         file_path = doc.get("file_path")
-        if not file_path or not os.path.exists(file_path):
+        if not file_path:
             return ""
 
-        # Check extension
-        if file_path.lower().endswith(".pdf"):
-            return self.extract_text_from_pdf(file_path)
-        else:
-            # Text/Markdown files
-            try:
+        # Open directly instead of checking os.path.exists first: one syscall, no race with deletes
+        try:
+            # Check extension
+            if file_path.lower().endswith(".pdf"):
+                # Generated reports keep their markdown next to the PDF
+                try:
+                    with gzip.open(self._markdown_sidecar(file_path), 'rt', encoding='utf-8') as f:
+                        return f.read()
+                except FileNotFoundError:
+                    pass
+                return self.extract_text_from_pdf(file_path)
+            else:
+                # Text/Markdown files
                 with open(file_path, 'r', encoding='utf-8') as f:
                     return f.read()
-            except Exception:
-                return ""
+        except FileNotFoundError:
+            return ""
+        except Exception as e:
+            logger.error(f"Failed to read document {doc.get('id')}: {e}")
+            return ""
 
     def delete_document(self, doc_id: str) -> bool:
         """Delete document metadata and file, unless it's pinned."""
+        # Pin status must be current, not cached
+        self._forget_metadata(doc_id)
         doc = self.get_document_metadata(doc_id)
         if not doc: return False
 
@@ -218,29 +445,31 @@ class KnowledgeService:
             return False
 
         # 2. Delete file
-        if "file_path" in doc and os.path.exists(doc["file_path"]):
-            try:
-                os.remove(doc["file_path"])
-            except Exception as e:
-                logger.error(f"Failed to delete file: {e}")
+        if "file_path" in doc:
+            for path in (doc["file_path"], self._markdown_sidecar(doc["file_path"])):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    logger.error(f"Failed to delete file: {e}")
 
         # 3. Delete Metadata
         if self.use_supabase:
             self.supabase.table(self.table_name).delete().eq("id", doc_id).execute()
         else:
             try:
-                with open(self.local_meta_file, 'r', encoding='utf-8') as f:
-                    docs = json.load(f)
-                docs = [d for d in docs if d["id"] != doc_id]
-                with open(self.local_meta_file, 'w', encoding='utf-8') as f:
-                    json.dump(docs, f, indent=2)
+                with self._db_lock, self.db:
+                    self.db.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
             except Exception:
                 pass
+        self._forget_metadata(doc_id)
         
         return True
 
     def toggle_pin_status(self, doc_id: str, user_id: str) -> dict:
         """Toggle the is_pinned status of a document."""
+        self._forget_metadata(doc_id)
         if self.use_supabase:
             try:
                 # Fetch current status
@@ -255,44 +484,69 @@ class KnowledgeService:
                 logger.error(f"Supabase toggle pin status failed for {doc_id}: {e}")
                 return {"error": str(e), "success": False}
         else:
-            # Local JSON update
+            # Local SQLite update
             try:
-                with open(self.local_meta_file, 'r', encoding='utf-8') as f:
-                    docs = json.load(f)
-                
-                found = False
-                for doc in docs:
-                    if doc["id"] == doc_id and doc.get("user_id") == user_id:
-                        doc["is_pinned"] = not doc.get("is_pinned", False)
-                        found = True
-                        break
-                
-                if found:
-                    with open(self.local_meta_file, 'w', encoding='utf-8') as f:
-                        json.dump(docs, f, indent=2)
-                    # Find the updated doc to return its status
-                    updated_doc = next((d for d in docs if d["id"] == doc_id), None)
-                    return {"id": doc_id, "is_pinned": updated_doc.get("is_pinned", False), "success": True} if updated_doc else {"error": "Document not found locally after update.", "success": False}
+                with self._db_lock, self.db:
+                    self.db.execute(
+                        "UPDATE docs SET is_pinned = 1 - is_pinned WHERE id = ? AND user_id IS ?", (doc_id, user_id)
+                    )
+                    row = self.db.execute(
+                        "SELECT is_pinned FROM docs WHERE id = ? AND user_id IS ?", (doc_id, user_id)
+                    ).fetchone()
+                if row:
+                    return {"id": doc_id, "is_pinned": bool(row["is_pinned"]), "success": True}
                 else:
                     return {"error": "Document not found locally or user mismatch.", "success": False}
             except Exception as e:
                 logger.error(f"Local toggle pin status failed for {doc_id}: {e}")
                 return {"error": str(e), "success": False}
 
-    def get_documents_content(self, file_ids: list) -> str:
-        """Combine content of multiple documents."""
+    def get_documents_content(self, file_ids: list, max_chars: int = DOCUMENTS_MAX_CHARS) -> str:
+        """
+        Combine content of multiple documents, capped at about max_chars in total.
+        Documents shorter than their share are kept whole and the spare budget goes
+        to the longer ones, which are cut with a truncation marker.
+        """
         if not file_ids:
             return ""
-            
-        combined_text = ""
-        for doc_id in file_ids:
-            doc = self.get_document_metadata(doc_id)
-            if not doc: continue
-            
-            filename = doc.get('filename', 'Unknown File')
-            content = self.get_document_content(doc_id)
-            
-            if content:
-                combined_text += f"\n\n--- Document: {filename} ---\n{content}\n"
-        
-        return combined_text
\ No newline at end of file
+
+        # Same document selected twice is only read (and included) once
+        doc_ids = list(dict.fromkeys(file_ids))
+
+        # One metadata query for all documents, then only the file reads / PDF parsing
+        # run in parallel; keep the documents in the order they were selected
+        metadata = self.get_documents_metadata(doc_ids)
+        docs = [metadata[doc_id] for doc_id in doc_ids if doc_id in metadata]
+        if not docs:
+            return ""
+
+        with ThreadPoolExecutor(max_workers=min(self.MAX_PARALLEL_READS, len(docs))) as ex:
+            contents = list(ex.map(self._read_document_content, docs))
+
+        limits = self._split_budget([len(c) for c in contents], max_chars)
+        blocks = []
+        for doc, content, limit in zip(docs, contents, limits):
+            if not content:
+                continue
+            if len(content) > limit:
+                content = content[:limit] + TRUNCATED_MARKER
+            blocks.append(f"\n\n--- Document: {doc.get('filename', 'Unknown File')} ---\n{content}\n")
+        return "".join(blocks)
+
+    @staticmethod
+    def _split_budget(lengths: list, max_chars: int) -> list:
+        """Per-document character limits: shortest first, each takes at most an even share of what's left."""
+        limits = [0] * len(lengths)
+        remaining = max_chars
+        pending = len(lengths)
+        for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+            limits[i] = min(lengths[i], remaining // pending)
+            remaining -= limits[i]
+            pending -= 1
+        return limits
+
+
+@lru_cache(maxsize=1)
+def get_knowledge_service() -> KnowledgeService:
+    """Process-wide KnowledgeService: one metadata store connection and metadata cache for every caller."""
+    return KnowledgeService()
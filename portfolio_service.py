@@ -2,14 +2,22 @@ import os
 import json
 import logging
 import base64
-import csv  # Standard library import
+import codecs
+import io
+import csv
+import pickle
+import sqlite3
+import threading
+import time
 # import requests # No longer needed
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from supabase import create_client, Client
+from functools import lru_cache
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
-import google.generativeai as genai # Legacy SDK
-from google import genai as client_genai # New SDK
-from google.genai import types
+
+if TYPE_CHECKING:
+    from supabase import Client
 
 load_dotenv()
 
@@ -17,23 +25,111 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-from knowledge_service import KnowledgeService
+# orjson parses/serializes several times faster than the stdlib; optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _read_json(path):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+
+def _write_json(path, data):
+    if orjson:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
+# Encoding detection for non-UTF-8 files (installed with requests); optional
+try:
+    from charset_normalizer import from_bytes as detect_charset
+except ImportError:
+    detect_charset = None
+
+# Arrow's CSV reader (multithreaded, vectorized) when pyarrow is installed, pandas otherwise
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+except ImportError:
+    pacsv = None
+
+from knowledge_service import get_knowledge_service, get_supabase_client
+
+
+# The Gemini SDKs and pandas are slow to import; load them only when a code path needs them,
+# so local-only setups (no GEMINI_API_KEY, Supabase name map) never pay for them.
+@lru_cache(maxsize=1)
+def _legacy_genai():
+    import google.generativeai as genai  # Legacy SDK
+    return genai
+
+# Company summary prompts, filled with str.format per call
+_SUMMARY_PROMPT_NAMED = "请用一句话简明扼要地总结 A股上市公司“{name}” ({symbol}) 的主要业务和行业地位（不要废话，直接说重点）。"
+_SUMMARY_PROMPT_A_SHARE = "请用一句话简明扼要地总结 A股代码为 {symbol} 的公司的主要业务和行业地位（不要废话，直接说重点）。"
+_SUMMARY_PROMPT = "请用一句话简明扼要地总结股票代码为 {symbol} 的公司的主要业务和行业地位（不要废话，直接说重点）。"
+# Placeholders _fetch_gemini_summary returns instead of a summary; never cached
+_SUMMARY_ERROR_PREFIXES = ("API Error", "API Key Missing", "AI Generation Error", "Network Error")
+
+# Chat system prompts for the advisor views; any other symbol uses _STOCK_CHAT_INSTRUCTION
+_ADVISOR_CHAT_INSTRUCTIONS = {
+    "MACRO": (
+        "You are the Chief Macro Economic Advisor (首席宏观经济顾问). "
+        "Your goal is to analyze the Global and Chinese economic environment (Policy, GDP, Interest Rates, Geopolitics). "
+        "Do NOT discuss individual stock technicals unless they reflect a broad trend. "
+        "When giving judgments, TRY to categorize them into: Short-term (1-3mo), Medium-term (3-12mo), and Long-term (1-3yr)."
+    ),
+    "STRATEGY": (
+        "You are the Chief Investment Strategist (首席投资策略顾问). "
+        "Your goal is to provide advice on Asset Allocation, Sector Rotation, and Risk Management. "
+        "Focus on *how* to invest (position sizing, timing, hedging) rather than just *what* to buy. "
+        "When giving judgments, TRY to categorize them into: Short-term (1-3mo), Medium-term (3-12mo), and Long-term (1-3yr)."
+    ),
+}
+_STOCK_CHAT_INSTRUCTION = "You are a financial analysis assistant. You are discussing the {market} {stock}. Answer questions specifically about this company, its financials, news, or technicals. Keep answers concise and professional."
+
+# Shared by every Gemini call; built once instead of per request
+_SAFETY_SETTINGS = tuple(
+    {"category": category, "threshold": "BLOCK_NONE"}
+    for category in (
+        "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "HARM_CATEGORY_HATE_SPEECH",
+        "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "HARM_CATEGORY_HARASSMENT",
+    )
+)
 
 class PortfolioService:
+    # Summaries kept in memory after the first lookup (oldest evicted first)
+    SUMMARY_MEMORY_SIZE = 4096
+    # Concurrent Gemini calls when summaries for a whole page are fetched at once
+    MAX_PARALLEL_SUMMARIES = 8
+    # Columns read back from the holdings table (covered by idx_holdings_user_symbol_covering)
+    HOLDING_COLUMNS = "user_id,symbol,shares,cost_basis,updated_at"
+
     def __init__(self):
         self.supabase_url = os.environ.get("SUPABASE_URL")
         self.supabase_key = os.environ.get("SUPABASE_KEY")
         self.local_file = "portfolio.json"
-        self.summary_file = "company_summaries.json"
+        self.summary_file = "company_summaries.json"  # Legacy, migrated into summary_db_file
+        self.summary_db_file = "company_summaries.db"
         self.use_supabase = bool(self.supabase_url and self.supabase_key)
         self.gemini_key = os.environ.get("GEMINI_API_KEY")
         
         # Configure globally if key exists
         if self.gemini_key:
             try:
+                from gemini_dispatcher import get_client
+                genai = _legacy_genai()
                 genai.configure(api_key=self.gemini_key)
                 self.gemini_client = genai.GenerativeModel("gemini-2.5-pro") # Default instance
-                self.new_client = client_genai.Client(api_key=self.gemini_key) # New SDK Client
+                self.new_client = get_client(self.gemini_key) # New SDK Client (shared process-wide)
             except Exception as e:
                 logger.error(f"Failed to initialize Gemini client: {e}")
                 self.gemini_client = None
@@ -45,7 +141,7 @@ class PortfolioService:
         if self.use_supabase:
             logger.info("Initializing PortfolioService with Supabase")
             try:
-                self.supabase: Client = create_client(self.supabase_url, self.supabase_key)
+                self.supabase: "Client" = get_supabase_client(self.supabase_url, self.supabase_key)
             except Exception as e:
                 logger.error(f"Failed to initialize Supabase client: {e}")
                 self.use_supabase = False
@@ -53,7 +149,8 @@ class PortfolioService:
         if not self.use_supabase:
             logger.info("Initializing PortfolioService with Local File Storage")
             self._init_local_storage()
-            self._init_summary_storage()
+        # Summary cache is local in both modes
+        self._init_summary_storage()
         
         # Load A Share Name Mapping
         self.a_share_map = {}
@@ -85,38 +182,19 @@ class PortfolioService:
         try:
             base_dir = os.path.dirname(os.path.abspath(__file__))
             csv_path = os.path.join(base_dir, "A share names.csv")
+            pickle_path = os.path.join(base_dir, "a_share_map.pkl")
             
             if os.path.exists(csv_path):
+                csv_mtime = os.path.getmtime(csv_path)
+                if self._load_a_share_pickle(pickle_path, csv_mtime):
+                    print(f"[Info] Final A-Share map size: {len(self.a_share_map)} (from {pickle_path})")
+                    return
                 try:
-                    with open(csv_path, mode='r', encoding='utf-8-sig') as f:
-                        reader = csv.DictReader(f)
-                        if reader.fieldnames:
-                            reader.fieldnames = [name.strip() for name in reader.fieldnames]
-                            
-                        for row in reader:
-                            raw_code = row.get('证券代码')
-                            name = row.get('证券名称')
-                            if raw_code and name:
-                                code = raw_code.strip().split('.')[0]
-                                self.a_share_map[code] = name.strip()
-                                loaded_count += 1
+                    loaded_count = self._read_a_share_csv(csv_path, self._sniff_csv_encoding(csv_path))
                 except Exception as csv_e:
                     print(f"[Warn] CSV load failed: {csv_e}")
-                    # Fallback to GBK
-                    try:
-                        with open(csv_path, mode='r', encoding='gbk') as f:
-                            reader = csv.DictReader(f)
-                            if reader.fieldnames:
-                                reader.fieldnames = [name.strip() for name in reader.fieldnames]
-                            for row in reader:
-                                raw_code = row.get('证券代码')
-                                name = row.get('证券名称')
-                                if raw_code and name:
-                                    code = raw_code.strip().split('.')[0]
-                                    self.a_share_map[code] = name.strip()
-                                    loaded_count += 1
-                    except Exception as gbk_e:
-                        print(f"[Warn] CSV GBK load failed: {gbk_e}")
+                if loaded_count > 0:
+                    self._save_a_share_pickle(pickle_path, csv_mtime)
             else:
                  print(f"[Warn] CSV file not found at: {csv_path}")
 
@@ -125,17 +203,102 @@ class PortfolioService:
             
         print(f"[Info] Final A-Share map size: {len(self.a_share_map)}")
 
+    def _load_a_share_pickle(self, pickle_path: str, csv_mtime: float) -> bool:
+        """Warm boot: reuse the map pickled from the last CSV parse if the CSV hasn't changed since."""
+        try:
+            with open(pickle_path, 'rb') as f:
+                cached = pickle.load(f)
+            if cached.get('mtime') != csv_mtime:
+                return False
+            self.a_share_map.update(cached['map'])
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"[Warn] A-share map cache unreadable, re-parsing CSV: {e}")
+            return False
+
+    def _save_a_share_pickle(self, pickle_path: str, csv_mtime: float):
+        try:
+            temp_path = f"{pickle_path}.tmp"
+            with open(temp_path, 'wb') as f:
+                pickle.dump({'mtime': csv_mtime, 'map': self.a_share_map}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, pickle_path)
+        except Exception as e:
+            print(f"[Warn] Failed to write A-share map cache: {e}")
+
+    @staticmethod
+    def _sniff_csv_encoding(csv_path: str) -> str:
+        """Pick the CSV's encoding from its first 64 KB, so the file is parsed exactly once."""
+        with open(csv_path, 'rb') as f:
+            sample = f.read(65536)
+        try:
+            # Incremental decode tolerates a multi-byte character cut off at the sample boundary
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+            return 'utf-8-sig'
+        except UnicodeDecodeError:
+            pass
+        if detect_charset:
+            best = detect_charset(sample).best()
+            if best:
+                return best.encoding
+        # Exported by Chinese Excel / Wind terminals
+        return 'gbk'
+
+    def _read_a_share_csv(self, csv_path: str, encoding: str) -> int:
+        """Bulk-read the CSV's code/name columns into a_share_map (Arrow for UTF-8 when available). Returns rows loaded."""
+        if pacsv is None or encoding != 'utf-8-sig':
+            return self._read_a_share_csv_pandas(csv_path, encoding)
+
+        # Header names may carry stray spaces; resolve the two columns from the raw header
+        with open(csv_path, 'r', encoding='utf-8-sig') as f:
+            columns = {name.strip(): name for name in next(csv.reader([f.readline()]))}
+        code_col, name_col = columns['证券代码'], columns['证券名称']
+
+        table = pacsv.read_csv(
+            csv_path,
+            read_options=pacsv.ReadOptions(block_size=1 << 20),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=[code_col, name_col],
+                # Strings, so codes like 000001 keep their leading zeros
+                column_types={code_col: pa.string(), name_col: pa.string()},
+            ),
+        )
+        # Trim, drop the .SH/.SZ suffix and filter blanks in Arrow kernels; nulls are dropped by filter
+        codes = pc.replace_substring_regex(pc.utf8_trim_whitespace(table.column(code_col)), pattern=r"\..*", replacement="")
+        names = pc.utf8_trim_whitespace(table.column(name_col))
+        valid = pc.and_(pc.greater(pc.utf8_length(codes), 0), pc.greater(pc.utf8_length(names), 0))
+        codes = codes.filter(valid).to_pylist()
+        names = names.filter(valid).to_pylist()
+        self.a_share_map.update(zip(codes, names))
+        return len(codes)
+
+    def _read_a_share_csv_pandas(self, csv_path: str, encoding: str) -> int:
+        """Bulk-read code/name columns into a_share_map (vectorized, no per-row Python loop). Returns rows loaded."""
+        import pandas as pd
+        df = pd.read_csv(csv_path, dtype=str, encoding=encoding)
+        df.columns = df.columns.str.strip()
+        codes = df['证券代码'].fillna('').str.strip().str.split('.', n=1).str[0]
+        names = df['证券名称'].fillna('').str.strip()
+        valid = (codes != '') & (names != '')
+        self.a_share_map.update(zip(codes[valid].tolist(), names[valid].tolist()))
+        return int(valid.sum())
+
     def _load_from_supabase_metadata(self) -> int:
-        """Fetch stock metadata from Supabase table with pagination. Returns count loaded."""
+        """Fetch stock metadata from Supabase table with keyset pagination. Returns count loaded."""
         count = 0
-        offset = 0
+        last_symbol = ""
         batch_size = 1000
         
         print("[Info] Starting Supabase metadata fetch...")
         try:
             while True:
-                # Range is inclusive start, inclusive end
-                response = self.supabase.table("stock_metadata").select("symbol,name").range(offset, offset + batch_size - 1).execute()
+                # Keyset page on the primary key: each page is an index seek past the
+                # last symbol seen, where OFFSET would rescan every earlier row
+                response = (
+                    self.supabase.table("stock_metadata").select("symbol,name")
+                    .gt("symbol", last_symbol).order("symbol").limit(batch_size).execute()
+                )
                 data = response.data
                 
                 if not data:
@@ -150,7 +313,7 @@ class PortfolioService:
                         batch_count += 1
                 
                 count += batch_count
-                offset += batch_size
+                last_symbol = data[-1]['symbol']
                 
                 # If we got less than batch_size, we are done
                 if len(data) < batch_size:
@@ -165,24 +328,51 @@ class PortfolioService:
 
 
     def _init_local_storage(self):
-        """Initialize local JSON file if it doesn't exist."""
-        if not os.path.exists(self.local_file):
-            with open(self.local_file, 'w', encoding='utf-8') as f:
-                json.dump([], f)
+        """Load the local portfolio into memory once (creating the JSON file if needed); mutations flush it back."""
+        self._local_lock = threading.Lock()
+        # Holdings indexed by symbol (dicts keep insertion order, so the file order is stable)
+        try:
+            self._local_by_symbol = {d["symbol"]: d for d in _read_json(self.local_file)}
+        except FileNotFoundError:
+            self._local_by_symbol = {}
+            _write_json(self.local_file, [])
+
+    def _flush_local(self):
+        """Write the in-memory portfolio to disk (caller holds _local_lock)."""
+        _write_json(self.local_file, list(self._local_by_symbol.values()))
 
     def _init_summary_storage(self):
-        """Initialize local summary cache."""
-        if not os.path.exists(self.summary_file):
-            with open(self.summary_file, 'w', encoding='utf-8') as f:
-                json.dump({}, f)
+        """Initialize local summary cache (SQLite, one row per symbol)."""
+        self._summary_lock = threading.Lock()
+        self._summary_mem = {}
+        self.summary_db = sqlite3.connect(self.summary_db_file, check_same_thread=False)
+        self.summary_db.execute("PRAGMA journal_mode=WAL")
+        with self.summary_db:
+            self.summary_db.execute(
+                "CREATE TABLE IF NOT EXISTS summaries(symbol TEXT PRIMARY KEY, summary TEXT, ts INTEGER)"
+            )
+
+        # One-off import of the old JSON cache
+        try:
+            cache = _read_json(self.summary_file)
+            with self._summary_lock, self.summary_db:
+                self.summary_db.executemany(
+                    "INSERT OR IGNORE INTO summaries VALUES (?, ?, ?)",
+                    [(symbol, summary, int(time.time())) for symbol, summary in cache.items()]
+                )
+            os.replace(self.summary_file, f"{self.summary_file}.migrated")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Summary cache migration error: {e}")
 
     def get_portfolio(self, user_id):
         """Retrieve all holdings for a specific user, merging with pinned stocks."""
         holdings = []
         if self.use_supabase:
             try:
-                # 1. Fetch actual holdings
-                response = self.supabase.table("holdings").select("*").eq("user_id", user_id).execute()
+                # 1. Fetch actual holdings (only the columns the UI uses; see supabase_holdings_index.sql)
+                response = self.supabase.table("holdings").select(self.HOLDING_COLUMNS).eq("user_id", user_id).execute()
                 holdings = response.data or []
                 
                 # 2. Fetch pinned stocks
@@ -201,6 +391,7 @@ class PortfolioService:
                     final_list.append(h)
                 
                 # Process pinned stocks that are NOT in holdings
+                now_iso = datetime.utcnow().isoformat()
                 for sym in pinned_symbols:
                     if sym not in holdings_map:
                         # Create a "virtual" holding for the pinned stock
@@ -209,7 +400,7 @@ class PortfolioService:
                             "symbol": sym,
                             "shares": 0,
                             "cost_basis": 0.0,
-                            "updated_at": datetime.utcnow().isoformat(),
+                            "updated_at": now_iso,
                             "is_pinned": True,
                             "name": self.a_share_map.get(sym, sym) # Try to resolve name
                         })
@@ -221,12 +412,9 @@ class PortfolioService:
                 return []
         else:
             try:
-                with open(self.local_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # Add default is_pinned for local mode compatibility
-                    for d in data:
-                        d['is_pinned'] = False
-                    return data
+                with self._local_lock:
+                    # Copies, with default is_pinned for local mode compatibility
+                    return [dict(d, is_pinned=False) for d in self._local_by_symbol.values()]
             except Exception as e:
                 logger.error(f"Local file read error: {e}")
                 return []
@@ -258,21 +446,7 @@ class PortfolioService:
 
     def add_stock(self, user_id, symbol, quantity, cost_basis):
         """Add a stock to the portfolio for a specific user."""
-        symbol = symbol.upper()
-        # Support fractional shares by using float()
-        try:
-            # Supabase shares column is bigint (int8), so we must send int, not float (e.g. 100.0 fails)
-            safe_shares = int(float(quantity))
-        except ValueError:
-            safe_shares = 0
-            
-        record = {
-            "user_id": user_id,
-            "symbol": symbol,
-            "shares": safe_shares,
-            "cost_basis": float(cost_basis),
-            "updated_at": datetime.utcnow().isoformat()
-        }
+        record = self._holding_record(user_id, symbol, quantity, cost_basis)
 
         if self.use_supabase:
             try:
@@ -287,23 +461,78 @@ class PortfolioService:
                 return {"status": "error", "msg": str(e)}
         else:
             try:
-                data = self.get_portfolio(user_id) # Local mode ignores user_id effectively
-                # Check if symbol exists, if so, maybe update?
-                existing = next((item for item in data if item["symbol"] == symbol), None)
-                if existing:
-                    existing["shares"] = safe_shares
-                    existing["cost_basis"] = float(cost_basis)
-                    existing["updated_at"] = datetime.utcnow().isoformat()
-                else:
-                    data.append(record)
-                
-                with open(self.local_file, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2)
+                # Local mode ignores user_id effectively
+                with self._local_lock:
+                    self._upsert_local(record)
+                    self._flush_local()
                 return {"status": "success", "msg": "Saved locally"}
             except Exception as e:
                 logger.error(f"Local file write error: {e}")
                 return {"status": "error", "msg": str(e)}
 
+    def bulk_add_stocks(self, user_id, rows):
+        """
+        Add/update many holdings in one write (e.g. a portfolio import).
+        rows: [{"symbol", "quantity", "cost"}]; a symbol listed twice keeps its last row.
+        """
+        # One row per symbol: Postgres rejects an upsert that touches the same key twice
+        records = {}
+        # One timestamp for the whole batch
+        now_iso = datetime.utcnow().isoformat()
+        for row in rows:
+            record = self._holding_record(user_id, row["symbol"], row["quantity"], row["cost"], now_iso)
+            records[record["symbol"]] = record
+        records = list(records.values())
+        if not records:
+            return {"status": "success", "count": 0}
+
+        if self.use_supabase:
+            try:
+                # Single request: PostgREST upserts the whole array in one statement
+                self.supabase.table("holdings").upsert(records, on_conflict="user_id,symbol").execute()
+                return {"status": "success", "count": len(records)}
+            except Exception as e:
+                logger.error(f"Supabase bulk write error: {e}")
+                return {"status": "error", "msg": str(e)}
+        else:
+            try:
+                with self._local_lock:
+                    for record in records:
+                        self._upsert_local(record)
+                    self._flush_local()
+                return {"status": "success", "count": len(records)}
+            except Exception as e:
+                logger.error(f"Local file write error: {e}")
+                return {"status": "error", "msg": str(e)}
+
+    @staticmethod
+    def _holding_record(user_id, symbol, quantity, cost_basis, updated_at=None):
+        # Support fractional shares by using float()
+        try:
+            # Supabase shares column is bigint (int8), so we must send int, not float (e.g. 100.0 fails)
+            safe_shares = int(float(quantity))
+        except ValueError:
+            safe_shares = 0
+            
+        return {
+            "user_id": user_id,
+            "symbol": symbol.upper(),
+            "shares": safe_shares,
+            "cost_basis": float(cost_basis),
+            "updated_at": updated_at or datetime.utcnow().isoformat()
+        }
+
+    def _upsert_local(self, record):
+        """Insert or update one holding in the in-memory portfolio (caller holds _local_lock)."""
+        # Check if symbol exists, if so, maybe update?
+        existing = self._local_by_symbol.get(record["symbol"])
+        if existing:
+            existing["shares"] = record["shares"]
+            existing["cost_basis"] = record["cost_basis"]
+            existing["updated_at"] = record["updated_at"]
+        else:
+            self._local_by_symbol[record["symbol"]] = record
+
     def update_stock(self, user_id, symbol, quantity, cost_basis):
         """Update an existing stock in the portfolio."""
         return self.add_stock(user_id, symbol, quantity, cost_basis)
@@ -319,10 +548,9 @@ class PortfolioService:
                 return {"status": "error", "msg": str(e)}
         else:
             try:
-                data = self.get_portfolio(user_id)
-                data = [d for d in data if d["symbol"] != symbol]
-                with open(self.local_file, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2)
+                with self._local_lock:
+                    self._local_by_symbol.pop(symbol, None)
+                    self._flush_local()
                 return {"status": "success"}
             except Exception as e:
                 return {"status": "error", "msg": str(e)}
@@ -330,52 +558,112 @@ class PortfolioService:
     def get_company_summary(self, symbol):
         """Get one-sentence company summary, using cache or Gemini AI."""
         if not symbol: return ""
+
+        # 0. Already served by this process
+        cached_summary = self._summary_mem.get(symbol)
+        if cached_summary is not None and not self._should_refresh_summary(symbol, cached_summary):
+            return cached_summary
         
         # 1. Try Cache
-        cache = {}
+        cached_summary = None
         try:
-            if os.path.exists(self.summary_file):
-                with open(self.summary_file, 'r', encoding='utf-8') as f:
-                    cache = json.load(f)
+            with self._summary_lock:
+                row = self.summary_db.execute("SELECT summary FROM summaries WHERE symbol = ?", (symbol,)).fetchone()
+            if row:
+                cached_summary = row[0]
         except Exception as e:
             logger.error(f"Summary cache read error: {e}")
 
-        if symbol in cache:
-            cached_summary = cache[symbol]
-            # [Validation] If we have a mapped name, ensure the summary is high quality
-            # If mapped name exists but summary doesn't contain it (likely old/generic summary), force refresh.
-            # Also refresh if it looks like an error.
-            should_refresh = False
-            
-            if cached_summary.startswith("AI Generation Error") or cached_summary.startswith("Network Error"):
-                should_refresh = True
-            elif symbol.isdigit() and symbol in self.a_share_map:
-                mapped_name = self.a_share_map[symbol]
-                # Simple heuristic: if the Chinese name isn't in the summary, it might be an old summary
-                # (unless summary is very short).
-                # But to be safe, let's just trust the cache unless it's an error, 
-                # OR if the user specifically requests a refresh (not implemented yet).
-                # actually, let's just force refresh if it's "API Key Missing" or similar
-                if "API Key Missing" in cached_summary:
-                    should_refresh = True
-            
-            if not should_refresh:
-                return cached_summary
+        if cached_summary is not None and not self._should_refresh_summary(symbol, cached_summary):
+            self._remember_summary(symbol, cached_summary)
+            return cached_summary
 
         # 2. Fetch from Gemini
         summary = self._fetch_gemini_summary(symbol)
         
         # 3. Save to Cache
-        if summary and not summary.startswith("API Error") and summary != "Network Error" and summary != "AI Generation Error":
-            cache[symbol] = summary
-            try:
-                with open(self.summary_file, 'w', encoding='utf-8') as f:
-                    json.dump(cache, f, indent=2, ensure_ascii=False)
-            except Exception as e:
-                logger.error(f"Summary cache write error: {e}")
+        self._store_summaries({symbol: summary})
         
         return summary
 
+    def get_company_summaries(self, symbols):
+        """
+        Summaries for several symbols at once: {symbol: summary}.
+        One cache query for all of them, then the missing ones are generated concurrently
+        and stored in a single transaction.
+        """
+        symbols = [s for s in dict.fromkeys(symbols) if s]
+        results = {}
+        pending = []
+        for symbol in symbols:
+            cached_summary = self._summary_mem.get(symbol)
+            if cached_summary is not None and not self._should_refresh_summary(symbol, cached_summary):
+                results[symbol] = cached_summary
+            else:
+                pending.append(symbol)
+
+        if pending:
+            try:
+                placeholders = ",".join("?" * len(pending))
+                with self._summary_lock:
+                    rows = self.summary_db.execute(
+                        f"SELECT symbol, summary FROM summaries WHERE symbol IN ({placeholders})", pending
+                    ).fetchall()
+                for symbol, cached_summary in rows:
+                    if not self._should_refresh_summary(symbol, cached_summary):
+                        self._remember_summary(symbol, cached_summary)
+                        results[symbol] = cached_summary
+            except Exception as e:
+                logger.error(f"Summary cache read error: {e}")
+
+        missing = [s for s in pending if s not in results]
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.MAX_PARALLEL_SUMMARIES, len(missing))) as ex:
+                fetched = dict(zip(missing, ex.map(self._fetch_gemini_summary, missing)))
+            self._store_summaries(fetched)
+            results.update(fetched)
+
+        return {s: results[s] for s in symbols}
+
+    def _should_refresh_summary(self, symbol, cached_summary):
+        # [Validation] If we have a mapped name, ensure the summary is high quality
+        # If mapped name exists but summary doesn't contain it (likely old/generic summary), force refresh.
+        # Also refresh if it looks like an error.
+        if cached_summary.startswith(_SUMMARY_ERROR_PREFIXES):
+            return True
+        if symbol in self.a_share_map:
+            # Simple heuristic: if the Chinese name isn't in the summary, it might be an old summary
+            # (unless summary is very short).
+            # But to be safe, let's just trust the cache unless it's an error, 
+            # OR if the user specifically requests a refresh (not implemented yet).
+            # actually, let's just force refresh if it's "API Key Missing" or similar
+            return "API Key Missing" in cached_summary
+        return False
+
+    def _store_summaries(self, summaries):
+        """Persist successfully generated summaries in one transaction (errors are never cached)."""
+        rows = [
+            (symbol, summary, int(time.time())) for symbol, summary in summaries.items()
+            if summary and not summary.startswith(_SUMMARY_ERROR_PREFIXES)
+        ]
+        if not rows:
+            return
+        try:
+            with self._summary_lock, self.summary_db:
+                self.summary_db.executemany("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)", rows)
+            for symbol, summary, _ in rows:
+                self._remember_summary(symbol, summary)
+        except Exception as e:
+            logger.error(f"Summary cache write error: {e}")
+
+    def _remember_summary(self, symbol, summary):
+        with self._summary_lock:
+            # Re-insert so the entry moves to the newest end
+            self._summary_mem.pop(symbol, None)
+            if len(self._summary_mem) >= self.SUMMARY_MEMORY_SIZE:
+                self._summary_mem.pop(next(iter(self._summary_mem)))
+            self._summary_mem[symbol] = summary
+
     def _fetch_gemini_summary(self, symbol):
         """Call Gemini API for summary."""
         if not self.gemini_client:
@@ -395,26 +683,19 @@ class PortfolioService:
             #     except Exception as e:
             #         logger.warning(f"Failed to fetch company name for {symbol}: {e}")
             
-            # Use specific context for A-Shares
-            if symbol.isdigit():
-                # Try to get name from CSV map
-                company_name = self.a_share_map.get(symbol)
-                if company_name:
-                    prompt_text = f"请用一句话简明扼要地总结 A股上市公司“{company_name}” ({symbol}) 的主要业务和行业地位（不要废话，直接说重点）。"
-                else:
-                    prompt_text = f"请用一句话简明扼要地总结 A股代码为 {symbol} 的公司的主要业务和行业地位（不要废话，直接说重点）。"
+            # Use specific context for A-Shares (the name map only holds A-share codes)
+            company_name = self.a_share_map.get(symbol)
+            if company_name:
+                prompt_text = _SUMMARY_PROMPT_NAMED.format(name=company_name, symbol=symbol)
+            elif symbol.isdigit():
+                prompt_text = _SUMMARY_PROMPT_A_SHARE.format(symbol=symbol)
             else:
-                prompt_text = f"请用一句话简明扼要地总结股票代码为 {symbol} 的公司的主要业务和行业地位（不要废话，直接说重点）。"
+                prompt_text = _SUMMARY_PROMPT.format(symbol=symbol)
 
             # Use the configured Gemini client
             response = self.gemini_client.generate_content(
                 prompt_text,
-                safety_settings=[
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                ]
+                safety_settings=_SAFETY_SETTINGS
             )
             
             if response and response.text:
@@ -426,60 +707,79 @@ class PortfolioService:
             logger.error(f"Gemini Fetch Exception: {e}")
             return f"Network Error: {str(e)}"
 
+    # Images larger than this go through the Files API instead of inline in the request
+    INLINE_IMAGE_MAX_BYTES = 1 << 20
+
+    def _image_part(self, image_data):
+        """Gemini Part for a base64 image (optionally a data URL, whose mime type is used)."""
+        from google.genai import types
+        mime_type = "image/png"
+        # Remove header if present (e.g. "data:image/png;base64,...")
+        if "," in image_data:
+            header, image_data = image_data.split(",", 1)
+            if header.startswith("data:"):
+                mime_type = header[5:].split(";", 1)[0] or mime_type
+
+        image_bytes = base64.b64decode(image_data)
+        if len(image_bytes) <= self.INLINE_IMAGE_MAX_BYTES:
+            return types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
+
+        # Large screenshots: upload once and reference by URI, keeping the generate request small
+        uploaded = self.new_client.files.upload(
+            file=io.BytesIO(image_bytes),
+            config=types.UploadFileConfig(mime_type=mime_type)
+        )
+        return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type or mime_type)
+
+    def _chat_context(self, symbol, selected_file_ids):
+        """Return (system_instruction, knowledge_context) for a chat turn about symbol."""
+        stock_context = symbol
+        company_name = self.a_share_map.get(symbol)
+        if company_name:
+            stock_context = f"{company_name} ({symbol})"
+
+        market_context = "China A-Share" if symbol.isdigit() else "US Stock"
+
+        # Knowledge Base Context
+        knowledge_context = ""
+        if selected_file_ids:
+            try:
+                ks = get_knowledge_service()
+                docs_text = ks.get_documents_content(selected_file_ids)
+                if docs_text:
+                    knowledge_context = f"\n\n[USER UPLOADED KNOWLEDGE BASE]\n{docs_text}\n[END KNOWLEDGE BASE]\n"
+            except Exception as e:
+                logger.error(f"Knowledge injection failed: {e}")
+
+        # System prompt to set behavior
+        system_instruction = _ADVISOR_CHAT_INSTRUCTIONS.get(symbol)
+        if system_instruction is None:
+            system_instruction = _STOCK_CHAT_INSTRUCTION.format(market=market_context, stock=stock_context)
+        return system_instruction, knowledge_context
+
+    @staticmethod
+    def _chat_message(system_instruction, knowledge_context, message, history):
+        """Build the user turn sent through the legacy chat session."""
+        if not history:
+            return f"{system_instruction}{knowledge_context}\n\nUser Question: {message}"
+        return f"{knowledge_context}\n{message}" if knowledge_context else message
+
     def chat_with_gemini(self, symbol, message, history=[], selected_file_ids=[], model_name="gemini-2.5-flash", image_data=None):
         """Interactive chat about a specific stock with knowledge base support."""
         if not self.gemini_key:
             return "API Key Missing or Client Not Initialized"
 
         try:
-            # Context preparation
-            stock_context = symbol
-            if symbol.isdigit() and symbol in self.a_share_map:
-                stock_context = f"{self.a_share_map[symbol]} ({symbol})"
-
-            market_context = "China A-Share" if symbol.isdigit() else "US Stock"
+            system_instruction, knowledge_context = self._chat_context(symbol, selected_file_ids)
 
-            # Knowledge Base Context
-            knowledge_context = ""
-            if selected_file_ids:
-                try:
-                    ks = KnowledgeService()
-                    docs_text = ks.get_documents_content(selected_file_ids)
-                    if docs_text:
-                        knowledge_context = f"\n\n[USER UPLOADED KNOWLEDGE BASE]\n{docs_text}\n[END KNOWLEDGE BASE]\n"
-                except Exception as e:
-                    logger.error(f"Knowledge injection failed: {e}")
-
-            # System prompt to set behavior
-            if symbol == "MACRO":
-                system_instruction = (
-                    "You are the Chief Macro Economic Advisor (首席宏观经济顾问). "
-                    "Your goal is to analyze the Global and Chinese economic environment (Policy, GDP, Interest Rates, Geopolitics). "
-                    "Do NOT discuss individual stock technicals unless they reflect a broad trend. "
-                    "When giving judgments, TRY to categorize them into: Short-term (1-3mo), Medium-term (3-12mo), and Long-term (1-3yr)."
-                )
-            elif symbol == "STRATEGY":
-                system_instruction = (
-                    "You are the Chief Investment Strategist (首席投资策略顾问). "
-                    "Your goal is to provide advice on Asset Allocation, Sector Rotation, and Risk Management. "
-                    "Focus on *how* to invest (position sizing, timing, hedging) rather than just *what* to buy. "
-                    "When giving judgments, TRY to categorize them into: Short-term (1-3mo), Medium-term (3-12mo), and Long-term (1-3yr)."
-                )
-            else:
-                system_instruction = f"You are a financial analysis assistant. You are discussing the {market_context} {stock_context}. Answer questions specifically about this company, its financials, news, or technicals. Keep answers concise and professional."
-            
             # --- IMAGE HANDLING (NEW SDK) ---
             if image_data:
                 if not self.new_client:
                     return "New Gemini Client initialization failed."
                 
                 try:
-                    # Decode Base64 Image
-                    # Remove header if present (e.g. "data:image/png;base64,...")
-                    if "," in image_data:
-                        image_data = image_data.split(",")[1]
-                    
-                    image_bytes = base64.b64decode(image_data)
+                    from google.genai import types
+                    image_part = self._image_part(image_data)
                     
                     # Construct Content with Image
                     # We treat this as a stateless call with history included in contents if possible,
@@ -510,7 +810,7 @@ class PortfolioService:
                     if message:
                         current_parts.append(types.Part.from_text(text=message))
                     
-                    current_parts.append(types.Part.from_bytes(data=image_bytes, mime_type="image/png"))
+                    current_parts.append(image_part)
                     
                     contents.append(types.Content(role='user', parts=current_parts))
                     
@@ -533,25 +833,16 @@ class PortfolioService:
 
             # --- TEXT ONLY HANDLING (LEGACY SDK) ---
             # Initialize specified model
-            client = genai.GenerativeModel(model_name)
+            client = _legacy_genai().GenerativeModel(model_name)
             
             # Start chat session
             chat = client.start_chat(history=history)
             
-            # Construct full message
-            if not history:
-                full_message = f"{system_instruction}{knowledge_context}\n\nUser Question: {message}"
-            else:
-                full_message = f"{knowledge_context}\n{message}" if knowledge_context else message
+            full_message = self._chat_message(system_instruction, knowledge_context, message, history)
 
             response = chat.send_message(
                 full_message,
-                safety_settings=[
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                ]
+                safety_settings=_SAFETY_SETTINGS
             )
             
             if response and response.text:
@@ -563,3 +854,48 @@ class PortfolioService:
             logger.error(f"Gemini Chat Exception: {e}")
             return f"Error: {str(e)}"
 
+    def chat_with_gemini_stream(self, symbol, message, history=[], selected_file_ids=[], model_name="gemini-2.5-flash", image_data=None):
+        """Like chat_with_gemini, but yields the reply in chunks as Gemini produces them."""
+        if image_data:
+            # Image turns go through the new SDK in one shot
+            yield self.chat_with_gemini(symbol, message, history, selected_file_ids, model_name, image_data)
+            return
+
+        if not self.gemini_key:
+            yield "API Key Missing or Client Not Initialized"
+            return
+
+        try:
+            system_instruction, knowledge_context = self._chat_context(symbol, selected_file_ids)
+            chat = _legacy_genai().GenerativeModel(model_name).start_chat(history=history)
+            full_message = self._chat_message(system_instruction, knowledge_context, message, history)
+
+            response = chat.send_message(
+                full_message,
+                safety_settings=_SAFETY_SETTINGS,
+                stream=True
+            )
+
+            produced = False
+            for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunk carries no text part (e.g. only a finish reason)
+                    continue
+                if text:
+                    produced = True
+                    yield text
+
+            if not produced:
+                yield "AI No Response"
+
+        except Exception as e:
+            logger.error(f"Gemini Chat Stream Exception: {e}")
+            yield f"Error: {str(e)}"
+
+
+@lru_cache(maxsize=1)
+def get_portfolio_service() -> PortfolioService:
+    """Process-wide PortfolioService: the name map, summary store and Supabase client are set up once."""
+    return PortfolioService()
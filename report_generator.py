@@ -1,18 +1,34 @@
 import os
-import io
+import html
+import hashlib
 import logging
 import time
+import threading
+import tempfile
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
 import markdown
-from weasyprint import HTML, CSS
-from weasyprint.text.fonts import FontConfiguration
+from functools import lru_cache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# mistune parses long reports several times faster than python-markdown; optional
+try:
+    import mistune
+except ImportError:
+    mistune = None
+
 # --- Configuration ---
 FONTS_DIR = os.path.join(os.path.dirname(__file__), 'fonts')
 
+# "weasyprint" (default) or "chromium": headless Chromium via Playwright, whose native layout
+# engine is much faster on long reports. Falls back to WeasyPrint if Chromium cannot render.
+PDF_BACKEND = os.environ.get("PDF_BACKEND", "weasyprint").strip().lower()
+
 # Standard CSS for WeasyPrint
 # Note: WeasyPrint handles @page and standard CSS3 remarkably well.
 REPORT_CSS = """
@@ -120,10 +136,74 @@ blockquote {
 }
 """
 
+# Chat lines look like "[role]: content"; deletes the bracket in one pass
+_ROLE_STRIP = str.maketrans('', '', '[')
+
+# Inline styles for chat bubbles, (wrapper, bubble) per role; anything but USER renders as MODEL
+_CHAT_BUBBLE_STYLES = {
+    'USER': (
+        "text-align: right; margin-bottom: 15px;",
+        "display: inline-block; text-align: left; background-color: #1e293b; color: #ffffff; padding: 10px 15px; border-radius: 8px; max-width: 80%;",
+    ),
+    'MODEL': (
+        "text-align: left; margin-bottom: 15px;",
+        "display: inline-block; text-align: left; background-color: #f1f5f9; color: #1e293b; padding: 10px 15px; border-radius: 8px; max-width: 80%; border: 1px solid #e2e8f0;",
+    ),
+}
+
+# Extensions per converter kind: full reports also get fenced code blocks
+_MARKDOWN_EXTENSIONS = {
+    'report': ['tables', 'fenced_code', 'nl2br'],
+    'chat': ['tables', 'nl2br'],
+}
+_markdown_local = threading.local()
+
+def _markdown_converter(kind):
+    """
+    Reusable markdown.Markdown instance for this thread (instances keep per-document state,
+    so they cannot be shared across threads). Call .reset() before each convert().
+    """
+    converters = getattr(_markdown_local, 'converters', None)
+    if converters is None:
+        converters = _markdown_local.converters = {}
+    converter = converters.get(kind)
+    if converter is None:
+        converter = converters[kind] = markdown.Markdown(extensions=_MARKDOWN_EXTENSIONS[kind])
+    return converter
+
+@lru_cache(maxsize=1)
+def _mistune_renderer():
+    # Same output contract as the python-markdown path: raw HTML passes through, single newlines become <br>
+    return mistune.create_markdown(escape=False, hard_wrap=True, plugins=['table', 'strikethrough', 'url'])
+
+def _render_markdown(text, kind):
+    """Markdown -> HTML for a report ('report') or a chat message ('chat'), via mistune when installed."""
+    if mistune:
+        return _mistune_renderer()(text)
+    return _markdown_converter(kind).reset().convert(text)
+
+# Raw HTML comment placed between chat messages so the whole chat renders in one Markdown pass
+_CHAT_SEPARATOR = "<!--chat-message-break-->"
+
+def _render_chat_markdown(contents):
+    """
+    HTML for each chat message, rendered in a single Markdown call and split afterwards.
+    Falls back to one call per message if the pieces don't line up (e.g. an unclosed code
+    fence swallowed a separator) or a message already contains the separator.
+    """
+    if len(contents) > 1 and not any(_CHAT_SEPARATOR in c for c in contents):
+        joined = f"\n\n{_CHAT_SEPARATOR}\n\n".join(contents)
+        parts = _render_markdown(joined, 'chat').split(_CHAT_SEPARATOR)
+        if len(parts) == len(contents):
+            return parts
+    return [_render_markdown(c, 'chat') for c in contents]
+
+@lru_cache(maxsize=1)
 def _get_font_path():
     """
     Resolve the absolute path to the Serif font.
     Prioritizes 'serif.ttf', falls back to 'yahei.ttf', then system fallback.
+    Resolved once per process; the fonts/ directory does not change at runtime.
     """
     serif = os.path.join(FONTS_DIR, 'serif.ttf')
     yahei = os.path.join(FONTS_DIR, 'yahei.ttf')
@@ -143,56 +223,220 @@ def _get_font_path():
     # WeasyPrint expects forward slashes even on Windows for file:// URLs
     return selected_font.replace('\\', '/')
 
-def create_markdown_pdf(symbol, markdown_text) -> bytes:
+@lru_cache(maxsize=1)
+def _weasyprint():
     """
-    Generate PDF using WeasyPrint (The Gold Standard for Python HTML->PDF).
+    (HTML, CSS, FontConfiguration), imported on first use: WeasyPrint pulls in pango/cairo
+    bindings, which processes that never render a PDF (or render with Chromium) can skip.
     """
-    t_start = time.time()
+    from weasyprint import HTML, CSS
+    from weasyprint.text.fonts import FontConfiguration
+    return HTML, CSS, FontConfiguration
+
+@lru_cache(maxsize=1)
+def _get_report_css_text():
+    """REPORT_CSS with the font path filled in (or the @font-face src dropped if no font is found)."""
+    font_path = _get_font_path()
+    if font_path:
+        # Inject font path into CSS
+        return REPORT_CSS % {'serif_font_path': font_path}
+    # Fallback CSS without custom font face
+    logger.warning("[PDF] Generating without custom font.")
+    return REPORT_CSS.replace("src: url('file://%(serif_font_path)s');", "")
+
+@lru_cache(maxsize=1)
+def _get_report_css():
+    """
+    Shared (FontConfiguration, CSS) pair for every PDF.
+    Substituting REPORT_CSS and letting WeasyPrint parse it (and register the @font-face)
+    happens once per process instead of once per document.
+    """
+    _, CSS, FontConfiguration = _weasyprint()
+    font_config = FontConfiguration()
+    return font_config, CSS(string=_get_report_css_text(), font_config=font_config)
+
+# Chromium can't draw @page margin boxes, so the page number comes from its own footer template
+_CHROMIUM_FOOTER = (
+    '<div style="width: 100%; text-align: center; font-size: 9pt; color: #64748b;">'
+    'Page <span class="pageNumber"></span></div>'
+)
+
+# Playwright's sync API is bound to the thread that started it, so a single worker thread
+# owns the browser and every Chromium render is handed to it
+_chromium_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chromium-pdf")
+_chromium_browser = None
+
+def _chromium_pdf(full_html):
+    """Render full_html with the persistent headless Chromium. Runs on _chromium_executor only."""
+    global _chromium_browser
+    if _chromium_browser is None or not _chromium_browser.is_connected():
+        from playwright.sync_api import sync_playwright
+        _chromium_browser = sync_playwright().start().chromium.launch()
+        logger.info("[PDF] Headless Chromium started")
+
+    # Chromium only loads the file:// font from a file:// page, so the HTML goes through a temp file
+    page_html = full_html.replace("</head>", f"<style>{_get_report_css_text()}</style></head>", 1)
+    with tempfile.NamedTemporaryFile('w', suffix='.html', encoding='utf-8', delete=False) as f:
+        f.write(page_html)
+        html_path = f.name
+
+    context = _chromium_browser.new_context()
     try:
-        # 1. Font Configuration
-        font_path = _get_font_path()
-        css_str = ""
-        
-        if font_path:
-            # Inject font path into CSS
-            css_str = REPORT_CSS % {'serif_font_path': font_path}
-        else:
-            # Fallback CSS without custom font face
-            logger.warning("[PDF] Generating without custom font.")
-            css_str = REPORT_CSS.replace("src: url('file://%(serif_font_path)s');", "")
-
-        # 2. Convert Markdown to HTML
-        html_body = markdown.markdown(
-            markdown_text, 
-            extensions=['tables', 'fenced_code', 'nl2br']
+        page = context.new_page()
+        page.goto(Path(html_path).as_uri(), wait_until="load")
+        return page.pdf(
+            format="A4",
+            prefer_css_page_size=True,
+            print_background=True,
+            display_header_footer=True,
+            header_template="<span></span>",
+            footer_template=_CHROMIUM_FOOTER
         )
-        
-        # 3. Build Complete HTML
-        full_html = f"""
+    finally:
+        context.close()
+        os.remove(html_path)
+
+def _write_pdf(full_html, base_url=None) -> bytes:
+    """Render a complete HTML document to PDF bytes with the configured backend."""
+    if PDF_BACKEND == "chromium":
+        try:
+            return _chromium_executor.submit(_chromium_pdf, full_html).result()
+        except Exception as e:
+            logger.warning(f"[PDF] Chromium backend failed ({e}), falling back to WeasyPrint")
+
+    font_config, stylesheet = _get_report_css()
+    HTML = _weasyprint()[0]
+    return HTML(string=full_html, base_url=base_url).write_pdf(
+        stylesheets=[stylesheet],
+        font_config=font_config
+    )
+
+# Static pieces of the report page; only the symbol (twice) and the rendered body vary per call
+_REPORT_HTML_HEAD = """
         <!DOCTYPE html>
         <html>
         <head>
             <meta charset="UTF-8">
-            <title>{symbol} Report</title>
+            <title>"""
+_REPORT_HTML_TITLE = """ Report</title>
         </head>
         <body>
             <div style="text-align: center; margin-bottom: 40px;">
-                <h1>{symbol} 深度投资价值分析报告</h1>
+                <h1>"""
+_REPORT_HTML_BODY = """ 深度投资价值分析报告</h1>
                 <p style="color: #64748b; font-size: 12pt;">AI Deep Research Agent</p>
             </div>
-            {html_body}
+            """
+_REPORT_HTML_TAIL = """
         </body>
         </html>
         """
+
+# PDF rendering (markdown + layout) is CPU-bound and single-threaded per document;
+# independent reports render in worker processes so concurrent requests use separate cores.
+# Sized by env, not os.cpu_count(): that counts host cores, not the container's CPU quota.
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", 2))
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def _warmup_pdf_worker():
+    """Pool initializer: font lookup and stylesheet parsing happen at worker start, not on its first report."""
+    try:
+        _get_report_css()
+    except Exception as e:
+        logger.warning(f"[PDF] Worker warm-up failed: {e}")
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn, not fork: the parent already runs the Gemini loop and other threads
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=max(1, PDF_WORKERS),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warmup_pdf_worker,
+            )
+        return _pdf_pool
+
+def _submit_pdf(symbol, markdown_text) -> Future:
+    """Submit a render, rebuilding the pool once if a dead worker (e.g. OOM-killed) broke it."""
+    global _pdf_pool
+    pool = _get_pdf_pool()
+    try:
+        return pool.submit(create_markdown_pdf, symbol, markdown_text)
+    except BrokenProcessPool:
+        logger.warning("[PDF] Worker pool is broken (a worker died); starting a new one")
+        with _pdf_pool_lock:
+            if _pdf_pool is pool:
+                _pdf_pool = None
+        pool.shutdown(wait=False)
+        return _get_pdf_pool().submit(create_markdown_pdf, symbol, markdown_text)
+
+# Rendered PDFs (as futures) by content digest, so the same report is only rendered once per TTL
+PDF_CACHE_TTL = 3600  # seconds
+PDF_CACHE_SIZE = 64
+_pdf_cache = {}  # digest -> (expires_at, Future)
+_pdf_cache_lock = threading.Lock()
+
+def _pdf_cache_key(symbol, markdown_text) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(symbol).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(markdown_text.encode('utf-8'))
+    return digest.digest()
+
+def _drop_failed_pdf(key, future):
+    # Failures (exception or the b"" failure signal) must not be served from the cache
+    if future.exception() is None and future.result():
+        return
+    with _pdf_cache_lock:
+        entry = _pdf_cache.get(key)
+        if entry and entry[1] is future:
+            del _pdf_cache[key]
+
+def create_markdown_pdf_async(symbol, markdown_text) -> Future:
+    """
+    Run create_markdown_pdf in the shared worker pool.
+    Returns a concurrent.futures.Future of the PDF bytes (asyncio callers: asyncio.wrap_future).
+    Identical (symbol, markdown_text) requests within PDF_CACHE_TTL share one render,
+    including while it is still in flight.
+    """
+    key = _pdf_cache_key(symbol, markdown_text)
+    now = time.monotonic()
+    with _pdf_cache_lock:
+        entry = _pdf_cache.pop(key, None)
+        if entry and entry[0] > now:
+            # Re-insert to mark it most recently used
+            _pdf_cache[key] = entry
+            return entry[1]
+
+        future = _submit_pdf(symbol, markdown_text)
+        if len(_pdf_cache) >= PDF_CACHE_SIZE:
+            # Least recently used first (dicts keep insertion order)
+            _pdf_cache.pop(next(iter(_pdf_cache)))
+        _pdf_cache[key] = (now + PDF_CACHE_TTL, future)
+
+    future.add_done_callback(lambda f: _drop_failed_pdf(key, f))
+    return future
+
+def create_markdown_pdf(symbol, markdown_text) -> bytes:
+    """
+    Generate PDF using WeasyPrint (The Gold Standard for Python HTML->PDF),
+    or headless Chromium when PDF_BACKEND=chromium.
+    """
+    t_start = time.time()
+    try:
+        # 1. Convert Markdown to HTML
+        html_body = _render_markdown(markdown_text, 'report')
+        
+        # 2. Build Complete HTML
+        symbol = html.escape(str(symbol))
+        full_html = "".join((_REPORT_HTML_HEAD, symbol, _REPORT_HTML_TITLE, symbol, _REPORT_HTML_BODY, html_body, _REPORT_HTML_TAIL))
         
-        logger.info(f"[PDF] HTML generated ({len(full_html)} chars). Starting WeasyPrint rendering...")
+        logger.info(f"[PDF] HTML generated ({len(full_html)} chars). Starting {PDF_BACKEND} rendering...")
 
-        # 4. Render PDF
-        font_config = FontConfiguration()
-        pdf_bytes = HTML(string=full_html, base_url=os.path.dirname(__file__)).write_pdf(
-            stylesheets=[CSS(string=css_str, font_config=font_config)],
-            font_config=font_config
-        )
+        # 3. Render PDF
+        pdf_bytes = _write_pdf(full_html, base_url=os.path.dirname(__file__))
         
         t_end = time.time()
         logger.info(f"[PDF] Success! Generated {len(pdf_bytes)} bytes in {t_end - t_start:.2f}s")
@@ -205,43 +449,33 @@ def create_markdown_pdf(symbol, markdown_text) -> bytes:
 
 def create_chat_pdf(symbol, messages) -> bytes:
     """
-    Generate Chat PDF using WeasyPrint.
+    Generate Chat PDF using WeasyPrint (or Chromium, see PDF_BACKEND).
     """
     try:
-        # Re-use font logic
-        font_path = _get_font_path()
-        css_str = ""
-        if font_path:
-            css_str = REPORT_CSS % {'serif_font_path': font_path}
-        else:
-            css_str = REPORT_CSS.replace("src: url('file://%(serif_font_path)s');", "")
-
-        chat_html_body = ""
+        roles, contents = [], []
         for msg in messages:
             if ']: ' in msg:
                 role_part, content = msg.split(']: ', 1)
-                role = role_part.replace('[', '').strip().upper()
+                roles.append(role_part.translate(_ROLE_STRIP).strip().upper())
             else:
-                role = 'UNKNOWN'
+                roles.append('UNKNOWN')
                 content = msg
-            
-            content_html = markdown.markdown(content, extensions=['tables', 'nl2br'])
-            
-            if role == 'USER':
-                wrapper_style = "text-align: right; margin-bottom: 15px;"
-                bubble_style = "display: inline-block; text-align: left; background-color: #1e293b; color: #ffffff; padding: 10px 15px; border-radius: 8px; max-width: 80%;"
-            else:
-                wrapper_style = "text-align: left; margin-bottom: 15px;"
-                bubble_style = "display: inline-block; text-align: left; background-color: #f1f5f9; color: #1e293b; padding: 10px 15px; border-radius: 8px; max-width: 80%; border: 1px solid #e2e8f0;"
+            contents.append(content)
 
-            chat_html_body += f"""
+        chat_parts = []
+        for role, content_html in zip(roles, _render_chat_markdown(contents)):
+            wrapper_style, bubble_style = _CHAT_BUBBLE_STYLES.get(role, _CHAT_BUBBLE_STYLES['MODEL'])
+            role = html.escape(role)
+
+            chat_parts.append(f"""
             <div style="{wrapper_style}">
                 <div style="{bubble_style}">
                     <div style="font-size: 8pt; font-weight: bold; opacity: 0.8; margin-bottom: 4px;">{role}</div>
                     <div style="font-size: 10pt;">{content_html}</div>
                 </div>
             </div>
-            """
+            """)
+        chat_html_body = "".join(chat_parts)
 
         full_html = f"""
         <!DOCTYPE html>
@@ -251,18 +485,14 @@ def create_chat_pdf(symbol, messages) -> bytes:
         </head>
         <body>
             <div style="text-align: center; border-bottom: 1px solid #e2e8f0; padding-bottom: 20px; margin-bottom: 30px;">
-                <h1>{symbol} - AI 对话记录</h1>
+                <h1>{html.escape(str(symbol))} - AI 对话记录</h1>
             </div>
             {chat_html_body}
         </body>
         </html>
         """
 
-        font_config = FontConfiguration()
-        return HTML(string=full_html).write_pdf(
-            stylesheets=[CSS(string=css_str, font_config=font_config)],
-            font_config=font_config
-        )
+        return _write_pdf(full_html)
 
     except Exception as e:
         logger.error(f"[Chat PDF] Error: {e}", exc_info=True)
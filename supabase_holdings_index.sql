@@ -0,0 +1,15 @@
+-- 数据库增量更新脚本 (Supabase Holdings Index SQL)
+-- 目的：加快持仓列表查询 (get_portfolio)
+-- 请在 Supabase Dashboard -> SQL Editor 中运行此脚本
+
+-- 1. 覆盖索引
+-- 说明：get_portfolio 只查询 user_id, symbol, shares, cost_basis, updated_at 五列。
+-- INCLUDE 其余三列后，按 user_id 过滤可以走 index-only scan，无需回表。
+-- 唯一性与表上已有的 UNIQUE(user_id, symbol) 一致，upsert 的 on_conflict 也依赖它。
+CREATE UNIQUE INDEX IF NOT EXISTS idx_holdings_user_symbol_covering
+    ON public.holdings(user_id, symbol) INCLUDE (shares, cost_basis, updated_at);
+
+-- 2. 清理冗余索引
+-- 说明：上面的索引已覆盖 (user_id) 与 (user_id, symbol) 前缀查询。
+DROP INDEX IF EXISTS public.idx_holdings_user_id;
+DROP INDEX IF EXISTS public.idx_holdings_user_symbol;
@@ -2,15 +2,70 @@ import json
 import os
 import uuid
 import time
+import atexit
+import heapq
 import logging
-from datetime import datetime
+import threading
+from datetime import datetime, timezone
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
+# orjson serializes the task store several times faster than the stdlib; optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _iso_utc(ns):
+    """Nanosecond epoch timestamp -> naive UTC ISO string (the format the task API has always returned)."""
+    return datetime.fromtimestamp(ns / 1e9, tz=timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def _ns_from_iso(value):
+    """Parse a stored ISO timestamp (task files written before the switch to *_ns fields)."""
+    try:
+        return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp() * 1e9)
+    except (TypeError, ValueError):
+        return 0
+
+
 class TaskManager:
+    """
+    Deep research task store.
+    Tasks live in memory (authoritative for this process) and are checkpointed to the JSON
+    file: right away when a task is created, completes or fails, otherwise at most every
+    FLUSH_INTERVAL seconds, so frequent progress updates don't rewrite the file each time.
+    """
+    # Seconds a progress-only update may wait before it is written to disk
+    FLUSH_INTERVAL = 2
+    # Statuses that are persisted immediately
+    FLUSH_NOW_STATUSES = ("completed", "failed")
+    # Once more than MAX_TASKS are stored, the oldest are dropped down to KEEP_TASKS
+    MAX_TASKS = 100
+    KEEP_TASKS = 50
+
     def __init__(self, base_path="knowledge_base"):
         self.file_path = os.path.join(base_path, "deep_research_tasks.json")
+        self._lock = threading.RLock()
+        # One writer at a time, so snapshots reach the file in the order they were taken.
+        # Lock order: _write_lock, then _lock; never call flush() while holding _lock.
+        self._write_lock = threading.Lock()
+        self._dirty = threading.Event()
         self._ensure_file()
+        self._tasks = self._load_tasks()
+        for task in self._tasks.values():
+            # Timestamps are kept as integer nanoseconds; convert tasks saved with ISO strings
+            if "created_at_ns" not in task:
+                task["created_at_ns"] = _ns_from_iso(task.pop("created_at", None))
+                task["updated_at_ns"] = _ns_from_iso(task.pop("updated_at", None))
+        # (created_at_ns, task_id) min-heap for evicting the oldest tasks
+        self._creation_heap = [(t["created_at_ns"], task_id) for task_id, t in self._tasks.items()]
+        heapq.heapify(self._creation_heap)
+
+        threading.Thread(target=self._flush_loop, name="task-flusher", daemon=True).start()
+        # Don't lose the last progress tick on a clean shutdown
+        atexit.register(self.flush)
 
     def _ensure_file(self):
         if not os.path.exists(self.file_path):
@@ -21,65 +76,138 @@ class TaskManager:
         try:
             if not os.path.exists(self.file_path):
                 return {}
-            with open(self.file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(self.file_path, 'rb') as f:
+                raw = f.read()
+            return orjson.loads(raw) if orjson else json.loads(raw)
         except Exception as e:
             logger.error(f"Failed to load tasks: {e}")
             return {}
 
-    def _save_tasks(self, tasks):
+    @staticmethod
+    def _serialize(tasks):
+        # Compact on the hot path; indented only when debug logging is on
+        pretty = logger.isEnabledFor(logging.DEBUG)
+        if orjson:
+            return orjson.dumps(tasks, option=orjson.OPT_INDENT_2 if pretty else 0)
+        return json.dumps(tasks, indent=2 if pretty else None, ensure_ascii=False).encode('utf-8')
+
+    def _write_file(self, data):
         try:
             # Atomic write to prevent corruption
             temp_path = f"{self.file_path}.tmp"
-            with open(temp_path, 'w', encoding='utf-8') as f:
-                json.dump(tasks, f, indent=2)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
             os.replace(temp_path, self.file_path)
         except Exception as e:
             logger.error(f"Failed to save tasks: {e}")
 
+    def _flush_loop(self):
+        while True:
+            self._dirty.wait()
+            # Debounce: let a burst of progress updates collapse into one write
+            time.sleep(self.FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        """Write the in-memory tasks to disk if anything changed since the last write."""
+        with self._write_lock:
+            # Snapshot under the task lock; the disk write happens without it, so
+            # progress updates from the Gemini event loop never wait on file I/O
+            with self._lock:
+                if not self._dirty.is_set():
+                    return
+                self._dirty.clear()
+                try:
+                    data = self._serialize(self._tasks)
+                except Exception as e:
+                    logger.error(f"Failed to save tasks: {e}")
+                    return
+            self._write_file(data)
+
     def create_task(self, symbol, mode):
-        tasks = self._load_tasks()
         task_id = str(uuid.uuid4())
-        
-        tasks[task_id] = {
-            "id": task_id,
-            "symbol": symbol,
-            "mode": mode,
-            "status": "pending",
-            "progress": "初始化任务...",
-            "result": None,
-            "error": None,
-            "created_at": datetime.utcnow().isoformat(),
-            "updated_at": datetime.utcnow().isoformat()
-        }
-        
-        self._save_tasks(tasks)
+        now = time.time_ns()
+
+        with self._lock:
+            self._tasks[task_id] = {
+                "id": task_id,
+                "symbol": symbol,
+                "mode": mode,
+                "status": "pending",
+                "progress": "初始化任务...",
+                "result": None,
+                "error": None,
+                "created_at_ns": now,
+                "updated_at_ns": now
+            }
+            heapq.heappush(self._creation_heap, (now, task_id))
+            self._dirty.set()
+        self.flush()
         return task_id
 
-    def update_task(self, task_id, status=None, progress=None, result=None, error=None):
-        tasks = self._load_tasks()
-        if task_id not in tasks:
-            return False
-            
-        if status:
-            tasks[task_id]["status"] = status
-        if progress:
-            tasks[task_id]["progress"] = progress
-        if result:
-            tasks[task_id]["result"] = result
-        if error:
-            tasks[task_id]["error"] = error
-            
-        tasks[task_id]["updated_at"] = datetime.utcnow().isoformat()
-        
-        # Cleanup old tasks (keep last 50) if list gets too long
-        if len(tasks) > 100:
-            sorted_tasks = sorted(tasks.items(), key=lambda x: x[1]['created_at'], reverse=True)
-            tasks = dict(sorted_tasks[:50])
-            
-        self._save_tasks(tasks)
+    def update_task(self, task_id, status=None, progress=None, result=None, error=None, webhook=None):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return False
+
+            if status:
+                task["status"] = status
+            if progress:
+                task["progress"] = progress
+            if result:
+                task["result"] = result
+            if error:
+                task["error"] = error
+            # Internal state of a Deep Research task waiting on its completion callback
+            # (see deep_research_agent): written right away, dropped once the task is finished
+            if webhook:
+                task["webhook"] = webhook
+            if status in self.FLUSH_NOW_STATUSES:
+                task.pop("webhook", None)
+
+            task["updated_at_ns"] = time.time_ns()
+
+            # Cleanup old tasks (keep last 50) if list gets too long
+            if len(self._tasks) > self.MAX_TASKS:
+                while len(self._tasks) > self.KEEP_TASKS and self._creation_heap:
+                    _, old_id = heapq.heappop(self._creation_heap)
+                    self._tasks.pop(old_id, None)
+
+            self._dirty.set()
+        if status in self.FLUSH_NOW_STATUSES or webhook:
+            self.flush()
         return True
 
     def get_task(self, task_id):
-        tasks = self._load_tasks()
-        return tasks.get(task_id)
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            # Copy so the caller can serialize it while the task keeps updating
+            task = dict(task)
+        task.pop("webhook", None)  # internal, not part of the task API
+        # ISO strings are only produced here, for the API response
+        task["created_at"] = _iso_utc(task.pop("created_at_ns"))
+        task["updated_at"] = _iso_utc(task.pop("updated_at_ns"))
+        return task
+
+    def get_webhook(self, task_id):
+        """Stored webhook state of a task that is still processing, or None."""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None or task.get("status") != "processing" or not task.get("webhook"):
+                return None
+            return dict(task["webhook"])
+
+    def webhook_tasks(self):
+        """[(task_id, webhook state)] for every processing task still waiting on a completion callback."""
+        with self._lock:
+            return [(task_id, dict(task["webhook"])) for task_id, task in self._tasks.items()
+                    if task.get("status") == "processing" and task.get("webhook")]
+
+
+@lru_cache(maxsize=1)
+def get_task_manager() -> TaskManager:
+    """Process-wide TaskManager; its in-memory state is the source of truth for this process."""
+    return TaskManager()
@@ -0,0 +1,131 @@
+import analyst_agent
+from analyst_agent import AnalystAgent
+
+
+def test_semantic_cache_scope_tracks_knowledge_and_date(monkeypatch):
+    monkeypatch.setattr(analyst_agent, "_CURRENT_DATE", "2025-01-02")
+    scope = AnalystAgent._semantic_cache_scope("AAPL", "gemini-2.5-pro", "doc A")
+
+    assert scope == AnalystAgent._semantic_cache_scope("AAPL", "gemini-2.5-pro", "doc A")
+    # New uploads change the scope even though they sit past the embedded prefix
+    assert scope != AnalystAgent._semantic_cache_scope("AAPL", "gemini-2.5-pro", "doc A\n\ndoc B")
+    assert scope != AnalystAgent._semantic_cache_scope("MSFT", "gemini-2.5-pro", "doc A")
+
+    monkeypatch.setattr(analyst_agent, "_CURRENT_DATE", "2025-01-03")
+    assert scope != AnalystAgent._semantic_cache_scope("AAPL", "gemini-2.5-pro", "doc A")
+
+
+def test_parse_combined_research_in_order():
+    text = "=== SECTION 1 ===\n- fact a\n\n=== SECTION 2 ===\n- fact b\n"
+    assert AnalystAgent._parse_combined_research(text, 2) == ["- fact a", "- fact b"]
+
+
+def test_parse_combined_research_reordered():
+    text = "=== SECTION 2 ===\n- fact b\n=== SECTION 1 ===\n- fact a"
+    assert AnalystAgent._parse_combined_research(text, 2) == ["- fact a", "- fact b"]
+
+
+def test_parse_combined_research_missing_section():
+    assert AnalystAgent._parse_combined_research("=== SECTION 1 ===\n- fact a", 2) is None
+    assert AnalystAgent._parse_combined_research("=== SECTION 1 ===\n\n=== SECTION 2 ===\n- b", 2) is None
+    assert AnalystAgent._parse_combined_research("no markers at all", 1) is None
+    assert AnalystAgent._parse_combined_research("", 1) is None
+
+
+def test_parse_combined_research_duplicated_marker():
+    text = "=== SECTION 1 ===\n- first\n=== SECTION 1 ===\n- repeat\n=== SECTION 2 ===\n- b"
+    assert AnalystAgent._parse_combined_research(text, 2) == ["- first", "- b"]
+    # An empty duplicate doesn't hide the real body
+    text = "=== SECTION 1 ===\n=== SECTION 1 ===\n- a\n=== SECTION 2 ===\n- b"
+    assert AnalystAgent._parse_combined_research(text, 2) == ["- a", "- b"]
+
+
+def test_parse_combined_research_ignores_preamble_and_extra_sections():
+    text = "Here are the findings:\n=== SECTION 1 ===\n- a\n=== SECTION 2 ===\n- b\n=== SECTION 3 ===\n- c"
+    assert AnalystAgent._parse_combined_research(text, 2) == ["- a", "- b"]
+
+
+def test_apply_combined_research_falls_back_on_count_mismatch():
+    agent = AnalystAgent.__new__(AnalystAgent)
+    written = []
+    agent._write_research_cache = lambda *args: written.append(args)
+    tasks = [("AAPL", "role1", "focus1"), ("AAPL", "role2", "focus2"), ("AAPL", "role3", "focus3")]
+
+    # Brief 1 was cached; briefs 2 and 3 were asked for but only one section came back
+    results = ["cached", None, None]
+    assert agent._apply_combined_research(tasks, "m", results, [1, 2], "=== SECTION 1 ===\n- b") is None
+    assert written == []
+    assert results == ["cached", None, None]
+
+    text = "=== SECTION 1 ===\n- b\n=== SECTION 2 ===\n- c"
+    assert agent._apply_combined_research(tasks, "m", results, [1, 2], text) == ["cached", "- b", "- c"]
+    assert written == [("AAPL", "role2", "focus2", "m", "- b"), ("AAPL", "role3", "focus3", "m", "- c")]
+
+
+def _para(tag, n=20):
+    # n words of 4+ chars: comfortably over CONTEXT_DEDUP_MIN_CHARS
+    return " ".join(f"{tag}{i:03d}" for i in range(n))
+
+
+def test_trim_context_drops_duplicate_paragraphs():
+    a, b = _para("alpha"), _para("beta")
+    # Second copy differs only in whitespace, as re-extracted pages do
+    text = "\n\n".join([a, b, "  " + a.replace(" ", "\n"), "---", "---"])
+    assert analyst_agent._trim_context(text, budget=10_000) == "\n\n".join([a, b, "---", "---"])
+
+
+def test_trim_context_keeps_tail_within_budget():
+    paragraphs = [_para(f"p{i}x") for i in range(10)]
+    cost = analyst_agent.gemini_dispatcher.estimate_tokens(paragraphs[0])
+    # Room for three whole paragraphs and half of a fourth
+    trimmed = analyst_agent._trim_context("\n\n".join(paragraphs), budget=cost * 3 + cost // 2)
+
+    kept = trimmed.split("\n\n")
+    assert kept[1:] == paragraphs[-3:]
+    assert paragraphs[-4].endswith(kept[0]) and 0 < len(kept[0]) < len(paragraphs[-4])
+    assert analyst_agent.gemini_dispatcher.estimate_tokens(trimmed) <= cost * 4
+
+
+def test_trim_context_single_paragraph_over_budget():
+    para = "x" * 4000  # ~1000 tokens
+    trimmed = analyst_agent._trim_context(para, budget=100)
+    assert trimmed == para[-400:]
+    assert analyst_agent.gemini_dispatcher.estimate_tokens(trimmed) <= 100
+
+
+def test_trim_context_empty_and_under_budget():
+    assert analyst_agent._trim_context("", budget=100) == ""
+    assert analyst_agent._trim_context("short\n\ntext", budget=100) == "short\n\ntext"
+
+
+def test_semantic_cache_round_trip(tmp_path):
+    cache = analyst_agent.SemanticReportCache(cache_dir=str(tmp_path), threshold=0.9, ttl=3600)
+    vector = analyst_agent.SemanticReportCache.normalize([1.0, 0.0, 0.0])
+    cache.add("AAPL|m", vector, "report A")
+
+    # Written by rename: no temp files left next to the cache
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["entries.json", "vectors.npy"]
+    reloaded = analyst_agent.SemanticReportCache(cache_dir=str(tmp_path), threshold=0.9, ttl=3600)
+    assert reloaded.lookup("AAPL|m", vector) == "report A"
+    assert reloaded.lookup("MSFT|m", vector) is None
+
+
+def test_async_research_cache_io_runs_off_the_loop():
+    import asyncio
+    import threading
+    agent = AnalystAgent.__new__(AnalystAgent)
+    threads = []
+
+    def read_cache(*args):
+        threads.append(threading.get_ident())
+        return "cached brief"
+    agent._read_research_cache = read_cache
+
+    async def run():
+        loop_thread = threading.get_ident()
+        result = await agent._run_research_task_async("AAPL", "role", "focus")
+        return loop_thread, result
+
+    loop_thread, result = asyncio.run(run())
+    assert result == "cached brief"
+    assert threads and threads[0] != loop_thread
@@ -0,0 +1,166 @@
+import asyncio
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import deep_research_agent
+from deep_research_agent import DeepResearchAgent
+from task_manager import TaskManager
+
+
+class FakeInteractions:
+    def __init__(self):
+        self.status = "in_progress"
+        self.created = []
+
+    async def create(self, **kwargs):
+        self.created.append(kwargs)
+        return SimpleNamespace(id="interaction-1")
+
+    async def get(self, interaction_id):
+        outputs = [SimpleNamespace(text="# Report\n\nbody")] if self.status == "completed" else []
+        return SimpleNamespace(id=interaction_id, status=self.status, outputs=outputs)
+
+
+class FakeKnowledgeService:
+    def __init__(self):
+        self.saved = []
+
+    def save_document(self, symbol, pdf_bytes, filename, doc_type=None, user_id=None, source_text=None):
+        self.saved.append((symbol, pdf_bytes, source_text))
+        return {"id": "doc-1"}
+
+
+def make_agent(monkeypatch, tmp_path):
+    monkeypatch.setattr(deep_research_agent, "WEBHOOK_BASE_URL", "https://example.test/")
+    monkeypatch.setattr(deep_research_agent, "WEBHOOK_SECRET", "s3cret")
+    monkeypatch.setattr(deep_research_agent, "_webhook_tasks", {})
+    monkeypatch.setattr(deep_research_agent, "_webhook_busy", set())
+    # The periodic sweep is exercised directly through asweep_webhook_tasks
+    monkeypatch.setattr(deep_research_agent, "ensure_webhook_sweeper", lambda: None)
+    tm = TaskManager(str(tmp_path))
+    monkeypatch.setattr(deep_research_agent, "get_task_manager", lambda: tm)
+    cache = {}
+    monkeypatch.setattr(deep_research_agent.report_cache, "get", cache.get)
+    monkeypatch.setattr(deep_research_agent.report_cache, "set", lambda key, value, ttl=None: cache.__setitem__(key, value))
+
+    def fake_pdf(symbol, text):
+        future = Future()
+        future.set_result(b"%PDF")
+        return future
+    monkeypatch.setattr(deep_research_agent, "create_markdown_pdf_async", fake_pdf)
+
+    interactions = FakeInteractions()
+    agent = DeepResearchAgent.__new__(DeepResearchAgent)
+    agent.client = SimpleNamespace(aio=SimpleNamespace(interactions=interactions))
+    return agent, interactions, tm, cache
+
+
+def test_webhook_url_round_trip(monkeypatch, tmp_path):
+    make_agent(monkeypatch, tmp_path)
+    url = deep_research_agent.webhook_url_for("task-1")
+    assert url.startswith("https://example.test/api/agent/deep_research_webhook/task-1?token=")
+    token = url.split("token=", 1)[1]
+    assert deep_research_agent.verify_webhook_token("task-1", token)
+    assert not deep_research_agent.verify_webhook_token("task-2", token)
+    assert not deep_research_agent.verify_webhook_token("task-1", "")
+
+
+def test_webhook_completes_task(monkeypatch, tmp_path):
+    agent, interactions, tm, cache = make_agent(monkeypatch, tmp_path)
+    ks = FakeKnowledgeService()
+    task_id = tm.create_task("AAPL", "STOCK")
+    webhook_url = deep_research_agent.webhook_url_for(task_id)
+
+    asyncio.run(agent.arun_task(task_id, "STOCK", "focus", "AAPL", ks, "user-1", webhook_url))
+    assert interactions.created[0]["webhook_config"] == {"uris": [webhook_url]}
+    assert tm.get_task(task_id)["status"] == "processing"
+
+    # An early callback (still running) leaves the task waiting
+    assert asyncio.run(DeepResearchAgent.acomplete_webhook_task(task_id))
+    assert tm.get_task(task_id)["status"] == "processing"
+
+    interactions.status = "completed"
+    assert asyncio.run(DeepResearchAgent.acomplete_webhook_task(task_id))
+    task = tm.get_task(task_id)
+    assert task["status"] == "completed"
+    assert task["result"]["file_record"] == {"id": "doc-1"}
+    assert ks.saved == [("AAPL", b"%PDF", "# Report\n\nbody")]
+    assert list(cache.values()) == ["# Report\n\nbody"]
+
+    # Redelivered callbacks are ignored once the task is finished
+    assert not asyncio.run(DeepResearchAgent.acomplete_webhook_task(task_id))
+
+
+def test_unknown_task_is_ignored(monkeypatch, tmp_path):
+    make_agent(monkeypatch, tmp_path)
+    assert not asyncio.run(DeepResearchAgent.acomplete_webhook_task("missing"))
+
+
+def restart(monkeypatch, tmp_path, interactions, api_key="server-key"):
+    """Drop the in-memory webhook state and reload tasks from disk, as a new process would."""
+    monkeypatch.setattr(deep_research_agent, "_webhook_tasks", {})
+    tm = TaskManager(str(tmp_path))
+    monkeypatch.setattr(deep_research_agent, "get_task_manager", lambda: tm)
+    if api_key:
+        monkeypatch.setenv("GEMINI_API_KEY", api_key)
+    else:
+        monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    monkeypatch.setattr(deep_research_agent, "get_client",
+                        lambda key: SimpleNamespace(aio=SimpleNamespace(interactions=interactions)))
+    ks = FakeKnowledgeService()
+    import knowledge_service
+    monkeypatch.setattr(knowledge_service, "get_knowledge_service", lambda: ks)
+    return tm, ks
+
+
+def test_webhook_task_survives_restart(monkeypatch, tmp_path):
+    agent, interactions, tm, cache = make_agent(monkeypatch, tmp_path)
+    task_id = tm.create_task("AAPL", "STOCK")
+    asyncio.run(agent.arun_task(task_id, "STOCK", "focus", "AAPL", FakeKnowledgeService(), "user-1",
+                                deep_research_agent.webhook_url_for(task_id)))
+    # The webhook state is internal to the task store
+    assert "webhook" not in tm.get_task(task_id)
+
+    tm, ks = restart(monkeypatch, tmp_path, interactions)
+    assert tm.get_webhook(task_id)["interaction_id"] == "interaction-1"
+    interactions.status = "completed"
+    assert asyncio.run(DeepResearchAgent.acomplete_webhook_task(task_id))
+    assert tm.get_task(task_id)["status"] == "completed"
+    assert ks.saved == [("AAPL", b"%PDF", "# Report\n\nbody")]
+    assert tm.get_webhook(task_id) is None and tm.webhook_tasks() == []
+
+
+def test_restored_task_without_api_key_fails(monkeypatch, tmp_path):
+    agent, interactions, tm, cache = make_agent(monkeypatch, tmp_path)
+    task_id = tm.create_task("AAPL", "STOCK")
+    asyncio.run(agent.arun_task(task_id, "STOCK", "focus", "AAPL", FakeKnowledgeService(), "user-1",
+                                deep_research_agent.webhook_url_for(task_id)))
+
+    tm, ks = restart(monkeypatch, tmp_path, interactions, api_key=None)
+    assert asyncio.run(DeepResearchAgent.acomplete_webhook_task(task_id))
+    assert tm.get_task(task_id)["status"] == "failed"
+    assert ks.saved == []
+
+
+def test_sweep_finishes_lost_callbacks_and_fails_stale_tasks(monkeypatch, tmp_path):
+    agent, interactions, tm, cache = make_agent(monkeypatch, tmp_path)
+    ks = FakeKnowledgeService()
+    fresh, stale = tm.create_task("AAPL", "STOCK"), tm.create_task("MSFT", "STOCK")
+    for task_id, symbol in ((fresh, "AAPL"), (stale, "MSFT")):
+        asyncio.run(agent.arun_task(task_id, "STOCK", "focus", symbol, ks, "user-1",
+                                    deep_research_agent.webhook_url_for(task_id)))
+    state = tm.get_webhook(stale)
+    state["submitted_at_ns"] -= (DeepResearchAgent.WEBHOOK_MAX_AGE + 1) * 1_000_000_000
+    tm.update_task(stale, webhook=state)
+
+    # Still running: the sweep only times out the stale task
+    asyncio.run(DeepResearchAgent.asweep_webhook_tasks())
+    assert tm.get_task(fresh)["status"] == "processing"
+    assert tm.get_task(stale)["status"] == "failed"
+    assert stale not in deep_research_agent._webhook_tasks
+
+    # The callback for the fresh task never arrives; the next sweep finishes it
+    interactions.status = "completed"
+    asyncio.run(DeepResearchAgent.asweep_webhook_tasks())
+    assert tm.get_task(fresh)["status"] == "completed"
+    assert tm.webhook_tasks() == []
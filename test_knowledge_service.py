@@ -0,0 +1,39 @@
+from knowledge_service import KnowledgeService
+
+split_budget = KnowledgeService._split_budget
+
+
+def test_split_budget_all_short_docs():
+    assert split_budget([100, 200, 50], 1000) == [100, 200, 50]
+
+
+def test_split_budget_one_huge_doc():
+    # Short docs are kept whole; the huge one gets everything left over
+    assert split_budget([100, 50_000, 200], 1000) == [100, 700, 200]
+
+
+def test_split_budget_several_long_docs_share_evenly():
+    limits = split_budget([5000, 100, 5000, 5000], 1000)
+    assert limits[1] == 100
+    assert sum(limits) == 1000
+    long_limits = [limits[0], limits[2], limits[3]]
+    assert max(long_limits) - min(long_limits) <= 1
+
+
+def test_split_budget_max_chars_below_doc_count():
+    limits = split_budget([10, 10, 10, 10, 10], 3)
+    assert sum(limits) == 3
+    assert all(limit in (0, 1) for limit in limits)
+    assert split_budget([10, 10], 0) == [0, 0]
+
+
+def test_split_budget_never_exceeds_lengths_or_total():
+    lengths = [0, 7, 3000, 42, 999, 1]
+    for max_chars in (0, 5, 100, 1234, 10_000):
+        limits = split_budget(lengths, max_chars)
+        assert all(0 <= limit <= length for limit, length in zip(limits, lengths))
+        assert sum(limits) == min(max_chars, sum(lengths))
+
+
+def test_split_budget_no_docs():
+    assert split_budget([], 1000) == []
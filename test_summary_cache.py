@@ -0,0 +1,90 @@
+from portfolio_service import PortfolioService
+
+
+class FakeModel:
+    """Stands in for the Gemini model: fails while `error` is set, otherwise returns `text`."""
+
+    def __init__(self, error=None, text="平安银行是一家全国性股份制商业银行。"):
+        self.error = error
+        self.text = text
+        self.calls = 0
+
+    def generate_content(self, prompt, safety_settings=None):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return type("Response", (), {"text": self.text})()
+
+
+def make_service(tmp_path, model):
+    # Skip __init__ (Supabase, Gemini, name map); only the summary cache is under test
+    service = PortfolioService.__new__(PortfolioService)
+    service.summary_file = str(tmp_path / "company_summaries.json")
+    service.summary_db_file = str(tmp_path / "company_summaries.db")
+    service.a_share_map = {}
+    service.gemini_client = model
+    service._init_summary_storage()
+    return service
+
+
+def stored_symbols(service):
+    return [row[0] for row in service.summary_db.execute("SELECT symbol FROM summaries")]
+
+
+def test_network_error_is_not_cached(tmp_path):
+    model = FakeModel(error=ConnectionError("timed out"))
+    service = make_service(tmp_path, model)
+
+    assert service.get_company_summary("000001").startswith("Network Error: ")
+    assert stored_symbols(service) == []
+    assert "000001" not in service._summary_mem
+
+    # The next call retries Gemini and caches the real summary
+    model.error = None
+    assert service.get_company_summary("000001") == model.text
+    assert model.calls == 2
+    assert service.get_company_summary("000001") == model.text
+    assert model.calls == 2
+    assert stored_symbols(service) == ["000001"]
+
+
+def test_error_placeholders_are_not_cached(tmp_path):
+    service = make_service(tmp_path, FakeModel())
+    service._store_summaries({
+        "000001": "Network Error: timed out",
+        "000002": "AI Generation Error: No text in response",
+        "000003": "API Key Missing or Client Not Initialized",
+        "000004": "万科是一家房地产开发企业。",
+    })
+    assert stored_symbols(service) == ["000004"]
+    assert list(service._summary_mem) == ["000004"]
+
+
+def test_missing_client_is_not_cached(tmp_path):
+    service = make_service(tmp_path, None)
+    assert service.get_company_summary("AAPL") == "API Key Missing or Client Not Initialized"
+    assert stored_symbols(service) == []
+
+
+def test_error_in_memory_is_refreshed(tmp_path):
+    model = FakeModel()
+    service = make_service(tmp_path, model)
+    # An error that reached the in-memory cache (e.g. from an older process state) is not served
+    service._summary_mem["000001"] = "Network Error: timed out"
+    assert service.get_company_summary("000001") == model.text
+    assert model.calls == 1
+
+
+def test_batch_errors_are_not_cached(tmp_path):
+    model = FakeModel(error=ConnectionError("timed out"))
+    service = make_service(tmp_path, model)
+
+    results = service.get_company_summaries(["000001", "000002"])
+    assert all(v.startswith("Network Error: ") for v in results.values())
+    assert stored_symbols(service) == []
+    assert service._summary_mem == {}
+
+    model.error = None
+    assert service.get_company_summaries(["000001", "000002"]) == {"000001": model.text, "000002": model.text}
+    assert model.calls == 4
+    assert sorted(stored_symbols(service)) == ["000001", "000002"]
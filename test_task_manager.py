@@ -0,0 +1,106 @@
+import itertools
+import json
+import threading
+
+import task_manager
+from task_manager import TaskManager
+
+
+def test_eviction_keeps_newest(tmp_path, monkeypatch):
+    # Strictly increasing timestamps, so "newest" is unambiguous
+    clock = itertools.count(1_700_000_000_000_000_000, 1000)
+    monkeypatch.setattr(task_manager.time, "time_ns", lambda: next(clock))
+    tm = TaskManager(str(tmp_path))
+
+    ids = [tm.create_task(f"S{i}", "STOCK") for i in range(TaskManager.MAX_TASKS + 1)]
+    # Eviction runs on update, once there are more than MAX_TASKS
+    assert tm.update_task(ids[-1], progress="tick")
+
+    assert len(tm._tasks) == TaskManager.KEEP_TASKS
+    assert set(tm._tasks) == set(ids[-TaskManager.KEEP_TASKS:])
+    assert tm.get_task(ids[0]) is None
+
+    # Still consistent after a second round of growth
+    more = [tm.create_task(f"T{i}", "STOCK") for i in range(TaskManager.MAX_TASKS)]
+    tm.update_task(more[-1], progress="tick")
+    assert set(tm._tasks) == set(more[-TaskManager.KEEP_TASKS:])
+
+
+def test_flush_round_trips_through_reload(tmp_path):
+    tm = TaskManager(str(tmp_path))
+    task_id = tm.create_task("AAPL", "STOCK")
+    tm.update_task(task_id, status="processing", progress="研究进行中...")
+    tm.flush()
+
+    reloaded = TaskManager(str(tmp_path)).get_task(task_id)
+    assert reloaded == tm.get_task(task_id)
+    assert reloaded["progress"] == "研究进行中..."
+    assert reloaded["status"] == "processing"
+
+
+def test_progress_is_flushed_by_background_thread(tmp_path, monkeypatch):
+    monkeypatch.setattr(TaskManager, "FLUSH_INTERVAL", 0.01)
+    tm = TaskManager(str(tmp_path))
+    task_id = tm.create_task("AAPL", "STOCK")
+    tm.update_task(task_id, progress="half way")
+
+    path = tmp_path / "deep_research_tasks.json"
+    for _ in range(200):
+        if json.loads(path.read_text(encoding="utf-8"))[task_id]["progress"] == "half way":
+            break
+        threading.Event().wait(0.01)
+    assert json.loads(path.read_text(encoding="utf-8"))[task_id]["progress"] == "half way"
+
+
+def test_old_iso_timestamps_are_migrated(tmp_path):
+    old = {
+        "t1": {
+            "id": "t1", "symbol": "AAPL", "mode": "STOCK", "status": "completed",
+            "progress": "已完成", "result": None, "error": None,
+            "created_at": "2025-01-02T03:04:05", "updated_at": "2025-01-02T03:14:05.500000",
+        }
+    }
+    (tmp_path / "deep_research_tasks.json").write_text(json.dumps(old), encoding="utf-8")
+
+    tm = TaskManager(str(tmp_path))
+    assert "created_at" not in tm._tasks["t1"]
+    task = tm.get_task("t1")
+    assert task["created_at"] == "2025-01-02T03:04:05"
+    assert task["updated_at"] == "2025-01-02T03:14:05.500000"
+
+    # Migrated tasks are stored in the new format on the next write
+    tm.update_task("t1", progress="x", status="completed")
+    stored = json.loads((tmp_path / "deep_research_tasks.json").read_text(encoding="utf-8"))["t1"]
+    assert "created_at_ns" in stored and "created_at" not in stored
+
+
+def test_updates_do_not_wait_for_disk_write(tmp_path, monkeypatch):
+    tm = TaskManager(str(tmp_path))
+    task_id = tm.create_task("AAPL", "STOCK")
+
+    writing, release = threading.Event(), threading.Event()
+    real_write = tm._write_file
+
+    def slow_write(data):
+        writing.set()
+        release.wait(5)
+        real_write(data)
+    monkeypatch.setattr(tm, "_write_file", slow_write)
+
+    tm.update_task(task_id, progress="a")
+    flusher = threading.Thread(target=tm.flush)
+    flusher.start()
+    assert writing.wait(5)
+
+    # The write is stuck; a progress update must still go through immediately
+    updater = threading.Thread(target=tm.update_task, args=(task_id,), kwargs={"progress": "b"})
+    updater.start()
+    updater.join(1)
+    assert not updater.is_alive()
+    assert tm.get_task(task_id)["progress"] == "b"
+
+    release.set()
+    flusher.join(5)
+    tm.flush()
+    stored = json.loads((tmp_path / "deep_research_tasks.json").read_text(encoding="utf-8"))
+    assert stored[task_id]["progress"] == "b"
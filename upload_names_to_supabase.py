@@ -1,69 +1,328 @@
+import io
 import os
+import sys
 import csv
 import time
-from supabase import create_client
+import asyncio
+from itertools import islice
+import httpx
+from supabase import acreate_client, AsyncClientOptions
 from dotenv import load_dotenv
 
+# PyArrow's C++ CSV parser is much faster than csv.DictReader; optional
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.compute as pc
+except ImportError:
+    pa = pacsv = pc = None
+
+# Serializes each batch once, straight to bytes; optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
-# 1. Connect to Supabase
-url = os.environ.get("SUPABASE_URL")
-key = os.environ.get("SUPABASE_KEY")
+csv_path = "A share names.csv"
+table = "stock_metadata"
+BATCH_SIZE = 1000
+# Batches in flight at once; bounds load on PostgREST instead of a fixed sleep between batches
+UPLOAD_CONCURRENCY = 8
+# `--tune`: time a sample at each candidate size and use the fastest per row.
+# Capped at 2000; PostgREST requests of ~5000+ rows start to time out.
+TUNE_BATCH_SIZES = (100, 250, 500, 1000, 2000)
+TUNE_SAMPLE_ROWS = 5000
+CODE_COLUMN = "证券代码"
+NAME_COLUMN = "证券名称"
+# Bytes of CSV parsed per Arrow record batch / read per syscall in the csv fallback
+ARROW_BLOCK_SIZE = 1 << 20
+CSV_BUFFER_SIZE = 1 << 20
+UTF8_BOM = b'\xef\xbb\xbf'
 
-if not url or not key:
-    print("Error: Missing SUPABASE_URL or SUPABASE_KEY")
-    exit(1)
+# Seconds before a single batch request is abandoned
+HTTP_TIMEOUT = 30
+# Throttled batches (429/503) are retried with exponential backoff, honouring Retry-After
+RETRY_ATTEMPTS = 5
+RETRY_MIN_WAIT = 0.5
+RETRY_MAX_WAIT = 8
 
-supabase = create_client(url, key)
 
-# 2. Read CSV
-csv_path = "A share names.csv"
-if not os.path.exists(csv_path):
-    print(f"Error: {csv_path} not found.")
-    exit(1)
+def open_csv_text(path):
+    """Text stream over the CSV with a large read buffer; the UTF-8 BOM is skipped once up front."""
+    raw = open(path, 'rb', buffering=CSV_BUFFER_SIZE)
+    if raw.read(len(UTF8_BOM)) != UTF8_BOM:
+        raw.seek(0)
+    return io.TextIOWrapper(raw, encoding='utf-8', newline='')
 
-print("Reading CSV...")
-rows_to_insert = []
-try:
-    with open(csv_path, mode='r', encoding='utf-8-sig') as f:
+
+def _arrow_pairs(path):
+    """
+    Cleaned, non-empty (code, name) pairs via PyArrow's streaming CSV reader; trimming, the
+    exchange-suffix split and the empty-value filter run on whole columns, one record batch at a time.
+    """
+    # Everything as text: codes must keep their leading zeros. The header is read first
+    # because column names may carry stray whitespace.
+    with open_csv_text(path) as f:
+        header = next(csv.reader(f), [])
+    columns = [name.strip() for name in header]
+    if CODE_COLUMN not in columns or NAME_COLUMN not in columns:
+        return
+    reader = pacsv.open_csv(
+        path,
+        read_options=pacsv.ReadOptions(block_size=ARROW_BLOCK_SIZE),
+        convert_options=pacsv.ConvertOptions(column_types={name: pa.string() for name in header}),
+    )
+    code_idx, name_idx = columns.index(CODE_COLUMN), columns.index(NAME_COLUMN)
+    for batch in reader:
+        # "600000.SH " -> "600000"
+        codes = pc.list_element(pc.split_pattern(pc.utf8_trim_whitespace(batch.column(code_idx)), "."), 0)
+        names = pc.utf8_trim_whitespace(batch.column(name_idx))
+        # One mask per batch drops rows missing either value
+        mask = pc.and_(pc.greater(pc.utf8_length(codes), 0), pc.greater(pc.utf8_length(names), 0))
+        codes, names = codes.filter(mask), names.filter(mask)
+        yield from zip(codes.to_pylist(), names.to_pylist())
+
+
+def _dictreader_pairs(path):
+    """Cleaned, non-empty (code, name) pairs via csv.DictReader."""
+    with open_csv_text(path) as f:
         reader = csv.DictReader(f)
         # Normalize headers
         if reader.fieldnames:
             reader.fieldnames = [name.strip() for name in reader.fieldnames]
-            
+
         for row in reader:
-            raw_code = row.get('证券代码')
-            name = row.get('证券名称')
-            
-            if raw_code and name:
-                code = raw_code.strip().split('.')[0]
-                clean_name = name.strip()
-                
-                rows_to_insert.append({
-                    "symbol": code,
-                    "name": clean_name,
-                    "market": "CN"
-                })
-except Exception as e:
-    print(f"Error reading CSV: {e}")
-    exit(1)
-
-print(f"Found {len(rows_to_insert)} records.")
-
-# 3. Upload to Supabase (Batch)
-BATCH_SIZE = 1000
-table = "stock_metadata"
+            code = (row.get(CODE_COLUMN) or '').strip().split('.')[0]
+            name = (row.get(NAME_COLUMN) or '').strip()
+            if code and name:
+                yield code, name
+
+
+def iter_rows(path):
+    """
+    Yield cleaned rows straight from the CSV, once per symbol (first occurrence wins).
+    Only the set of symbols seen so far is held, not the rows.
+    """
+    seen = set()
+    pairs = _arrow_pairs(path) if pacsv else _dictreader_pairs(path)
+    for code, name in pairs:
+        # Repeated codes would make the upsert hit the same key twice
+        if code in seen:
+            continue
+        seen.add(code)
+
+        yield {
+            "symbol": code,
+            "name": name,
+            "market": "CN"
+        }
+
+
+def throttle_wait(e):
+    """Server-requested wait (seconds) if e is a 429/503 backpressure error, else None."""
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None) or getattr(e, "code", None)
+    if str(status) not in ("429", "503"):
+        return None
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+async def upload_batches(send, rows, batch_size=BATCH_SIZE):
+    """
+    Upload rows (any iterable) in batches as they are read, with at most UPLOAD_CONCURRENCY
+    batches in flight; the next batch is only read once a slot frees up. Returns rows sent.
+    """
+    sem = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    pending = set()
+
+    async def upload(start, batch):
+        try:
+            for attempt in range(RETRY_ATTEMPTS):
+                try:
+                    await send(batch)
+                    print(f"Uploaded batch {start} - {start+len(batch)}")
+                    return
+                except Exception as e:
+                    wait = throttle_wait(e)
+                    if wait is None or attempt == RETRY_ATTEMPTS - 1:
+                        print(f"Error uploading batch {start}: {e}")
+                        return
+                    # Only back off when the server asks; the slot stays held so other batches slow down too
+                    wait = max(wait, min(RETRY_MAX_WAIT, RETRY_MIN_WAIT * 2 ** attempt))
+                    print(f"[Retry] Batch {start} throttled; retrying in {wait:.1f}s")
+                    await asyncio.sleep(wait)
+        finally:
+            sem.release()
+
+    rows = iter(rows)
+    sent = 0
+    while batch := list(islice(rows, batch_size)):
+        await sem.acquire()
+        task = asyncio.create_task(upload(sent, batch))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        sent += len(batch)
+
+    if pending:
+        await asyncio.gather(*pending)
+    return sent
 
-print("Starting upload to Supabase...")
-for i in range(0, len(rows_to_insert), BATCH_SIZE):
-    batch = rows_to_insert[i : i + BATCH_SIZE]
+
+async def tune_batch_size(send, sample):
+    """Upload sample once per candidate size (upserts are idempotent); return the size with the lowest time per row."""
+    best_size, best_cost = BATCH_SIZE, None
+    for size in TUNE_BATCH_SIZES:
+        t0 = time.perf_counter()
+        await upload_batches(send, sample, size)
+        cost = (time.perf_counter() - t0) / len(sample)
+        print(f"[Tune] batch size {size}: {cost * 1e6:.0f} us/row")
+        if best_cost is None or cost < best_cost:
+            best_size, best_cost = size, cost
+    print(f"[Tune] Using batch size {best_size}")
+    return best_size
+
+
+def make_http_client():
+    """
+    One keep-alive connection pool for the whole upload, sized to the batches in flight,
+    so every batch after the first reuses an open TLS connection.
+    """
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(retries=2),  # retries failed connects only
+        limits=httpx.Limits(
+            max_keepalive_connections=UPLOAD_CONCURRENCY,
+            max_connections=UPLOAD_CONCURRENCY * 2,
+            keepalive_expiry=60,
+        ),
+        timeout=HTTP_TIMEOUT,
+    )
+
+
+async def connect(url, key, http_client):
+    try:
+        options = AsyncClientOptions(httpx_client=http_client)
+    except TypeError:
+        # supabase-py before the httpx_client option: the SDK's own session still keeps connections alive
+        print("[Info] supabase-py does not accept a custom httpx client; using its default session")
+        options = AsyncClientOptions(postgrest_client_timeout=HTTP_TIMEOUT)
+    return await acreate_client(url, key, options=options)
+
+
+async def make_sender(url, key, http_client):
+    """
+    Coroutine function that upserts one batch. With orjson the batch is serialized once and
+    POSTed straight to PostgREST over the pooled client; otherwise it goes through supabase-py.
+    """
+    if orjson is None:
+        supabase = await connect(url, key, http_client)
+
+        async def send(batch):
+            # Conflicts resolve on the primary key (symbol)
+            await supabase.table(table).upsert(batch).execute()
+        return send
+
+    endpoint = f"{url.rstrip('/')}/rest/v1/{table}"
+    headers = {
+        "apikey": key,
+        "Authorization": f"Bearer {key}",
+        "Content-Type": "application/json",
+        # Upsert on the primary key (symbol); don't echo the rows back
+        "Prefer": "resolution=merge-duplicates,return=minimal",
+    }
+
+    async def send(batch):
+        response = await http_client.post(endpoint, content=orjson.dumps(batch), headers=headers)
+        # HTTPStatusError carries the response, so throttle_wait can read 429 / Retry-After
+        response.raise_for_status()
+    return send
+
+
+async def upload_csv(send):
+    """Stream CSV rows to Supabase in concurrent batches."""
+    print("Reading CSV and uploading to Supabase...")
+    rows = iter_rows(csv_path)
     try:
-        # upsert=True is implicit if we rely on Primary Key (symbol) conflict resolution?
-        # Supabase-py 'upsert' method:
-        response = supabase.table(table).upsert(batch).execute()
-        print(f"Uploaded batch {i} - {i+len(batch)}")
-        time.sleep(0.5) # Rate limit protection
+        batch_size = BATCH_SIZE
+        sent = 0
+        if "--tune" in sys.argv[1:]:
+            sample = list(islice(rows, TUNE_SAMPLE_ROWS))
+            if sample:
+                batch_size = await tune_batch_size(send, sample)
+            # The sample is already uploaded; carry on from where it stopped
+            sent = len(sample)
+
+        sent += await upload_batches(send, rows, batch_size)
     except Exception as e:
-        print(f"Error uploading batch {i}: {e}")
+        print(f"Error reading CSV: {e}")
+        exit(1)
+
+    print(f"Upload complete! {sent} records.")
+
+
+def copy_upload(db_url):
+    """
+    Bulk-load over a direct Postgres connection: COPY every row into a temp table, then
+    one INSERT ... ON CONFLICT into the real table. Returns rows copied.
+    """
+    import psycopg  # optional, only for SUPABASE_DB_URL
+
+    sent = 0
+    with psycopg.connect(db_url) as conn:
+        with conn.cursor() as cur:
+            cur.execute("CREATE TEMP TABLE _stock_names (symbol text, name text, market text) ON COMMIT DROP")
+            with cur.copy("COPY _stock_names (symbol, name, market) FROM STDIN") as copy:
+                for row in iter_rows(csv_path):
+                    copy.write_row((row["symbol"], row["name"], row["market"]))
+                    sent += 1
+            # DISTINCT ON: a symbol repeated in the CSV may only hit ON CONFLICT once per statement
+            cur.execute(
+                f"INSERT INTO public.{table} (symbol, name, market) "
+                "SELECT DISTINCT ON (symbol) symbol, name, market FROM _stock_names "
+                "ON CONFLICT (symbol) DO UPDATE SET name = EXCLUDED.name, market = EXCLUDED.market"
+            )
+    return sent
+
+
+async def main():
+    # 1. Check CSV
+    if not os.path.exists(csv_path):
+        print(f"Error: {csv_path} not found.")
+        exit(1)
+
+    # 2. Direct Postgres COPY when a database URL is configured (much faster than batched REST)
+    db_url = os.environ.get("SUPABASE_DB_URL")
+    if db_url:
+        try:
+            print("Reading CSV and copying to Postgres...")
+            sent = await asyncio.to_thread(copy_upload, db_url)
+            print(f"Upload complete! {sent} records.")
+            return
+        except ImportError:
+            print("[Info] psycopg not installed; falling back to REST upload")
+        except Exception as e:
+            print(f"Error in COPY upload ({e}); falling back to REST upload")
+
+    url = os.environ.get("SUPABASE_URL")
+    key = os.environ.get("SUPABASE_KEY")
+
+    if not url or not key:
+        print("Error: Missing SUPABASE_URL or SUPABASE_KEY")
+        exit(1)
+
+    # 3. Connect over one pooled HTTP client and upload
+    http_client = make_http_client()
+    try:
+        send = await make_sender(url, key, http_client)
+        await upload_csv(send)
+    finally:
+        await http_client.aclose()
+
 
-print("Upload complete!")
+if __name__ == "__main__":
+    asyncio.run(main())
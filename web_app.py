@@ -12,23 +12,21 @@ try:
 except Exception:
     pass
 
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context
 from datetime import datetime
 import os
 import tempfile
 import shutil
 import numpy as np
 from flask_cors import CORS
-from portfolio_service import PortfolioService
+from portfolio_service import get_portfolio_service
 from data_fetcher import DataFetcher
-from knowledge_service import KnowledgeService
-from report_generator import create_chat_pdf, create_markdown_pdf
-from analyst_agent import AnalystAgent
+from knowledge_service import get_knowledge_service
+from report_generator import create_chat_pdf, create_markdown_pdf_async
+from analyst_agent import get_analyst_agent
 
-# Initialize services
-portfolio_service = PortfolioService()
-knowledge_service = KnowledgeService()
-analyst_agent = AnalystAgent()
+# Services are built on first use (get_* are process-wide singletons), not at import:
+# report_generator's spawn workers re-import this module and must stay light
 
 # PDF reporting is disabled for local testing.
 HAVE_REPORT = False
@@ -63,7 +61,7 @@ def get_portfolio():
         user_id = request.headers.get('User-ID', 'anonymous')
         
         # 1. Get holdings from DB/File
-        holdings = portfolio_service.get_portfolio(user_id)
+        holdings = get_portfolio_service().get_portfolio(user_id)
         if not holdings:
             return jsonify({'overview': {'total_market_value': 0, 'total_pl': 0, 'total_cost': 0, 'day_pl': 0, 'total_pl_pct': 0, 'currency': 'CNY'}, 'holdings': []})
 
@@ -99,8 +97,8 @@ def get_portfolio():
             name = rt['name']
             
             # Override name if found in A-Share Map (CSV source of truth)
-            if symbol.isdigit() and symbol in portfolio_service.a_share_map:
-                name = portfolio_service.a_share_map[symbol]
+            if symbol.isdigit() and symbol in get_portfolio_service().a_share_map:
+                name = get_portfolio_service().a_share_map[symbol]
             
             # Determine Currency
             is_us = not symbol.isdigit()
@@ -190,7 +188,7 @@ def add_portfolio_item():
         if not symbol or quantity is None or cost is None:
             return jsonify({'error': 'Missing fields'}), 400
             
-        result = portfolio_service.add_stock(user_id, symbol, quantity, cost)
+        result = get_portfolio_service().add_stock(user_id, symbol, quantity, cost)
         if result.get('status') == 'error':
              return jsonify({'error': result.get('msg')}), 500
              
@@ -198,6 +196,25 @@ def add_portfolio_item():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/portfolio/bulk_add', methods=['POST'])
+def bulk_add_portfolio_items():
+    """Add/update many holdings at once. Body: { "holdings": [{symbol, quantity, cost}, ...] }"""
+    try:
+        user_id = request.headers.get('User-ID', 'anonymous')
+        data = request.get_json(force=True)
+        holdings = data.get('holdings') or []
+
+        if any(not h.get('symbol') or h.get('quantity') is None or h.get('cost') is None for h in holdings):
+            return jsonify({'error': 'Missing fields'}), 400
+
+        result = get_portfolio_service().bulk_add_stocks(user_id, holdings)
+        if result.get('status') == 'error':
+             return jsonify({'error': result.get('msg')}), 500
+
+        return jsonify({'status': 'success', 'count': result.get('count', 0)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/portfolio/update', methods=['POST'])
 def update_portfolio_item():
     """Update an existing stock holding."""
@@ -212,7 +229,7 @@ def update_portfolio_item():
             return jsonify({'error': 'Missing fields'}), 400
             
         # Reusing update_stock logic (which wraps add_stock with upsert)
-        result = portfolio_service.update_stock(user_id, symbol, quantity, cost)
+        result = get_portfolio_service().update_stock(user_id, symbol, quantity, cost)
         if result.get('status') == 'error':
              return jsonify({'error': result.get('msg')}), 500
              
@@ -235,7 +252,7 @@ def get_portfolio_analysis():
         user_id = request.headers.get('User-ID', 'anonymous')
 
         # 1. Get Holdings
-        holdings = portfolio_service.get_portfolio(user_id)
+        holdings = get_portfolio_service().get_portfolio(user_id)
         if not holdings:
              return jsonify({'error': 'Portfolio is empty'}), 400
 
@@ -372,7 +389,7 @@ def remove_portfolio_item():
         if not symbol:
              return jsonify({'error': 'Missing symbol'}), 400
 
-        result = portfolio_service.remove_stock(user_id, symbol)
+        result = get_portfolio_service().remove_stock(user_id, symbol)
         if result.get('status') == 'error':
              return jsonify({'error': result.get('msg')}), 500
              
@@ -390,7 +407,7 @@ def toggle_portfolio_pin():
         if not symbol:
              return jsonify({'error': 'Missing symbol'}), 400
 
-        result = portfolio_service.toggle_stock_pin(user_id, symbol)
+        result = get_portfolio_service().toggle_stock_pin(user_id, symbol)
         if result.get('status') == 'error':
              return jsonify({'error': result.get('msg')}), 500
              
@@ -418,7 +435,7 @@ def upload_document():
              return jsonify({'error': 'Only PDF files are allowed'}), 400
 
         user_id = request.headers.get('User-ID', 'anonymous')
-        result = knowledge_service.save_document(symbol, file, file.filename, user_id=user_id)
+        result = get_knowledge_service().save_document(symbol, file, file.filename, user_id=user_id)
         if "error" in result:
              return jsonify(result), 500
              
@@ -432,7 +449,7 @@ def list_documents():
     if not symbol:
         return jsonify({'error': 'Missing symbol'}), 400
     try:
-        docs = knowledge_service.list_documents(symbol)
+        docs = get_knowledge_service().list_documents(symbol)
         return jsonify(docs)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -444,7 +461,7 @@ def download_document():
         return jsonify({'error': 'Missing doc_id'}), 400
     try:
         # Get metadata to find path
-        doc = knowledge_service.get_document_metadata(doc_id)
+        doc = get_knowledge_service().get_document_metadata(doc_id)
         if not doc or not os.path.exists(doc['file_path']):
              return jsonify({'error': 'Document not found'}), 404
              
@@ -462,7 +479,7 @@ def delete_document():
     if not doc_id:
         return jsonify({'error': 'Missing doc_id'}), 400
     try:
-        success = knowledge_service.delete_document(doc_id)
+        success = get_knowledge_service().delete_document(doc_id)
         if success:
             return jsonify({'status': 'success'})
         else:
@@ -480,7 +497,7 @@ def toggle_document_pin():
         if not doc_id:
             return jsonify({'error': 'Missing doc_id'}), 400
 
-        result = knowledge_service.toggle_pin_status(doc_id, user_id)
+        result = get_knowledge_service().toggle_pin_status(doc_id, user_id)
         if result.get('success'):
             return jsonify(result)
         else:
@@ -505,7 +522,7 @@ def save_chat_to_knowledge():
         # Save
         user_id = request.headers.get('User-ID', 'anonymous')
         filename = f"chat_export_{datetime.now().strftime('%Y%m%d%H%M%S')}.pdf"
-        result = knowledge_service.save_document(symbol, pdf_bytes, filename, doc_type='chat_history', user_id=user_id)
+        result = get_knowledge_service().save_document(symbol, pdf_bytes, filename, doc_type='chat_history', user_id=user_id)
         
         if "error" in result:
              return jsonify(result), 500
@@ -526,16 +543,16 @@ def generate_agent_report():
             return jsonify({'error': 'Missing symbol'}), 400
             
         # 1. Get Context
-        docs_text = knowledge_service.get_documents_content(selected_file_ids)
+        docs_text = get_knowledge_service().get_documents_content(selected_file_ids)
         
         # 2. Run Agent (Multi-Agent Workflow)
         # Returns only the final report text now
         if symbol in ["MACRO", "STRATEGY"]:
-            report_text = analyst_agent.generate_macro_strategy_report(
+            report_text = get_analyst_agent().generate_macro_strategy_report(
                 symbol, docs_text, model
             )
         else:
-            report_text = analyst_agent.generate_deep_research_report(
+            report_text = get_analyst_agent().generate_deep_research_report(
                 symbol, docs_text, model
             )
         
@@ -550,7 +567,8 @@ def generate_agent_report():
             user_id = request.headers.get('User-ID', 'anonymous')
             import time
             t0 = time.time()
-            pdf_bytes = create_markdown_pdf(symbol, report_text)
+            # Render in the PDF worker pool so concurrent requests don't queue on one core
+            pdf_bytes = create_markdown_pdf_async(symbol, report_text).result()
             
             if not pdf_bytes or len(pdf_bytes) == 0:
                 print(f"[Error] PDF generation returned empty bytes. Time taken: {time.time()-t0:.2f}s")
@@ -558,7 +576,7 @@ def generate_agent_report():
             else:
                 print(f"[Info] PDF generated successfully ({len(pdf_bytes)} bytes) in {time.time()-t0:.2f}s")
                 filename = f"DeepReport_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-                save_result = knowledge_service.save_document(symbol, pdf_bytes, filename, doc_type='ai_report', user_id=user_id)
+                save_result = get_knowledge_service().save_document(symbol, pdf_bytes, filename, doc_type='ai_report', user_id=user_id, source_text=report_text)
                 results['file_record'] = save_result
                 
         except Exception as pdf_e:
@@ -579,9 +597,8 @@ def generate_ultra_deep_report():
     Returns: { "status": "pending", "task_id": "..." }
     """
     try:
-        from deep_research_agent import DeepResearchAgent
-        from task_manager import TaskManager
-        import threading
+        from deep_research_agent import DeepResearchAgent, webhook_url_for
+        from task_manager import get_task_manager
 
         data = request.get_json(force=True)
         symbol = data.get('symbol')
@@ -594,7 +611,7 @@ def generate_ultra_deep_report():
             return jsonify({'error': 'Missing required parameters'}), 400
 
         # Create Task Record
-        tm = TaskManager()
+        tm = get_task_manager()
         task_id = tm.create_task(symbol, mode)
 
         # Initialize agent
@@ -603,14 +620,11 @@ def generate_ultra_deep_report():
         # Get user_id from headers
         user_id = request.headers.get('User-ID')
 
-        # Start Background Thread
-        # We pass knowledge_service instance to thread
-        thread = threading.Thread(
-            target=agent.run_async_task,
-            args=(task_id, mode, custom_prompt, symbol if mode == 'STOCK' else None, knowledge_service, user_id)
-        )
-        thread.daemon = True # Ensure thread doesn't block shutdown
-        thread.start()
+        # Queue on the shared background event loop (returns immediately)
+        # We pass knowledge_service instance to the task
+        # With DEEP_RESEARCH_WEBHOOK_BASE/SECRET set, completion arrives at deep_research_webhook instead of polling
+        agent.submit_task(task_id, mode, custom_prompt, symbol if mode == 'STOCK' else None, get_knowledge_service(), user_id,
+                          webhook_url=webhook_url_for(task_id))
 
         return jsonify({
             'status': 'pending',
@@ -623,15 +637,38 @@ def generate_ultra_deep_report():
         traceback.print_exc()
         return jsonify({'error': f'Failed to start task: {str(e)}'}), 500
 
+@app.route('/api/agent/deep_research_webhook/<task_id>', methods=['POST'])
+def deep_research_webhook(task_id):
+    """
+    Completion callback from the Deep Research API (URL built by deep_research_agent.webhook_url_for).
+    Only the token is checked here; the task's result is fetched from the API, not taken from the body.
+    """
+    try:
+        from deep_research_agent import DeepResearchAgent, verify_webhook_token
+        from gemini_dispatcher import submit
+
+        if not verify_webhook_token(task_id, request.args.get('token', '')):
+            return jsonify({'error': 'Invalid token'}), 403
+
+        # Fetch, render and save on the shared event loop; acknowledge right away
+        submit(DeepResearchAgent.acomplete_webhook_task(task_id))
+        return jsonify({'status': 'accepted'}), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/agent/task_status/<task_id>', methods=['GET'])
 def get_task_status(task_id):
     try:
-        from task_manager import TaskManager
-        tm = TaskManager()
-        task = tm.get_task(task_id)
+        from task_manager import get_task_manager
+        task = get_task_manager().get_task(task_id)
         
         if not task:
             return jsonify({'error': 'Task not found'}), 404
+
+        if task['status'] == 'processing':
+            # After a restart nothing else may wake the webhook sweep that resolves tasks whose callback was lost
+            from deep_research_agent import ensure_webhook_sweeper
+            ensure_webhook_sweeper()
             
         return jsonify(task)
     except Exception as e:
@@ -710,8 +747,8 @@ def analyze():
             # Force update name from A-share map if available (Fix for Analyzer header display)
             if analyzer.stock_info and 'code' in analyzer.stock_info and analyzer.stock_info['code'].isdigit():
                 code = analyzer.stock_info['code']
-                if hasattr(portfolio_service, 'a_share_map') and code in portfolio_service.a_share_map:
-                    analyzer.stock_info['name'] = portfolio_service.a_share_map[code]
+                if hasattr(get_portfolio_service(), 'a_share_map') and code in get_portfolio_service().a_share_map:
+                    analyzer.stock_info['name'] = get_portfolio_service().a_share_map[code]
 
             result = {
                 'stock_info': analyzer.stock_info,
@@ -755,11 +792,24 @@ def stock_summary():
         
     try:
         # Delegate to portfolio_service to handle caching and AI call
-        summary = portfolio_service.get_company_summary(symbol)
+        summary = get_portfolio_service().get_company_summary(symbol)
         return jsonify({'summary': summary})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/stock_summaries')
+def stock_summaries():
+    """Summaries for a comma-separated list of symbols in one request: { "summaries": {symbol: summary} }"""
+    symbols = [s.strip().upper() for s in request.args.get('symbols', '').split(',') if s.strip()]
+    if not symbols:
+        return jsonify({'error': 'Missing symbols'}), 400
+
+    try:
+        summaries = get_portfolio_service().get_company_summaries(symbols)
+        return jsonify({'summaries': summaries})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     try:
@@ -774,11 +824,40 @@ def chat():
         if not symbol or (not message and not image_data):
             return jsonify({'error': 'Missing symbol or message/image'}), 400
             
-        reply = portfolio_service.chat_with_gemini(symbol, message, history, selected_file_ids, model, image_data)
+        reply = get_portfolio_service().chat_with_gemini(symbol, message, history, selected_file_ids, model, image_data)
         return jsonify({'reply': reply})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Same as /api/chat, but streams the reply as server-sent events."""
+    import json
+    try:
+        data = request.get_json(force=True)
+        symbol = (data.get('symbol') or '').strip().upper()
+        message = (data.get('message') or '').strip()
+        history = data.get('history') or []
+        selected_file_ids = data.get('selected_file_ids') or []
+        model = data.get('model') or 'gemini-2.5-flash'
+        image_data = data.get('image_data')
+
+        if not symbol or (not message and not image_data):
+            return jsonify({'error': 'Missing symbol or message/image'}), 400
+
+        def events():
+            for text in get_portfolio_service().chat_with_gemini_stream(symbol, message, history, selected_file_ids, model, image_data):
+                yield f"data: {json.dumps({'text': text}, ensure_ascii=False)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+
+        return Response(
+            stream_with_context(events()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/health')
 def health():
     return jsonify({'status': 'ok'})
@@ -990,8 +1069,8 @@ def _generate_pdf_report(analyzer, pdf_path: str, chart_png_path: str):
 def debug_ashare_map():
     """Debug endpoint to check if A-share map is loaded."""
     try:
-        count = len(portfolio_service.a_share_map)
-        sample = dict(list(portfolio_service.a_share_map.items())[:5])
+        count = len(get_portfolio_service().a_share_map)
+        sample = dict(list(get_portfolio_service().a_share_map.items())[:5])
         return jsonify({
             'status': 'ok',
             'count': count,